@@ -0,0 +1,118 @@
+"""
+Embedding size benchmark: recall and search latency per dimension and storage type.
+
+Loads stored full-size embeddings, then for each (dimensions, type) configuration builds a
+temporary table with truncated + re-normalized vectors and an HNSW index, and runs sampled
+queries against it. Recall@k is measured against exact float32 search on the full vectors.
+No embedding API calls are made.
+
+Usage:
+    python -m api.bench_embeddings [--chat-id <CHAT_ID>] [--rows 5000] [--queries 100] [--k 10]
+                                   [--dimensions 256,512,768,1024,1536] [--types vector,halfvec]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+def _truncate(vectors, dimensions: int):
+    import numpy as np
+    shortened = vectors[:, :dimensions]
+    return shortened / np.maximum(np.linalg.norm(shortened, axis=1, keepdims=True), 1e-12)
+
+async def bench_config(connection, ids, vectors, query_rows, truth, k: int, dimensions: int, storage_type: str):
+    shortened = _truncate(vectors, dimensions)
+    table = f"bench_embeddings_{storage_type}_{dimensions}"
+    await connection.execute(f"DROP TABLE IF EXISTS {table}")
+    await connection.execute(f"CREATE TEMP TABLE {table} (memory_id BIGINT, embedding {storage_type}({dimensions}))")
+    await connection.copy_records_to_table(
+        table, records=[(int(i), v.tolist()) for i, v in zip(ids, shortened)], columns=["memory_id", "embedding"]
+    )
+    began = time.perf_counter()
+    await connection.execute(
+        f"CREATE INDEX ON {table} USING hnsw (embedding {storage_type}_cosine_ops) WITH (m = 16, ef_construction = 64)"
+    )
+    build_s = time.perf_counter() - began
+    await connection.execute(f"ANALYZE {table}")
+    sizes = await connection.fetchrow(
+        f"SELECT avg(pg_column_size(embedding))::INT AS row_bytes, pg_indexes_size('{table}') AS index_bytes FROM {table}"
+    )
+
+    query = f"SELECT memory_id FROM {table} ORDER BY embedding <=> $1::{storage_type}({dimensions}) LIMIT $2"
+    timings, recalls = [], []
+    for row, expected in zip(query_rows, truth):
+        start = time.perf_counter()
+        found = await connection.fetch(query, shortened[row].tolist(), k)
+        timings.append((time.perf_counter() - start) * 1000)
+        recalls.append(len({r["memory_id"] for r in found} & expected) / k)
+    await connection.execute(f"DROP TABLE {table}")
+
+    timings.sort()
+    print(f"{storage_type:<8} {dimensions:>5} {statistics.mean(recalls):>9.3f} {statistics.mean(timings):>9.2f} "
+          f"{timings[len(timings) // 2]:>9.2f} {timings[int(len(timings) * 0.95) - 1]:>9.2f} "
+          f"{sizes['row_bytes']:>9} {sizes['index_bytes'] / 1e6:>10.1f} {build_s:>8.1f}")
+
+async def run_benchmark(chat_id: int | None, rows: int, queries: int, k: int, dimensions: list[int], types: list[str]):
+    import numpy as np
+
+    await database.init_db_pool()
+    repo = database.repository
+    if not repo:
+        print("Database is not available.")
+        return
+    try:
+        async with repo.connection() as connection:
+            records = await connection.fetch(
+                "SELECT memory_id, embedding FROM chat_memories WHERE ($1::BIGINT IS NULL OR chat_id = $1) "
+                "ORDER BY memory_id DESC LIMIT $2",
+                chat_id, rows
+            )
+            if len(records) <= k:
+                print("Not enough stored memories to benchmark.")
+                return
+            ids = np.array([r["memory_id"] for r in records])
+            vectors = np.array([r["embedding"] for r in records], dtype=np.float32)
+            full_dims = vectors.shape[1]
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+            # Exact ground truth on the full float32 vectors
+            rng = np.random.default_rng(0)
+            query_rows = rng.choice(len(ids), size=min(queries, len(ids)), replace=False)
+            scores = vectors[query_rows] @ vectors.T
+            top = np.argsort(-scores, axis=1)[:, :k]
+            truth = [set(ids[row].tolist()) for row in top]
+
+            print(f"{len(ids)} rows of {full_dims} dims, {len(query_rows)} queries, recall@{k} vs exact float32 search")
+            print(f"{'type':<8} {'dims':>5} {'recall':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} "
+                  f"{'row B':>9} {'index MB':>10} {'build s':>8}")
+            for storage_type in types:
+                for dims in dimensions:
+                    if dims > full_dims:
+                        continue
+                    await bench_config(connection, ids, vectors, query_rows, truth, k, dims, storage_type)
+    finally:
+        await database.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall/latency per embedding size and storage type.")
+    parser.add_argument("--chat-id", type=int, default=None)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dimensions", default="256,512,768,1024,1536")
+    parser.add_argument("--types", default="vector,halfvec")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run_benchmark(
+        args.chat_id, args.rows, args.queries, args.k,
+        [int(d) for d in args.dimensions.split(",")], args.types.split(",")
+    ))
+
+if __name__ == "__main__":
+    main()
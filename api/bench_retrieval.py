@@ -0,0 +1,78 @@
+"""
+Retrieval latency benchmark: vector vs hybrid memory search.
+
+Samples stored memories from a chat and replays them as queries (their stored
+embedding plus text), so no embedding API calls are made.
+
+Usage:
+    python -m api.bench_retrieval --chat-id <CHAT_ID> [--samples 50] [--limit 3]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from . import database
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def run_benchmark(chat_id: int, samples: int, limit: int, max_age_days: int | None):
+    await database.init_db_pool()
+    repo = database.repository
+    if not repo:
+        print("Database is not available.")
+        return
+
+    async with repo.connection() as connection:
+        rows = await connection.fetch(
+            "SELECT bot_id, message_text, embedding FROM chat_memories WHERE chat_id = $1 ORDER BY random() LIMIT $2",
+            chat_id, samples
+        )
+    if not rows:
+        print(f"No memories found for chat {chat_id}.")
+        await database.close_db_pool()
+        return
+    queries = [(row["bot_id"], row["message_text"], row["embedding"]) for row in rows]
+
+    results: dict[str, list[set]] = {}
+    print(f"Benchmarking {len(queries)} queries against chat {chat_id} (limit {limit})")
+    print(f"{'mode':<8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for mode in database.RETRIEVAL_MODES:
+        # One warm-up query so connection setup and statement preparation aren't measured
+        await database.find_relevant_memories(queries[0][0], chat_id, queries[0][2], limit, max_age_days, mode=mode, query_text=queries[0][1])
+        timings = []
+        results[mode] = []
+        for bot_id, text, embedding in queries:
+            start = time.perf_counter()
+            memories = await database.find_relevant_memories(
+                bot_id, chat_id, embedding, limit, max_age_days, mode=mode, query_text=text
+            )
+            timings.append((time.perf_counter() - start) * 1000)
+            results[mode].append({m["memory_id"] for m in memories})
+        print(f"{mode:<8} {statistics.mean(timings):>9.2f} {_percentile(timings, 50):>9.2f} "
+              f"{_percentile(timings, 95):>9.2f} {_percentile(timings, 99):>9.2f}")
+
+    overlaps = [len(v & h) / max(1, len(v)) for v, h in zip(results["vector"], results["hybrid"])]
+    print(f"Mean top-{limit} overlap between modes: {statistics.mean(overlaps):.2%}")
+    await database.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory retrieval latency per mode.")
+    parser.add_argument("--chat-id", type=int, required=True)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=settings.MEMORY_RETRIEVAL_LIMIT if settings else 3)
+    parser.add_argument("--max-age-days", type=int, default=None)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING) # Keep per-query info logs out of the report
+    asyncio.run(run_benchmark(args.chat_id, args.samples, args.limit, args.max_age_days))
+
+if __name__ == "__main__":
+    main()
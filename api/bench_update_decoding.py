@@ -0,0 +1,127 @@
+"""
+Webhook decode/encode benchmark: per-update CPU cost of turning a request body into the
+fields the pipeline reads, and of serializing the response.
+
+Compares the previous approach (json.loads + pydantic model with Dict fields + .get()
+chains), pydantic parsing straight from bytes, and the msgspec structs in telegram_types.
+Payloads are realistic group updates: a text message with entities and full from/chat
+objects, a reply to the bot, and an edited message. No network or database access.
+
+Usage:
+    python -m api.bench_update_decoding [--iterations 50000]
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Dict
+
+from pydantic import BaseModel
+
+from . import telegram_types
+
+_USER = {"id": 123456789, "is_bot": False, "first_name": "Alice", "last_name": "Smith",
+         "username": "alice_smith", "language_code": "en", "is_premium": True}
+_CHAT = {"id": -1001234567890, "title": "Crypto Builders", "username": "cryptobuilders",
+         "type": "supergroup", "is_forum": False}
+_BOT = {"id": 987654321, "is_bot": True, "first_name": "Telefy", "username": "telefy_bot"}
+
+PAYLOADS = {
+    "mention": {
+        "update_id": 500000001,
+        "message": {
+            "message_id": 4242, "from": _USER, "chat": _CHAT, "date": 1760000000,
+            "text": "@telefy_bot what did we decide about the token launch date last week? https://example.com/x",
+            "entities": [{"offset": 0, "length": 11, "type": "mention"},
+                         {"offset": 70, "length": 21, "type": "url"}],
+        },
+    },
+    "reply": {
+        "update_id": 500000002,
+        "message": {
+            "message_id": 4243, "from": _USER, "chat": _CHAT, "date": 1760000005,
+            "text": "ok and who is handling the announcement?",
+            "reply_to_message": {
+                "message_id": 4241, "from": _BOT, "chat": _CHAT, "date": 1759999990,
+                "text": "The launch was moved to the 14th after the audit feedback.",
+            },
+        },
+    },
+    "edited": {
+        "update_id": 500000003,
+        "edited_message": {
+            "message_id": 4240, "from": _USER, "chat": _CHAT, "date": 1759999900, "edit_date": 1759999950,
+            "text": "gm everyone",
+        },
+    },
+}
+
+RESPONSE = {"status": "ok", "detail": "Response sent"}
+
+
+class LegacyTelegramUpdate(BaseModel):
+    """The webhook's previous request model."""
+    update_id: int
+    message: Dict[str, Any] | None = None
+    edited_message: Dict[str, Any] | None = None
+    channel_post: Dict[str, Any] | None = None
+    edited_channel_post: Dict[str, Any] | None = None
+
+
+def legacy_extract(body: bytes):
+    # What FastAPI did for the old endpoint signature, followed by the handler's lookups
+    update = LegacyTelegramUpdate.model_validate(json.loads(body))
+    message = update.message or update.edited_message
+    reply = message.get('reply_to_message') or {}
+    return (message.get('chat', {}).get('id'), message.get('text'), message.get('from', {}).get('id'),
+            message.get('message_id'), message.get('date'), reply.get('from', {}).get('id'))
+
+def pydantic_json_extract(body: bytes):
+    update = LegacyTelegramUpdate.model_validate_json(body)
+    message = update.message or update.edited_message
+    reply = message.get('reply_to_message') or {}
+    return (message.get('chat', {}).get('id'), message.get('text'), message.get('from', {}).get('id'),
+            message.get('message_id'), message.get('date'), reply.get('from', {}).get('id'))
+
+def msgspec_extract(body: bytes):
+    update = telegram_types.decode_update(body)
+    message = update.message or update.edited_message
+    reply = message.reply_to_message
+    return (message.chat.id, message.text, message.sender.id if message.sender else None,
+            message.message_id, message.date, reply.sender.id if reply and reply.sender else None)
+
+
+def _time_us(func, arg, iterations: int) -> float:
+    for _ in range(min(1000, iterations)): # Warm-up
+        func(arg)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def run_benchmark(iterations: int):
+    decoders = [("json.loads + pydantic Dict model", legacy_extract),
+                ("pydantic model_validate_json", pydantic_json_extract),
+                ("msgspec structs", msgspec_extract)]
+    print(f"Decode + field extraction, µs/update ({iterations} iterations)")
+    print(f"{'payload':<10} {'bytes':>6} " + " ".join(f"{name:>34}" for name, _ in decoders))
+    for name, payload in PAYLOADS.items():
+        body = json.dumps(payload).encode()
+        expected = legacy_extract(body)
+        for _, func in decoders[1:]:
+            assert func(body) == expected, f"{func.__name__} disagrees on {name}"
+        timings = [_time_us(func, body, iterations) for _, func in decoders]
+        print(f"{name:<10} {len(body):>6} " + " ".join(f"{t:>34.2f}" for t in timings))
+
+    print("\nResponse encoding, µs/response")
+    print(f"  json.dumps().encode()   {_time_us(lambda r: json.dumps(r).encode(), RESPONSE, iterations):.2f}")
+    print(f"  msgspec                 {_time_us(telegram_types.encode, RESPONSE, iterations):.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark webhook update decoding and response encoding.")
+    parser.add_argument("--iterations", type=int, default=50000)
+    args = parser.parse_args()
+    run_benchmark(args.iterations)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Registry of the Telegram bots served by this process.
+
+The primary bot comes from TELEGRAM_BOT_TOKEN (with BOT_USERNAME / BOT_USER_ID / DEFAULT_PERSONA),
+more from TELEGRAM_BOTS. All bots share the process's database pool, OpenAI client, Telegram HTTP
+client and caches; what differs per bot is its token, identity, default persona and memories
+(chat_memories.bot_id), and per-chat in-process state is keyed by chat_key().
+
+Updates for a bot are posted to /api/webhook/<webhook_key(token)>, a path that can't be derived
+without the token (Telegram's recommendation for webhook URLs) but doesn't reveal it in access
+logs. /api/webhook keeps serving the primary bot. The bot of the current request is held in a
+context variable, like the logging context.
+"""
+
+import contextvars
+import hashlib
+import logging
+from typing import Iterator, Optional
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def bot_user_id_from_token(token: Optional[str]) -> Optional[int]:
+    """Bot tokens look like '<bot_id>:<secret>', so the bot's user ID needs no network call."""
+    if not token or ":" not in token:
+        return None
+    try:
+        return int(token.split(":", 1)[0])
+    except ValueError:
+        return None
+
+def webhook_key(token: str) -> str:
+    """Path segment that routes a bot's updates (bot/listener.py derives the same key)."""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+class Bot:
+    """One hosted bot. `username` (with '@') is resolved by telegram_utils.ensure_bot_info if not configured."""
+    __slots__ = ("token", "user_id", "username", "persona", "webhook_key")
+
+    def __init__(self, token: str, username: Optional[str] = None, user_id: Optional[int] = None,
+                 persona: Optional[str] = None):
+        self.token = token
+        self.user_id = user_id or bot_user_id_from_token(token)
+        self.username = (username if username.startswith("@") else f"@{username}") if username else None
+        self.persona = persona # Default persona for this bot's groups; None = DEFAULT_PERSONA
+        self.webhook_key = webhook_key(token)
+
+    def __repr__(self) -> str:
+        return f"Bot({self.username or '?'}, id={self.user_id})" # Never the token
+
+
+class BotRegistry:
+    def __init__(self, bots: list[Bot]):
+        self.primary: Optional[Bot] = None
+        self._by_key: dict[str, Bot] = {}
+        self._by_user_id: dict[int, Bot] = {}
+        for bot in bots:
+            if not bot.user_id:
+                logger.error("Ignoring a configured bot: its token is malformed.")
+                continue
+            if bot.user_id in self._by_user_id:
+                logger.error("Ignoring duplicate configuration for bot %s.", bot.user_id)
+                continue
+            self._by_key[bot.webhook_key] = bot
+            self._by_user_id[bot.user_id] = bot
+            if self.primary is None:
+                self.primary = bot
+
+    def get(self, key: str) -> Optional[Bot]:
+        """Looks up a bot by webhook key."""
+        return self._by_key.get(key)
+
+    def by_user_id(self, user_id: int) -> Optional[Bot]:
+        return self._by_user_id.get(user_id)
+
+    def __iter__(self) -> Iterator[Bot]:
+        return iter(self._by_user_id.values())
+
+    def __len__(self) -> int:
+        return len(self._by_user_id)
+
+    def stats(self) -> dict:
+        return {"bots": len(self), "identified": sum(1 for bot in self if bot.username)}
+
+
+def _configured_bots() -> list[Bot]:
+    if not settings:
+        return []
+    bots = []
+    if settings.TELEGRAM_BOT_TOKEN:
+        bots.append(Bot(settings.TELEGRAM_BOT_TOKEN, settings.BOT_USERNAME, settings.BOT_USER_ID))
+    for config in settings.TELEGRAM_BOTS:
+        bots.append(Bot(config.token, config.username, config.user_id, config.persona))
+    if not bots:
+        logger.error("No bots configured (TELEGRAM_BOT_TOKEN / TELEGRAM_BOTS). Cannot send messages or fetch bot info.")
+    return bots
+
+
+registry = BotRegistry(_configured_bots())
+
+_current: contextvars.ContextVar[Optional[Bot]] = contextvars.ContextVar("bot", default=None)
+
+def use(bot: Bot):
+    """Selects the bot the current request is handled for."""
+    _current.set(bot)
+
+def current() -> Optional[Bot]:
+    """The bot of the current request (the primary bot outside of a request)."""
+    return _current.get() or registry.primary
+
+def chat_key(chat_id: int) -> tuple[int, int]:
+    """Key for per-chat in-process state, so bots sharing a chat keep separate buffers, bursts and limits."""
+    bot = current()
+    return (bot.user_id if bot else 0, chat_id)
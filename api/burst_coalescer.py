@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Hashable, Optional
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TriggeredMessage:
+    """A message that mentioned or replied to the bot."""
+    __slots__ = ("message_id", "sender_user_id", "sender_name", "text", "date")
+
+    def __init__(self, message_id: Optional[int], sender_user_id: Optional[int], sender_name: Optional[str],
+                 text: str, date: Optional[int]):
+        self.message_id = message_id
+        self.sender_user_id = sender_user_id
+        self.sender_name = sender_name # "@username", first name, or None
+        self.text = text
+        self.date = date # Unix timestamp
+
+    @property
+    def speaker(self) -> str:
+        return self.sender_name or f"User {self.sender_user_id}"
+
+
+class _Burst:
+    __slots__ = ("messages", "full", "opened_at")
+
+    def __init__(self):
+        self.messages: list[TriggeredMessage] = []
+        self.full = asyncio.Event()
+        self.opened_at = time.monotonic()
+
+
+class BurstCoalescer:
+    """
+    Gathers triggered messages per chat (bot_registry.chat_key()) during the group's burst window.
+
+    The first mention in a chat opens a burst and becomes its leader: a background task waits
+    out the window (or until `max_messages` are gathered) and then gets every gathered message,
+    to answer them with one reply. Mentions arriving while a burst is open join it. Every
+    webhook request returns at once, so the listener's forward timeout doesn't limit the window.
+    State is per process, so with several replicas a burst only gathers the mentions that reach
+    the same instance. Its updates count as handled once their requests return, so a burst is
+    lost if the process stops inside the window. For the same reason bursts are off in
+    SERVERLESS_MODE, where the instance may be frozen as soon as it has responded.
+    """
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self._open: dict[Hashable, _Burst] = {}
+        self.bursts = 0
+        self.coalesced = 0
+
+    def join(self, chat_key: Hashable, message: TriggeredMessage) -> Optional[_Burst]:
+        """
+        Adds a triggered message to the chat's open burst and returns None, or opens a new burst
+        with it and returns that burst, which the caller (the leader) then passes to collect().
+        """
+        burst = self._open.get(chat_key)
+        if burst is not None:
+            burst.messages.append(message)
+            self.coalesced += 1
+            if len(burst.messages) >= self.max_messages:
+                del self._open[chat_key] # Later mentions start a new burst
+                burst.full.set()
+            return None
+        burst = self._open[chat_key] = _Burst()
+        burst.messages.append(message)
+        return burst
+
+    async def collect(self, chat_key: Hashable, burst: _Burst, window_seconds: float) -> list[TriggeredMessage]:
+        """Waits out the window (or until the burst is full) and returns its messages, oldest first."""
+        try:
+            await asyncio.wait_for(burst.full.wait(), window_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._open.get(chat_key) is burst:
+                del self._open[chat_key]
+        self.bursts += 1
+        if len(burst.messages) > 1:
+            logger.info("Coalesced %s mentions in chat %s into one reply (%.1fs window).",
+                        len(burst.messages), chat_key, time.monotonic() - burst.opened_at)
+        return burst.messages
+
+    def stats(self) -> dict:
+        return {"open": len(self._open), "bursts": self.bursts, "coalesced": self.coalesced}
+
+
+coalescer = BurstCoalescer(max_messages=settings.BURST_MAX_MESSAGES if settings else 15)
@@ -1,6 +1,6 @@
 import logging
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import PostgresDsn, Field
+from pydantic import BaseModel, PostgresDsn, Field
 from typing import Optional
 
 logger = logging.getLogger(__name__)
@@ -9,25 +9,189 @@ logger = logging.getLogger(__name__)
 # Define .env file loading if needed (optional)
 # We can add validation here too
 
+class BotConfig(BaseModel):
+    """One additional bot served by this process (see TELEGRAM_BOTS and bot_registry.py)."""
+    token: str = Field(..., repr=False)
+    username: Optional[str] = None # With or without '@'; skips the getMe call when set
+    user_id: Optional[int] = None # Defaults to the numeric prefix of the token
+    persona: Optional[str] = None # Default persona for this bot's groups (instead of DEFAULT_PERSONA)
+
 class Settings(BaseSettings):
     # Define fields corresponding to environment variables
     # Secrets (use Field(repr=False) to hide from logs/repr)
-    TELEGRAM_BOT_TOKEN: str = Field(..., repr=False) 
+    # Primary bot, served on /api/webhook (and /api/webhook/<key>); may be omitted if TELEGRAM_BOTS is set
+    TELEGRAM_BOT_TOKEN: Optional[str] = Field(None, repr=False)
+    # More bots hosted by the same process, as JSON: [{"token": "...", "username": "...", "persona": "..."}].
+    # Each bot's updates go to /api/webhook/<bot_registry.webhook_key(token)>.
+    TELEGRAM_BOTS: list[BotConfig] = Field([], repr=False)
     OPENAI_API_KEY: str = Field(..., repr=False)
     DATABASE_URL: PostgresDsn # Pydantic validates the DSN format
+    # Direct (non-PgBouncer) connection for LISTEN; defaults to DATABASE_URL
+    DATABASE_LISTEN_URL: Optional[PostgresDsn] = Field(None, repr=False)
+    # Shared secret for the /api/admin/* endpoints (X-Admin-Token header); they are disabled when unset
+    ADMIN_API_TOKEN: Optional[str] = Field(None, repr=False)
 
     # General Config
     # API_BASE_URL for listener might be better set where listener runs
     # API_BASE_URL: str = "http://localhost:8000" 
     DEFAULT_PERSONA: str = "You are a helpful AI assistant participating in a Telegram group chat."
     
+    # Logging Config (see logging_setup.py)
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json" # "json" (one object per line) or "text"
+    # Fraction of INFO/DEBUG records kept per logger-name prefix, e.g. {"api.llm_service": 0.1}
+    LOG_SAMPLE_RATES: dict[str, float] = {}
+
     # Model Config
     LLM_MODEL: str = "gpt-4o-mini"
+    # Cheaper/faster model for the router's fast tier and the load-shedding fast_model level.
+    # Setting it to LLM_MODEL makes that level a no-op.
+    LLM_FAST_MODEL: str = "gpt-4.1-nano"
+    LLM_MAX_TOKENS: int = 150
+    # Per OpenAI request (completion or embedding), and retries after a timeout or server error. A reply makes
+    # up to two such calls, so the listener's FORWARD_TIMEOUT_SECONDS should exceed 2 * (1 + retries) * timeout.
+    LLM_TIMEOUT_SECONDS: float = 20.0
+    LLM_MAX_RETRIES: int = 1
+    # Model routing: pick fast/default/large per request (see model_router.py)
+    LLM_ROUTING_ENABLED: bool = True
+    LLM_LARGE_MODEL: str = "gpt-4o" # Only used for messages classified as complex
+    LLM_FAST_MAX_TOKENS: int = 60
+    LLM_LARGE_MAX_TOKENS: int = 400
+    LLM_ROUTING_SHORT_MESSAGE_CHARS: int = 24 # At or below: fast tier (unless it looks like a real question)
+    LLM_ROUTING_LONG_MESSAGE_CHARS: int = 280 # At or above: counts towards the large tier
+    LLM_ROUTING_LARGE_CONTEXT_CHARS: int = 6000 # Prompt context size that counts towards the large tier
+    # A model is avoided while its latency (EWMA) or error rate exceeds these; stats decay while idle
+    LLM_ROUTING_LATENCY_BUDGET_SECONDS: float = 8.0
+    LLM_ROUTING_MAX_ERROR_RATE: float = 0.3
+    LLM_ROUTING_STATS_HALF_LIFE_SECONDS: float = 120.0
     EMBEDDING_MODEL: str = "text-embedding-3-small"
+    # Reduced output size for text-embedding-3 models (None = model default, 1536 for -small).
+    # Must not exceed the chat_memories.embedding column (longer embeddings are shortened to fit);
+    # see migrate_embeddings.py for changing it and the order to deploy in.
+    EMBEDDING_DIMENSIONS: Optional[int] = None
+    # Column type of chat_memories.embedding: "vector" (float32) or "halfvec" (float16, pgvector >= 0.7)
+    EMBEDDING_STORAGE_TYPE: str = "vector"
 
     # Memory Config
     MEMORY_RETRIEVAL_LIMIT: int = 3
     MEMORY_RETRIEVAL_MAX_AGE_DAYS: int = 7
+    # "vector" (cosine distance only) or "hybrid" (full-text + vector, reciprocal rank fusion).
+    # Per-group override: groups.retrieval_mode
+    MEMORY_RETRIEVAL_MODE: str = "vector"
+    MEMORY_HYBRID_CANDIDATES: int = 20 # Candidates fetched per side before fusion
+    MEMORY_RRF_K: int = 60 # Reciprocal rank fusion constant
+    # Duplicate suppression before embedding (see dedup.py)
+    DEDUP_ENABLED: bool = True
+    DEDUP_WINDOW_SIZE: int = 200 # Recent stored memories remembered per chat
+    DEDUP_WINDOW_SECONDS: float = 3600.0
+    DEDUP_NEAR_MIN_TOKENS: int = 6 # Shorter messages only match exact duplicates
+    DEDUP_NEAR_MAX_DISTANCE: int = 6 # SimHash bits (of 64) that may differ for a near duplicate
+    DEDUP_MAX_CHATS: int = 10_000
+    # On a window miss, also look up exact duplicates in the database (other replicas, restarts)
+    DEDUP_CHECK_DATABASE: bool = True
+    # Local reranking: over-fetch candidates, then pick by maximal marginal relevance with time decay
+    MEMORY_RERANK_ENABLED: bool = True
+    MEMORY_RERANK_CANDIDATES: int = 20
+    MEMORY_MMR_LAMBDA: float = 0.5 # 1.0 = pure relevance, lower values favor diversity
+    MEMORY_RECENCY_WEIGHT: float = 0.2 # Share of relevance given to recency (0 disables time decay)
+    MEMORY_RECENCY_HALF_LIFE_HOURS: float = 24.0
+
+    # Short-term Conversation Buffer Config (in-process, per chat)
+    CONVERSATION_BUFFER_SIZE: int = 20 # Messages kept per chat (0 disables the buffer)
+    CONVERSATION_BUFFER_MAX_BYTES: int = 32 * 1024 * 1024 # Global cap; least recently active chats are evicted
+    CONVERSATION_PROMPT_TURNS: int = 8 # Recent messages included in each prompt
+    # Skip vector retrieval when at least this many recent messages are buffered (0 = always retrieve)
+    CONVERSATION_SKIP_RETRIEVAL_MIN_TURNS: int = 0
+
+    # Bot Identity of the primary bot (optional)
+    # When set, the API skips the getMe network call on startup.
+    # BOT_USERNAME may be given with or without the leading '@'.
+    BOT_USERNAME: Optional[str] = None
+    BOT_USER_ID: Optional[int] = None
+
+    # Deployment / Database Pool Config
+    # SERVERLESS_MODE: create the DB pool lazily on first use and skip network calls on cold start
+    SERVERLESS_MODE: bool = False
+    DB_POOL_MIN_SIZE: int = 1
+    DB_POOL_MAX_SIZE: int = 10
+    # Set when DATABASE_URL points at PgBouncer in transaction mode (disables the prepared-statement cache)
+    DB_PGBOUNCER_TRANSACTION_MODE: bool = False
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_COMMAND_TIMEOUT_SECONDS: float = 30.0
+
+    # Rate Limit Config (token buckets in front of the LLM path)
+    # Per-group overrides: groups.rate_limit_user_per_minute / groups.rate_limit_chat_per_minute
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_USER_PER_MINUTE: float = 4
+    RATE_LIMIT_USER_BURST: int = 3
+    RATE_LIMIT_CHAT_PER_MINUTE: float = 20
+    RATE_LIMIT_CHAT_BURST: int = 10
+    # Keep buckets in Postgres so limits are shared across API replicas
+    RATE_LIMIT_SHARED: bool = False
+    RATE_LIMIT_MAX_TRACKED_KEYS: int = 100_000
+    RATE_LIMIT_COOLDOWN_MESSAGE: str = "Slow down a little! I'll answer again in a moment."
+
+    # Load Shedding Config (see load_shedder.py for the degradation ladder)
+    LOAD_SHED_ENABLED: bool = True
+    LOAD_SHED_MAX_IN_FLIGHT: int = 20 # Triggered requests in flight at pressure 1.0
+    LOAD_SHED_LATENCY_TARGET_SECONDS: float = 4.0 # LLM call latency (EWMA) at pressure 1.0
+    LOAD_SHED_QUEUE_AGE_TARGET_SECONDS: float = 15.0 # Wait since the listener got the message (EWMA) at pressure 1.0
+    # Messages that waited longer (e.g. a spool backlog drained after an outage) aren't counted as
+    # queue age, and get no busy reply when shedding
+    LOAD_SHED_STALE_SECONDS: float = 300.0
+    LOAD_SHED_BUSY_NOTICE_INTERVAL_SECONDS: float = 60.0 # At most one busy reply per chat per interval
+    LOAD_SHED_THRESHOLDS: list[float] = [1.0, 1.25, 1.5, 2.0, 3.0] # Pressure at which levels 1..5 start
+    LOAD_SHED_RECOVERY_SECONDS: float = 30.0
+    LOAD_SHED_REDUCED_MAX_TOKENS: int = 60
+    LOAD_SHED_BUSY_MESSAGE: str = "I'm getting a lot of messages right now. Please try again in a minute!"
+
+    # Usage Accounting (per-chat tokens, cost and latency rollups, see usage_accounting.py)
+    USAGE_ACCOUNTING_ENABLED: bool = True
+    USAGE_FLUSH_INTERVAL_SECONDS: float = 60.0
+    USAGE_MAX_PENDING_ROWS: int = 50_000 # Rollups kept in memory while flushes keep failing
+    # USD per million tokens, [input, output]. Models missing here count tokens but no cost.
+    USAGE_PRICES_PER_MILLION_TOKENS: dict[str, list[float]] = {
+        "gpt-4.1-nano": [0.10, 0.40],
+        "gpt-4o-mini": [0.15, 0.60],
+        "gpt-4o": [2.50, 10.00],
+        "text-embedding-3-small": [0.02],
+        "text-embedding-3-large": [0.13],
+    }
+
+    # Burst Coalescing (see burst_coalescer.py): opt-in per group via groups.burst_window_seconds (/set_burst).
+    # Off in SERVERLESS_MODE, since the combined reply is sent after the webhook request returns.
+    BURST_MAX_MESSAGES: int = 15 # A burst is answered early once this many mentions are gathered
+    BURST_MAX_TOKENS: int = 350 # Output limit for a combined reply (addresses several users)
+
+    # Update Capture (gzip JSONL of incoming webhook updates for load replay, see replay_updates.py)
+    CAPTURE_UPDATES_PATH: Optional[str] = None # Capture is off unless set
+    CAPTURE_ANONYMIZE: bool = True # Hash chat/user IDs, drop names, replace usernames
+    CAPTURE_ANONYMIZE_TEXT: bool = False # Also replace message text with same-length filler
+    CAPTURE_ANONYMIZE_SALT: Optional[str] = Field(None, repr=False) # Keeps hashed IDs stable across restarts
+
+    # Redelivered Updates (see seen_updates.py): the listener retries forwards that time out
+    UPDATE_DEDUP_TTL_SECONDS: float = 900.0 # Longer than the spool's retry backoff
+    UPDATE_DEDUP_MAX_ENTRIES: int = 100_000
+
+    # Group Settings Cache (invalidated across replicas via LISTEN/NOTIFY, see group_cache.py)
+    GROUP_CACHE_ENABLED: bool = True
+    GROUP_CACHE_TTL_SECONDS: float = 3600.0 # While the invalidation listener is connected
+    GROUP_CACHE_FALLBACK_TTL_SECONDS: float = 30.0 # Without a listener (serverless, listener down)
+    GROUP_CACHE_MAX_CHATS: int = 10_000
+
+    # Persona Prompt Cache (generated /set_personality prompts, see persona_cache.py)
+    PERSONA_CACHE_ENABLED: bool = True
+    PERSONA_CACHE_MAX_ENTRIES: int = 1000 # Prompts kept in memory; all are kept in persona_prompts
+    PERSONA_CACHE_WARM_COUNT: int = 100 # Most used prompts preloaded by the warm_persona_cache job
+
+    # Scheduled Maintenance (see scheduler.py and maintenance.py; not run in serverless mode)
+    SCHEDULER_ENABLED: bool = True
+    SCHEDULER_JITTER_SECONDS: float = 30.0 # Random delay added to each run
+    SCHEDULER_JOB_TIMEOUT_SECONDS: float = 600.0 # Runs are cancelled after this long
+    # Overrides of job schedules by name: "every 10m", a cron spec in UTC ("30 3 * * *"), or "off"
+    SCHEDULER_SCHEDULES: dict[str, str] = {}
+    MEMORY_RETENTION_DAYS: Optional[int] = None # Memories older than this are pruned; None keeps them
+    USAGE_RETENTION_DAYS: Optional[int] = 180 # Hourly usage rollups older than this are pruned
     
     # Pydantic Settings Configuration
     model_config = SettingsConfigDict(
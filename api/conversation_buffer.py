@@ -0,0 +1,88 @@
+import logging
+from collections import OrderedDict, deque
+from typing import Hashable, Optional, List, Deque
+from datetime import datetime
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Rough per-record overhead (object + deque slot + timestamp) used for the memory cap
+_RECORD_OVERHEAD_BYTES = 120
+
+class BufferedMessage:
+    """A single recent chat message kept in memory."""
+    __slots__ = ("message_id", "user_id", "text", "timestamp")
+
+    def __init__(self, message_id: Optional[int], user_id: Optional[int], text: str, timestamp: datetime):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.text = text
+        self.timestamp = timestamp
+
+    def size(self) -> int:
+        return _RECORD_OVERHEAD_BYTES + len(self.text)
+
+
+class ConversationBuffer:
+    """
+    Per-chat ring buffers of the last `per_chat` messages, keyed by bot_registry.chat_key().
+
+    Chats are kept in LRU order; when the approximate total size exceeds
+    `max_bytes`, the least recently active chats are evicted whole.
+    """
+
+    def __init__(self, per_chat: int, max_bytes: int):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._chats: "OrderedDict[Hashable, Deque[BufferedMessage]]" = OrderedDict()
+        self._chat_bytes: dict = {}
+        self.total_bytes = 0
+
+    def add(self, chat_key: Hashable, message_id: Optional[int], user_id: Optional[int], text: str,
+            timestamp: Optional[datetime] = None):
+        """Appends a message to the chat's ring buffer and marks the chat most recently used."""
+        if self.per_chat <= 0:
+            return
+        record = BufferedMessage(message_id, user_id, text, timestamp or datetime.now())
+        messages = self._chats.get(chat_key)
+        if messages is None:
+            messages = self._chats[chat_key] = deque(maxlen=self.per_chat)
+            self._chat_bytes[chat_key] = 0
+        else:
+            self._chats.move_to_end(chat_key)
+
+        delta = record.size()
+        if len(messages) == messages.maxlen:
+            delta -= messages[0].size() # The oldest record is dropped by the deque
+        messages.append(record)
+        self._chat_bytes[chat_key] += delta
+        self.total_bytes += delta
+
+        while self.total_bytes > self.max_bytes and len(self._chats) > 1:
+            evicted_chat_key, _ = self._chats.popitem(last=False)
+            self.total_bytes -= self._chat_bytes.pop(evicted_chat_key)
+            logger.debug("Evicted conversation buffer for chat %s (memory cap).", evicted_chat_key)
+
+    def recent(self, chat_key: Hashable, limit: Optional[int] = None,
+               exclude_message_id: Optional[int] = None) -> List[BufferedMessage]:
+        """Returns up to `limit` most recent messages for a chat, oldest first."""
+        messages = self._chats.get(chat_key)
+        if not messages:
+            return []
+        records = [m for m in messages if exclude_message_id is None or m.message_id != exclude_message_id]
+        return records[-limit:] if limit else records
+
+    def message_ids(self, chat_key: Hashable) -> set:
+        """Returns the message IDs currently buffered for a chat."""
+        return {m.message_id for m in self._chats.get(chat_key, ()) if m.message_id is not None}
+
+    def stats(self) -> dict:
+        return {"chats": len(self._chats), "approx_bytes": self.total_bytes}
+
+
+buffer = ConversationBuffer(
+    per_chat=settings.CONVERSATION_BUFFER_SIZE if settings else 20,
+    max_bytes=settings.CONVERSATION_BUFFER_MAX_BYTES if settings else 32 * 1024 * 1024,
+)
@@ -1,14 +1,29 @@
-import asyncpg
+import asyncio
 import logging
+import math
 import os
-from typing import Optional, List
-from datetime import datetime
+import re
+from typing import Optional, List, Dict, TYPE_CHECKING
+from datetime import datetime, timedelta
 
 # Import settings
 from .config import settings
+# Import the prepared-statement data access layer
+from .repository import Repository
+# Import local reranking of retrieved memories
+from . import reranker
+# Import the per-process group settings cache
+from .group_cache import cache as group_cache
+# Import duplicate detection for the memory write path
+from . import dedup
+# Import the hosted bots (the primary bot owns memories stored before bot_id)
+from . import bot_registry
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+if TYPE_CHECKING:
+    # asyncpg is imported lazily (see _load_asyncpg) to keep serverless cold starts fast
+    import asyncpg
+
+# Logging is configured once by the entry point (see logging_setup.py)
 logger = logging.getLogger(__name__)
 
 # DATABASE_URL = os.getenv("DATABASE_URL") # Replaced by settings
@@ -16,26 +31,56 @@ logger = logging.getLogger(__name__)
 #     logger.error("DATABASE_URL environment variable not set.")
 #     # raise ValueError("DATABASE_URL environment variable not set.")
 
-# Global variable to hold the connection pool
-# It will be initialized in the main app startup
-pool: Optional[asyncpg.Pool] = None
+# Global repository (owns the connection pool) and a shortcut to its pool.
+# Initialized in the main app startup, or lazily on first use in SERVERLESS_MODE.
+repository: Optional[Repository] = None
+pool: Optional["asyncpg.Pool"] = None
+
+# bot_id of memories stored before multi-bot hosting (see schema.sql)
+LEGACY_BOT_ID = 0
+_pool_lock: Optional[asyncio.Lock] = None
+
+def _load_asyncpg():
+    """Imports asyncpg on first use and binds it to the module-level name."""
+    global asyncpg
+    import asyncpg
+    return asyncpg
+
+def _pool_kwargs() -> dict:
+    """Builds asyncpg.create_pool keyword arguments from settings."""
+    kwargs = {
+        "min_size": settings.DB_POOL_MIN_SIZE, # Minimum number of connections in the pool
+        "max_size": settings.DB_POOL_MAX_SIZE, # Maximum number of connections in the pool
+        "command_timeout": settings.DB_COMMAND_TIMEOUT_SECONDS,
+        "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+    }
+    if settings.DB_PGBOUNCER_TRANSACTION_MODE:
+        # PgBouncer in transaction mode may hand each transaction a different server
+        # connection, so named prepared statements cannot be reused across calls.
+        kwargs["statement_cache_size"] = 0
+    return kwargs
 
 async def init_db_pool():
-    """Initializes the database connection pool."""
-    global pool
+    """Initializes the repository and its database connection pool."""
+    global pool, repository
     if not settings or not settings.DATABASE_URL:
         logger.error("Cannot initialize DB pool because DATABASE_URL is not set in settings.")
         return # Or raise an error
 
     try:
+        _load_asyncpg()
         # Convert Pydantic PostgresDsn back to string for asyncpg
         db_url_str = str(settings.DATABASE_URL)
-        pool = await asyncpg.create_pool(
+        repository = Repository(
             db_url_str,
-            min_size=1, # Minimum number of connections in the pool
-            max_size=10 # Maximum number of connections in the pool
+            prepare_statements=not settings.DB_PGBOUNCER_TRANSACTION_MODE,
+            **_pool_kwargs()
         )
+        pool = await repository.open()
         logger.info("Database connection pool created successfully.")
+        if settings.SERVERLESS_MODE:
+            # Skip the test round trip; the first real query will surface connection errors
+            return
         # Optional: Test connection
         async with pool.acquire() as connection:
             val = await connection.fetchval('SELECT 1')
@@ -43,328 +88,559 @@ async def init_db_pool():
                 logger.info("Database connection test successful.")
             else:
                 logger.warning("Database connection test returned unexpected value.")
+        await check_embedding_column()
     except Exception as e:
-        logger.error(f"Failed to create database connection pool: {e}")
+        logger.error("Failed to create database connection pool: %s", e)
         pool = None # Ensure pool is None if initialization fails
+        repository = None
+
+async def get_repository() -> Optional[Repository]:
+    """
+    Returns the repository, creating it (and its pool) on first use if needed.
+    Concurrent first callers share a single initialization.
+    """
+    global _pool_lock
+    if repository:
+        return repository
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if not repository:
+            logger.info("Database pool not initialized. Creating it lazily...")
+            await init_db_pool()
+    return repository
+
+async def get_pool() -> Optional["asyncpg.Pool"]:
+    """Returns the connection pool, creating it on first use if needed."""
+    await get_repository()
+    return pool
 
 async def close_db_pool():
     """Closes the database connection pool."""
-    global pool
-    if pool:
+    global pool, repository
+    if repository:
         try:
-            await pool.close()
+            await repository.close()
             logger.info("Database connection pool closed.")
         except Exception as e:
-            logger.error(f"Error closing database connection pool: {e}")
+            logger.error("Error closing database connection pool: %s", e)
         finally:
             pool = None
+            repository = None
 
+async def check_embedding_column():
+    """Warns if chat_memories.embedding doesn't match EMBEDDING_STORAGE_TYPE / EMBEDDING_DIMENSIONS."""
+    try:
+        column_type = await repository.refresh_embedding_dimensions()
+    except Exception as e:
+        logger.warning("Could not inspect chat_memories.embedding column type: %s", e)
+        return
+    expected_type = settings.EMBEDDING_STORAGE_TYPE
+    expected = f"{expected_type}({settings.EMBEDDING_DIMENSIONS})" if settings.EMBEDDING_DIMENSIONS else expected_type
+    if column_type and not column_type.startswith(expected):
+        logger.warning("chat_memories.embedding is %s but settings expect %s. Run migrate_embeddings.py or fix the settings.", column_type, expected)
+
+def statement_stats() -> Dict[str, Dict[str, float]]:
+    """Returns per-statement timing stats from the repository (empty if not initialized)."""
+    return repository.statement_stats() if repository else {}
 
-async def get_or_create_group(chat_id: int) -> Optional[asyncpg.Record]:
+
+async def get_or_create_group(chat_id: int) -> Optional["asyncpg.Record"]:
     """
     Retrieves group details from the database by chat_id.
     If the group doesn't exist, it creates a new entry.
     Returns the group record or None if an error occurs or pool is not initialized.
     """
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return None
 
-    async with pool.acquire() as connection:
-        async with connection.transaction():
-            # Attempt to fetch the group first
-            group_record = await connection.fetchrow(
-                "SELECT chat_id, is_active, admin_ids, created_at, updated_at FROM groups WHERE chat_id = $1",
-                chat_id
-            )
+    hit, group_record = group_cache.get(chat_id, "group")
+    if hit:
+        return group_record
+    try:
+        epoch = group_cache.epoch
+        group_record = await repo.get_or_create_group(chat_id)
+        logger.debug("Group %s record: %s", chat_id, group_record)
+        if group_record:
+            group_cache.put(chat_id, "group", group_record, epoch)
+        return group_record
+    except Exception as e:
+        logger.error("Error getting or creating group %s: %s", chat_id, e)
+        return None
 
-            if group_record:
-                logger.debug(f"Group {chat_id} found in database.")
-                return group_record
-            else:
-                # Group not found, create it
-                logger.info(f"Group {chat_id} not found. Creating new entry.")
-                try:
-                    # Insert the new group with default values
-                    # admin_ids is left NULL initially
-                    new_group_record = await connection.fetchrow(
-                        """
-                        INSERT INTO groups (chat_id)
-                        VALUES ($1)
-                        RETURNING chat_id, is_active, admin_ids, created_at, updated_at
-                        """,
-                        chat_id
-                    )
-                    logger.info(f"Group {chat_id} created successfully.")
-                    return new_group_record
-                except asyncpg.UniqueViolationError:
-                    # Highly unlikely race condition: another process inserted between SELECT and INSERT
-                    logger.warning(f"Race condition: Group {chat_id} was created concurrently. Fetching again.")
-                    # Fetch the concurrently inserted record
-                    group_record = await connection.fetchrow(
-                        "SELECT chat_id, is_active, admin_ids, created_at, updated_at FROM groups WHERE chat_id = $1",
-                        chat_id
-                    )
-                    return group_record
-                except Exception as e:
-                    logger.error(f"Error creating group {chat_id}: {e}")
-                    # Re-raise the exception to potentially roll back the transaction if needed elsewhere
-                    # raise e
-                    return None
+async def get_groups(chat_ids: List[int]) -> Dict[int, "asyncpg.Record"]:
+    """Retrieves several groups in a single query. Missing groups are absent from the result."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return {}
+    try:
+        return await repo.get_groups(chat_ids)
+    except Exception as e:
+        logger.error("Error fetching groups %s: %s", chat_ids, e)
+        return {}
 
 # Example of an update function (we might need this later)
 async def set_group_activity(chat_id: int, is_active: bool) -> bool:
     """Sets the activity status for a given group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return False
 
     try:
-        async with pool.acquire() as connection:
-            result = await connection.execute(
-                "UPDATE groups SET is_active = $1 WHERE chat_id = $2",
-                is_active, chat_id
-            )
-            # result format is like 'UPDATE N' where N is rows affected
-            rows_affected = int(result.split()[-1])
-            if rows_affected > 0:
-                logger.info(f"Set group {chat_id} active status to {is_active}")
-                return True
-            else:
-                logger.warning(f"Attempted to update activity for non-existent group {chat_id}")
-                return False
+        if await repo.set_group_activity(chat_id, is_active):
+            group_cache.invalidate(chat_id) # Other replicas are notified by the statement itself
+            logger.info("Set group %s active status to %s", chat_id, is_active)
+            return True
+        else:
+            logger.warning("Attempted to update activity for non-existent group %s", chat_id)
+            return False
+    except Exception as e:
+        logger.error("Error updating group %s activity: %s", chat_id, e)
+        return False
+
+async def set_group_retrieval_mode(chat_id: int, mode: Optional[str]) -> bool:
+    """Sets the memory retrieval mode ('vector' or 'hybrid') for a group. None resets it to the default."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return False
+    try:
+        if await repo.set_group_retrieval_mode(chat_id, mode):
+            group_cache.invalidate(chat_id)
+            logger.info("Set retrieval mode for group %s to %s", chat_id, mode)
+            return True
+        else:
+            logger.warning("Attempted to set retrieval mode for non-existent group %s", chat_id)
+            return False
+    except Exception as e:
+        logger.error("Error setting retrieval mode for group %s: %s", chat_id, e)
+        return False
+
+async def set_group_model_tier(chat_id: int, tier: Optional[str]) -> bool:
+    """Pins the model tier ('fast', 'default' or 'large') for a group. None restores automatic routing."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return False
+    try:
+        if await repo.set_group_model_tier(chat_id, tier):
+            group_cache.invalidate(chat_id)
+            logger.info("Set model tier for group %s to %s", chat_id, tier)
+            return True
+        else:
+            logger.warning("Attempted to set model tier for non-existent group %s", chat_id)
+            return False
     except Exception as e:
-        logger.error(f"Error updating group {chat_id} activity: {e}")
+        logger.error("Error setting model tier for group %s: %s", chat_id, e)
+        return False
+
+async def set_group_burst_window(chat_id: int, seconds: Optional[int]) -> bool:
+    """Sets the burst coalescing window (seconds) for a group. None turns coalescing off."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return False
+    try:
+        if await repo.set_group_burst_window(chat_id, seconds):
+            group_cache.invalidate(chat_id)
+            logger.info("Set burst window for group %s to %s", chat_id, seconds)
+            return True
+        else:
+            logger.warning("Attempted to set burst window for non-existent group %s", chat_id)
+            return False
+    except Exception as e:
+        logger.error("Error setting burst window for group %s: %s", chat_id, e)
         return False
 
 async def get_group_admins(chat_id: int) -> Optional[List[int]]:
     """Retrieves the list of admin user IDs for a given group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return None
     try:
-        async with pool.acquire() as connection:
-            # Fetch only the admin_ids column
-            admin_ids = await connection.fetchval(
-                "SELECT admin_ids FROM groups WHERE chat_id = $1",
-                chat_id
-            )
-            # fetchval returns None if the record doesn't exist or admin_ids is NULL
-            # It returns a list directly if the column type is an array (like BIGINT[])
-            logger.debug(f"Fetched admin_ids for chat {chat_id}: {admin_ids}")
-            return admin_ids # This will be None or a list[int]
+        hit, admin_ids = group_cache.get(chat_id, "admins")
+        if hit:
+            return admin_ids
+        epoch = group_cache.epoch
+        # Returns None if the record doesn't exist or admin_ids is NULL, otherwise a list[int]
+        admin_ids = await repo.get_group_admins(chat_id)
+        logger.debug("Fetched admin_ids for chat %s: %s", chat_id, admin_ids)
+        group_cache.put(chat_id, "admins", admin_ids, epoch)
+        return admin_ids
     except Exception as e:
-        logger.error(f"Error fetching admin IDs for group {chat_id}: {e}")
+        logger.error("Error fetching admin IDs for group %s: %s", chat_id, e)
         return None
 
 async def set_group_personality(chat_id: int, personality_prompt: str) -> bool:
     """Sets the personality prompt for a given group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return False
 
     try:
-        async with pool.acquire() as connection:
-            result = await connection.execute(
-                "UPDATE groups SET personality_prompt = $1 WHERE chat_id = $2",
-                personality_prompt, chat_id
-            )
-            # result format is like 'UPDATE N' where N is rows affected
-            rows_affected = int(result.split()[-1])
-            if rows_affected > 0:
-                logger.info(f"Set personality for group {chat_id}")
-                return True
-            else:
-                # This case means the group didn't exist in the table.
-                # get_or_create_group should have been called first, but handle defensively.
-                logger.warning(f"Attempted to set personality for non-existent group {chat_id}")
-                return False
+        if await repo.set_group_personality(chat_id, personality_prompt):
+            group_cache.invalidate(chat_id)
+            logger.info("Set personality for group %s", chat_id)
+            return True
+        else:
+            # This case means the group didn't exist in the table.
+            # get_or_create_group should have been called first, but handle defensively.
+            logger.warning("Attempted to set personality for non-existent group %s", chat_id)
+            return False
     except Exception as e:
-        logger.error(f"Error setting personality for group {chat_id}: {e}")
+        logger.error("Error setting personality for group %s: %s", chat_id, e)
         return False
 
 async def get_group_personality(chat_id: int) -> Optional[str]:
     """Retrieves the currently set personality prompt for a given group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return None
     try:
-        async with pool.acquire() as connection:
-            # Fetch the personality_prompt column
-            # fetchval returns the value of the first column of the first row, or None
-            personality = await connection.fetchval(
-                "SELECT personality_prompt FROM groups WHERE chat_id = $1",
-                chat_id
-            )
-            if personality is not None:
-                 logger.debug(f"Fetched personality for chat {chat_id}: {personality[:50]}...")
-            else:
-                 # This can happen if the group exists but prompt is NULL, or if group doesn't exist
-                 logger.debug(f"No personality prompt found for chat {chat_id} (might be NULL or group non-existent).")
-            return personality # Returns the string or None
+        hit, personality = group_cache.get(chat_id, "personality")
+        if hit:
+            return personality
+        epoch = group_cache.epoch
+        personality = await repo.get_group_personality(chat_id)
+        group_cache.put(chat_id, "personality", personality, epoch)
+        if personality is not None:
+             logger.debug("Fetched personality for chat %s: %.50s...", chat_id, personality)
+        else:
+             # This can happen if the group exists but prompt is NULL, or if group doesn't exist
+             logger.debug("No personality prompt found for chat %s (might be NULL or group non-existent).", chat_id)
+        return personality # Returns the string or None
     except Exception as e:
-        logger.error(f"Error fetching personality for group {chat_id}: {e}")
+        logger.error("Error fetching personality for group %s: %s", chat_id, e)
         return None
 
+def _fit_embedding(repo: Repository, embedding: List[float]) -> Optional[List[float]]:
+    """
+    Fits an embedding to the live chat_memories.embedding column (EMBEDDING_DIMENSIONS until it has
+    been read). Longer text-embedding-3 vectors are shortened like the API's `dimensions` parameter
+    does (truncate, then re-normalize), so replicas keep working right after migrate_embeddings.py
+    swaps in a smaller column. Returns None if the embedding can't fit.
+    """
+    dimensions = repo.embedding_dimensions or settings.EMBEDDING_DIMENSIONS
+    if not dimensions or len(embedding) == dimensions:
+        return embedding
+    if len(embedding) < dimensions:
+        return None
+    shortened = embedding[:dimensions]
+    norm = math.sqrt(sum(x * x for x in shortened)) or 1.0
+    return [x / norm for x in shortened]
+
 async def add_chat_memory(
+    bot_id: int,
     chat_id: int,
     message_id: int,
     user_id: int,
     message_text: str,
     message_timestamp: datetime,
-    embedding: List[float]
+    embedding: List[float],
+    embedding_model: Optional[str] = None
 ) -> bool:
-    """Adds a message and its embedding to the chat_memories table."""
-    if not pool:
+    """Adds a message and its embedding (tagged with the model that produced it) to a bot's memories."""
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized. Cannot add memory.")
         return False
 
     if not embedding:
-        logger.error(f"Attempted to add memory for msg {message_id} in chat {chat_id} with empty embedding.")
+        logger.error("Attempted to add memory for msg %s in chat %s with empty embedding.", message_id, chat_id)
         return False
-        
+    fitted = _fit_embedding(repo, embedding)
+    if fitted is None:
+        logger.error("Embedding for msg %s in chat %s has %s dimensions, expected %s.", message_id, chat_id, len(embedding), repo.embedding_dimensions or settings.EMBEDDING_DIMENSIONS)
+        return False
+    embedding = fitted
+
     try:
-        async with pool.acquire() as connection:
-            await connection.execute(
-                """
-                INSERT INTO chat_memories 
-                    (chat_id, message_id, user_id, message_text, message_timestamp, embedding)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                ON CONFLICT (chat_id, message_id) DO NOTHING; -- Ignore if message already exists
-                """,
-                chat_id,
-                message_id,
-                user_id,
-                message_text,
-                message_timestamp,
-                embedding # asyncpg handles list[float] conversion to vector
-            )
-            logger.info(f"Successfully added/ignored memory for msg {message_id} in chat {chat_id}.")
-            return True
+        fingerprint = dedup.Fingerprint(message_text)
+        # Duplicate (bot_id, chat_id, message_id) rows are ignored by ON CONFLICT DO NOTHING
+        memory_id = await repo.add_chat_memory(
+            bot_id, chat_id, message_id, user_id, message_text, message_timestamp, embedding,
+            embedding_model or settings.EMBEDDING_MODEL, fingerprint.text_hash, fingerprint.simhash
+        )
+        if memory_id is not None:
+            dedup.window.remember((bot_id, chat_id), memory_id, fingerprint)
+        logger.info("Successfully added/ignored memory for msg %s in chat %s.", message_id, chat_id)
+        return True
     except asyncpg.exceptions.UndefinedFunctionError as e:
          # This likely means the vector extension isn't properly enabled/installed
-         logger.error(f"Database error adding chat memory: Vector function undefined. Is pgvector enabled? Details: {e}")
+         logger.error("Database error adding chat memory: Vector function undefined. Is pgvector enabled? Details: %s", e)
          return False
     except Exception as e:
-        logger.error(f"Unexpected error adding chat memory for msg {message_id} in chat {chat_id}: {e}")
+        logger.error("Unexpected error adding chat memory for msg %s in chat %s: %s", message_id, chat_id, e)
         return False
 
+def memory_bot_ids(bot_id: int) -> List[int]:
+    """The bot_id values whose memories a bot reads. Rows stored before multi-bot hosting (bot_id 0) belong to the primary bot."""
+    primary = bot_registry.registry.primary
+    if primary and bot_id == primary.user_id:
+        return [bot_id, LEGACY_BOT_ID]
+    return [bot_id]
+
+async def absorb_duplicate_memory(bot_id: int, chat_id: int, message_text: str, message_timestamp: datetime) -> Optional[List[float]]:
+    """
+    Checks whether `message_text` repeats (exactly or nearly) a recently stored memory of the bot in the chat.
+    If so, counts it on that row instead of storing a new one and returns the stored embedding,
+    so the caller can skip the embedding call. Returns None when the message is not a duplicate
+    (or on error), in which case the caller embeds and stores it as usual.
+    """
+    if not settings.DEDUP_ENABLED or not message_text:
+        return None
+    repo = await get_repository()
+    if not repo:
+        return None
+    fingerprint = dedup.Fingerprint(message_text)
+    try:
+        memory_id = dedup.window.match((bot_id, chat_id), fingerprint)
+        if memory_id is None and settings.DEDUP_CHECK_DATABASE:
+            since = message_timestamp - timedelta(seconds=settings.DEDUP_WINDOW_SECONDS)
+            memory_id = await repo.find_duplicate_memory(memory_bot_ids(bot_id), chat_id, fingerprint.text_hash, since)
+            if memory_id is not None:
+                dedup.window.remember((bot_id, chat_id), memory_id, fingerprint)
+        if memory_id is None:
+            return None
+        embedding = await repo.record_duplicate_memory(memory_id, message_timestamp)
+        if embedding is None:
+            return None # Row deleted since; store this message normally
+        logger.info("Message in chat %s duplicates memory %s; counted instead of stored.", chat_id, memory_id)
+        return list(embedding)
+    except Exception as e:
+        logger.error("Error checking for duplicate memory in chat %s: %s", chat_id, e)
+        return None
+
+def collapse_duplicate_memories(memories: List["asyncpg.Record"], query_text: Optional[str] = None) -> List["asyncpg.Record"]:
+    """
+    Keeps the best-ranked row per normalized-text hash and drops rows whose text is the query itself.
+    Rows stored before fingerprinting (NULL text_hash) are kept as-is.
+    """
+    query_hash = dedup.Fingerprint(query_text).text_hash if query_text else None
+    seen = set()
+    result = []
+    for memory in memories:
+        text_hash = memory.get("text_hash")
+        if text_hash is not None:
+            if text_hash == query_hash or text_hash in seen:
+                continue
+            seen.add(text_hash)
+        result.append(memory)
+    return result
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+
+_TSQUERY_TOKEN_RE = re.compile(r"\w{2,}")
+
+def build_tsquery(text: str, exclude_terms: Optional[List[str]] = None, max_terms: int = 32) -> Optional[str]:
+    """
+    Builds an OR-ed to_tsquery('simple', ...) string from the word tokens in `text`.
+    Tokens are plain \\w runs, so they can't inject tsquery operators. Returns None if no tokens remain.
+    """
+    excluded = {term.lower().lstrip("@$") for term in (exclude_terms or [])}
+    terms = []
+    for token in _TSQUERY_TOKEN_RE.findall(text.lower()):
+        if token not in excluded and token not in terms:
+            terms.append(token)
+            if len(terms) >= max_terms:
+                break
+    return " | ".join(terms) if terms else None
+
 async def find_relevant_memories(
+    bot_id: int,
     chat_id: int, 
     query_embedding: List[float], 
     limit: int = 3,
-    max_age_days: Optional[int] = 7 # Default to only considering memories from last 7 days
-) -> List[asyncpg.Record]:
-    """Finds relevant chat memories using vector similarity search.
+    max_age_days: Optional[int] = 7, # Default to only considering memories from last 7 days
+    mode: str = "vector",
+    query_text: Optional[str] = None,
+    exclude_terms: Optional[List[str]] = None
+) -> List["asyncpg.Record"]:
+    """Finds relevant memories of a bot in a chat using vector similarity search.
     Optionally filters memories by age.
+
+    mode="hybrid" also runs a full-text search over `query_text` in the same round trip and
+    merges both rankings with reciprocal rank fusion, so exact tokens (tickers, wallet
+    addresses, usernames) are found even when their embeddings aren't close.
+
+    When MEMORY_RERANK_ENABLED is set, MEMORY_RERANK_CANDIDATES rows are fetched and reranked
+    locally for diversity (MMR) and recency before the top `limit` are returned.
+    Repeated texts are collapsed to one row, and copies of `query_text` itself are dropped.
     """
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized. Cannot find memories.")
         return []
     
     if not query_embedding:
-        logger.error(f"Attempted to find memories in chat {chat_id} with empty query embedding.")
+        logger.error("Attempted to find memories in chat %s with empty query embedding.", chat_id)
         return []
+    fitted = _fit_embedding(repo, query_embedding)
+    if fitted is None:
+        logger.error("Query embedding for chat %s has %s dimensions, expected %s.", chat_id, len(query_embedding), repo.embedding_dimensions or settings.EMBEDDING_DIMENSIONS)
+        return []
+    query_embedding = fitted
+
+    # With reranking enabled, over-fetch candidates (with their vectors) and pick the final set locally
+    rerank = settings.MEMORY_RERANK_ENABLED
+    # Without it, fetch a few extra rows to make up for collapsed duplicates
+    fetch_limit = max(limit, settings.MEMORY_RERANK_CANDIDATES) if rerank else limit * 2
 
     try:
-        async with pool.acquire() as connection:
-            # Base query + parameters
-            sql_query = """
-                SELECT memory_id, message_text, user_id, message_timestamp 
-                FROM chat_memories 
-                WHERE chat_id = $1 
-            """
-            params = [chat_id]
-            param_index = 2 # Start index for next parameters
-
-            # Add time-based filtering if requested
-            if max_age_days is not None and max_age_days > 0:
-                 sql_query += f" AND message_timestamp >= NOW() - INTERVAL '${param_index} day' "
-                 params.append(max_age_days)
-                 param_index += 1
-                 logger.debug(f"Filtering memories to last {max_age_days} days.")
-
-            # Add vector search condition
-            sql_query += f" ORDER BY embedding <=> ${param_index} " # Cosine distance
-            params.append(query_embedding)
-            param_index += 1
-
-            # Add limit
-            sql_query += f" LIMIT ${param_index}; "
-            params.append(limit)
-
-            logger.debug(f"Executing memory search query: {sql_query} with params: {params[:1] + ['<embedding>'] + params[2:]}")
-
-            memories = await connection.fetch(sql_query, *params)
-            
-            logger.info(f"Retrieved {len(memories)} relevant memories for chat {chat_id} (limit {limit}, max_age {max_age_days} days).")
-            return memories
+        if mode == "hybrid" and query_text:
+            memories = await repo.find_relevant_memories_hybrid(
+                memory_bot_ids(bot_id), chat_id, query_embedding, build_tsquery(query_text, exclude_terms), fetch_limit, max_age_days,
+                candidates=max(fetch_limit, settings.MEMORY_HYBRID_CANDIDATES), rrf_k=settings.MEMORY_RRF_K,
+                with_vectors=rerank
+            )
+        else:
+            memories = await repo.find_relevant_memories(
+                memory_bot_ids(bot_id), chat_id, query_embedding, fetch_limit, max_age_days, with_vectors=rerank
+            )
+        memories = collapse_duplicate_memories(memories, query_text)
+        if rerank:
+            memories = reranker.rerank_memories(query_embedding, memories, limit)
+        else:
+            memories = memories[:limit]
+        logger.info("Retrieved %s relevant memories for chat %s (mode %s, limit %s, max_age %s days).", len(memories), chat_id, mode, limit, max_age_days)
+        return memories
     except asyncpg.exceptions.UndefinedFunctionError as e:
-         logger.error(f"Database error finding memories: Vector operator/function undefined. Is pgvector enabled? Details: {e}")
+         logger.error("Database error finding memories: Vector operator/function undefined. Is pgvector enabled? Details: %s", e)
          return []
     except Exception as e:
-        logger.error(f"Unexpected error finding relevant memories for chat {chat_id}: {e}")
-        return [] 
+        logger.error("Unexpected error finding relevant memories for chat %s: %s", chat_id, e)
+        return []
+
+async def get_memories_by_ids(memory_ids: List[int]) -> List["asyncpg.Record"]:
+    """Fetches several memory rows by memory_id in a single query."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized. Cannot fetch memories.")
+        return []
+    try:
+        return await repo.get_memories_by_ids(memory_ids)
+    except Exception as e:
+        logger.error("Unexpected error fetching memories %s: %s", memory_ids[:10], e)
+        return []
 
 async def add_group_admin(chat_id: int, user_id_to_add: int) -> bool:
     """Adds a user ID to the admin_ids array for a group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return False
     try:
-        async with pool.acquire() as connection:
-            # Use COALESCE to handle NULL admin_ids, append if not already present
-            result = await connection.execute(
-                """ 
-                UPDATE groups 
-                SET admin_ids = array_append(COALESCE(admin_ids, ARRAY[]::BIGINT[]), $1) 
-                WHERE chat_id = $2 AND (admin_ids IS NULL OR NOT admin_ids @> ARRAY[$1]::BIGINT[]);
-                """,
-                user_id_to_add,
-                chat_id
-            )
-            rows_affected = int(result.split()[-1])
-            if rows_affected > 0:
-                logger.info(f"Added user {user_id_to_add} to admins for chat {chat_id}.")
-                return True
+        # Appends only if not already present (COALESCE handles NULL admin_ids)
+        if await repo.add_group_admin(chat_id, user_id_to_add):
+            group_cache.invalidate(chat_id)
+            logger.info("Added user %s to admins for chat %s.", user_id_to_add, chat_id)
+            return True
+        else:
+            # Could mean group doesn't exist OR user was already an admin
+            # Check if user is already admin to confirm
+            current_admins = await get_group_admins(chat_id)
+            if current_admins and user_id_to_add in current_admins:
+                 logger.info("User %s was already an admin for chat %s. No change needed.", user_id_to_add, chat_id)
+                 return True # Indicate success as the user is an admin
             else:
-                # Could mean group doesn't exist OR user was already an admin
-                # Check if user is already admin to confirm
-                current_admins = await get_group_admins(chat_id)
-                if current_admins and user_id_to_add in current_admins:
-                     logger.info(f"User {user_id_to_add} was already an admin for chat {chat_id}. No change needed.")
-                     return True # Indicate success as the user is an admin
-                else:
-                     logger.warning(f"Failed to add admin {user_id_to_add} for chat {chat_id}. Group not found or user already exists?")
-                     return False
+                 logger.warning("Failed to add admin %s for chat %s. Group not found or user already exists?", user_id_to_add, chat_id)
+                 return False
     except Exception as e:
-        logger.error(f"Error adding admin {user_id_to_add} for chat {chat_id}: {e}")
+        logger.error("Error adding admin %s for chat %s: %s", user_id_to_add, chat_id, e)
         return False
 
 async def remove_group_admin(chat_id: int, user_id_to_remove: int) -> bool:
     """Removes a user ID from the admin_ids array for a group."""
-    if not pool:
+    repo = await get_repository()
+    if not repo:
         logger.error("Database pool is not initialized.")
         return False
     try:
-        async with pool.acquire() as connection:
-            # Use array_remove. This works even if admin_ids is NULL or user is not present.
-            result = await connection.execute(
-                """
-                UPDATE groups 
-                SET admin_ids = array_remove(admin_ids, $1) 
-                WHERE chat_id = $2;
-                """,
-                user_id_to_remove,
-                chat_id
-            )
-            rows_affected = int(result.split()[-1]) # Will be 1 if group exists, 0 otherwise
-            if rows_affected > 0:
-                 logger.info(f"Removed user {user_id_to_remove} from admins for chat {chat_id} (if they were present)." )
-                 return True
-            else:
-                 logger.warning(f"Attempted to remove admin {user_id_to_remove} for non-existent group {chat_id}.")
-                 return False # Group likely didn't exist
+        # array_remove works even if admin_ids is NULL or user is not present.
+        if await repo.remove_group_admin(chat_id, user_id_to_remove):
+             group_cache.invalidate(chat_id)
+             logger.info("Removed user %s from admins for chat %s (if they were present).", user_id_to_remove, chat_id )
+             return True
+        else:
+             logger.warning("Attempted to remove admin %s for non-existent group %s.", user_id_to_remove, chat_id)
+             return False # Group likely didn't exist
     except Exception as e:
-        logger.error(f"Error removing admin {user_id_to_remove} for chat {chat_id}: {e}")
-        return False
\ No newline at end of file
+        logger.error("Error removing admin %s for chat %s: %s", user_id_to_remove, chat_id, e)
+        return False
+
+
+async def consume_rate_limit_token(bucket_key: str, capacity: float, refill_per_second: float) -> Optional[bool]:
+    """
+    Takes one token from a shared Postgres-backed bucket.
+    Returns True/False for allowed/throttled, or None if the database is unavailable.
+    """
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return None
+    try:
+        return await repo.consume_rate_limit_token(bucket_key, capacity, refill_per_second)
+    except Exception as e:
+        logger.error("Error consuming shared rate limit token for %s: %s", bucket_key, e)
+        return None
+
+
+async def get_bot_identity(bot_user_id: int) -> Optional[str]:
+    """Retrieves the cached username (with '@') for a bot user ID, or None if not cached."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return None
+    try:
+        username = await repo.get_bot_identity(bot_user_id)
+        logger.debug("Fetched cached bot identity for %s: %s", bot_user_id, username)
+        return username
+    except Exception as e:
+        logger.error("Error fetching cached bot identity for %s: %s", bot_user_id, e)
+        return None
+
+async def save_bot_identity(bot_user_id: int, username: str) -> bool:
+    """Caches the bot's username so later cold starts can skip the getMe call."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return False
+    try:
+        await repo.save_bot_identity(bot_user_id, username)
+        logger.info("Cached bot identity %s (%s).", username, bot_user_id)
+        return True
+    except Exception as e:
+        logger.error("Error caching bot identity for %s: %s", bot_user_id, e)
+        return False
+
+async def get_persona_prompt(description_key: str, model: str) -> Optional[str]:
+    """Retrieves a previously generated persona prompt for a normalized description and model."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return None
+    try:
+        return await repo.get_persona_prompt(description_key, model)
+    except Exception as e:
+        logger.error("Error fetching cached persona prompt for '%.50s': %s", description_key, e)
+        return None
+
+async def save_persona_prompt(description_key: str, model: str, prompt: str) -> bool:
+    """Stores a generated persona prompt so other groups (and replicas) can reuse it."""
+    repo = await get_repository()
+    if not repo:
+        logger.error("Database pool is not initialized.")
+        return False
+    try:
+        await repo.save_persona_prompt(description_key, model, prompt)
+        return True
+    except Exception as e:
+        logger.error("Error caching persona prompt for '%.50s': %s", description_key, e)
+        return False
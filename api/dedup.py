@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from typing import Hashable, Optional, Deque
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+_URL_RE = re.compile(r"https?://\S+")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+_MENTION_RE = re.compile(r"@\w+")
+_MASK_64 = (1 << 64) - 1
+
+def normalize(text: str) -> str:
+    """Case-folds, unifies Unicode look-alikes and drops punctuation/emoji, so trivial variations hash the same."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _URL_RE.sub(lambda m: m.group(0).split("?")[0], text) # Tracking query strings vary per paste
+    return _NON_WORD_RE.sub(" ", text).strip()
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+def _signed(value: int) -> int:
+    """Maps an unsigned 64-bit value into BIGINT range."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def simhash(tokens: list[str]) -> int:
+    """64-bit SimHash over word bigrams (single words for one-word texts)."""
+    features = [" ".join(pair) for pair in zip(tokens, tokens[1:])] or tokens
+    weights = [0] * 64
+    for feature in features:
+        h = _hash64(feature)
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & _MASK_64).count("1")
+
+
+class Fingerprint:
+    """Exact and near-duplicate keys for a message. Both fit BIGINT columns."""
+    __slots__ = ("text_hash", "simhash", "tokens")
+
+    def __init__(self, text: str):
+        normalized = normalize(text)
+        tokens = normalized.split()
+        self.tokens = len(tokens)
+        if not normalize(_MENTION_RE.sub(" ", text)):
+            # Only mentions, punctuation and emoji: normalized, "@bot 🚀" and "@bot 🔥" would be equal,
+            # so these hash their case-folded text as-is and only dedup exactly
+            self.text_hash = _signed(_hash64(" ".join(unicodedata.normalize("NFKC", text).casefold().split())))
+            self.simhash = None
+            return
+        self.text_hash = _signed(_hash64(normalized))
+        # SimHash is too noisy on a few words; short texts only dedup exactly
+        min_tokens = settings.DEDUP_NEAR_MIN_TOKENS if settings else 6
+        self.simhash = _signed(simhash(tokens)) if self.tokens >= min_tokens else None
+
+
+class _WindowEntry:
+    __slots__ = ("memory_id", "text_hash", "simhash", "seen_at")
+
+    def __init__(self, memory_id: int, fingerprint: Fingerprint, seen_at: float):
+        self.memory_id = memory_id
+        self.text_hash = fingerprint.text_hash
+        self.simhash = fingerprint.simhash
+        self.seen_at = seen_at
+
+
+class DedupWindow:
+    """
+    Per-chat sliding window of recently stored memories' fingerprints, keyed by (bot_id, chat_id).
+
+    A message matches an entry if its normalized text hash is equal (exact duplicate) or
+    its SimHash is within `max_distance` bits (near duplicate). Windows hold at most
+    `per_chat` entries no older than `max_age_seconds`; chats are evicted in LRU order.
+    """
+
+    def __init__(self, per_chat: int, max_age_seconds: float, max_distance: int, max_chats: int):
+        self.per_chat = per_chat
+        self.max_age_seconds = max_age_seconds
+        self.max_distance = max_distance
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[Hashable, Deque[_WindowEntry]]" = OrderedDict()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def match(self, chat_key: Hashable, fingerprint: Fingerprint) -> Optional[int]:
+        """Returns the memory_id of a stored duplicate of `fingerprint`, or None."""
+        entries = self._chats.get(chat_key)
+        if not entries:
+            self.misses += 1
+            return None
+        cutoff = time.monotonic() - self.max_age_seconds
+        while entries and entries[0].seen_at < cutoff:
+            entries.popleft()
+        # Newest first: the most recent copy is the likeliest match
+        for entry in reversed(entries):
+            if entry.text_hash == fingerprint.text_hash:
+                self.exact_hits += 1
+                return entry.memory_id
+        if fingerprint.simhash is not None:
+            for entry in reversed(entries):
+                if entry.simhash is not None and hamming(entry.simhash, fingerprint.simhash) <= self.max_distance:
+                    self.near_hits += 1
+                    return entry.memory_id
+        self.misses += 1
+        return None
+
+    def remember(self, chat_key: Hashable, memory_id: int, fingerprint: Fingerprint):
+        if self.per_chat <= 0:
+            return
+        entries = self._chats.get(chat_key)
+        if entries is None:
+            entries = self._chats[chat_key] = deque(maxlen=self.per_chat)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_key)
+        entries.append(_WindowEntry(memory_id, fingerprint, time.monotonic()))
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+        }
+
+
+window = DedupWindow(
+    per_chat=settings.DEDUP_WINDOW_SIZE if settings else 200,
+    max_age_seconds=settings.DEDUP_WINDOW_SECONDS if settings else 3600.0,
+    max_distance=settings.DEDUP_NEAR_MAX_DISTANCE if settings else 6,
+    max_chats=settings.DEDUP_MAX_CHATS if settings else 10_000,
+)
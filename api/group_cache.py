@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+# Import settings
+from .config import settings
+# Channel the groups table trigger NOTIFYs on (see schema.sql)
+from .repository import GROUP_INVALIDATION_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# How often an idle LISTEN connection is probed, so half-open TCP connections are noticed
+_KEEPALIVE_SECONDS = 30.0
+_MAX_RECONNECT_DELAY_SECONDS = 30.0
+
+
+class GroupCache:
+    """
+    Per-process cache of group settings (group row, admins, personality), keyed by chat.
+
+    Entries are served for GROUP_CACHE_TTL_SECONDS while the invalidation listener is
+    connected, and only GROUP_CACHE_FALLBACK_TTL_SECONDS otherwise (serverless mode, listener
+    down), since changes made by other replicas can't be seen then. The TTL is applied at
+    read time, so it shortens as soon as the listener disconnects. Chats are evicted in LRU order
+    beyond `max_chats`.
+    """
+
+    def __init__(self, max_chats: int):
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, dict]" = OrderedDict()
+        # Bumped by every invalidation; a read that started before one must not be cached
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _ttl(self) -> float:
+        return settings.GROUP_CACHE_TTL_SECONDS if listener.connected else settings.GROUP_CACHE_FALLBACK_TTL_SECONDS
+
+    def get(self, chat_id: int, field: str) -> tuple[bool, Any]:
+        """Returns (hit, value). A cached None is a hit."""
+        if not settings or not settings.GROUP_CACHE_ENABLED:
+            return False, None
+        entries = self._chats.get(chat_id)
+        entry = entries.get(field) if entries else None
+        if entry is None or time.monotonic() - entry[1] > self._ttl():
+            self.misses += 1
+            return False, None
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, chat_id: int, field: str, value: Any, epoch: int):
+        """Caches a value read while the cache was at `epoch` (skipped if an invalidation happened since)."""
+        if not settings or not settings.GROUP_CACHE_ENABLED or epoch != self.epoch:
+            return
+        entries = self._chats.get(chat_id)
+        if entries is None:
+            entries = self._chats[chat_id] = {}
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        entries[field] = (value, time.monotonic())
+
+    def invalidate(self, chat_id: int):
+        self.epoch += 1
+        self.invalidations += 1
+        self._chats.pop(chat_id, None)
+
+    def clear(self):
+        self.epoch += 1
+        self._chats.clear()
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._chats),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "listener_connected": listener.connected,
+            "listener_reconnects": listener.reconnects,
+            "ttl_seconds": self._ttl() if settings else None,
+        }
+
+
+class InvalidationListener:
+    """
+    Holds a dedicated connection that LISTENs on GROUP_INVALIDATION_CHANNEL and drops the
+    notified chat from the cache. Reconnects with exponential backoff; after every
+    (re)connect the whole cache is cleared, since notifications sent while disconnected are lost.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self.reconnects = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, dsn: str):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(dsn))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str):
+        try:
+            chat_id = int(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed cache invalidation payload: %r", payload)
+            return
+        logger.debug("Invalidating cached settings for chat %s (notified by backend %s).", chat_id, pid)
+        cache.invalidate(chat_id)
+
+    async def _run(self, dsn: str):
+        import asyncpg
+        delay = 1.0
+        while True:
+            connection = None
+            try:
+                # No statement cache: this connection only runs LISTEN and keepalives
+                connection = await asyncpg.connect(dsn, statement_cache_size=0)
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _connection: lost.set())
+                await connection.add_listener(GROUP_INVALIDATION_CHANNEL, self._on_notification)
+                cache.clear()
+                self.connected = True
+                delay = 1.0
+                logger.info("Listening for group cache invalidations on '%s'.", GROUP_INVALIDATION_CHANNEL)
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), timeout=_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        await connection.fetchval("SELECT 1", timeout=10)
+                logger.warning("Cache invalidation listener connection lost.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Cache invalidation listener error: %s", e)
+            finally:
+                self.connected = False
+                if connection is not None and not connection.is_closed():
+                    try:
+                        await connection.close(timeout=5)
+                    except Exception:
+                        connection.terminate()
+            self.reconnects += 1
+            logger.info("Reconnecting cache invalidation listener in %.0fs.", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _MAX_RECONNECT_DELAY_SECONDS)
+
+
+cache = GroupCache(max_chats=settings.GROUP_CACHE_MAX_CHATS if settings else 10_000)
+listener = InvalidationListener()
+
+def start_listener():
+    """Starts the LISTEN connection (from the app lifespan). Skipped when it can't work."""
+    if not settings or not settings.GROUP_CACHE_ENABLED:
+        return
+    dsn = settings.DATABASE_LISTEN_URL or settings.DATABASE_URL
+    if settings.DB_PGBOUNCER_TRANSACTION_MODE and not settings.DATABASE_LISTEN_URL:
+        # LISTEN needs a session-level connection, which transaction pooling doesn't provide
+        logger.warning("DB_PGBOUNCER_TRANSACTION_MODE is set without DATABASE_LISTEN_URL; "
+                       "group cache invalidation is disabled and the fallback TTL applies.")
+        return
+    listener.start(str(dsn))
+
+async def stop_listener():
+    await listener.stop()
@@ -1,28 +1,70 @@
 # Placeholder for FastAPI application logic
 # This will run as a Vercel Serverless Function
 
+import hmac
+import time
+# Recorded before the remaining imports so cold-start time includes module loading
+_PROCESS_IMPORT_START = time.perf_counter()
+
+import asyncio
 import logging
 from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel # For request body validation
-from typing import Any, Dict # For flexible Update structure
+from fastapi.responses import JSONResponse
+from typing import Any
 from contextlib import asynccontextmanager # For lifespan management
 from datetime import datetime # Added for timestamp conversion
 import os
 
+# Import process-wide logging configuration
+from . import logging_setup
 # Import database utility functions
-import database # Adjusted import for api/ structure
+from . import database # Adjusted import for api/ structure
 # Import LLM service functions
-import llm_service # Added import for LLM
+from . import llm_service # Added import for LLM
 # Import Telegram utility functions
-import telegram_utils # Added import for sending messages
+from . import telegram_utils # Added import for sending messages
+# Import rate limiter
+from . import rate_limiter
+# Import short-term conversation buffer
+from . import conversation_buffer
+# Import overload controller
+from . import load_shedder
+# Import per-request model routing
+from . import model_router
+# Import group settings cache (and its invalidation listener)
+from . import group_cache
+# Import update capture for load replay
+from . import update_capture
+# Import memory duplicate detection
+from . import dedup
+# Import lean Telegram update structs (msgspec)
+from . import telegram_types
+# Import burst coalescing of mentions
+from . import burst_coalescer
+# Import per-chat usage accounting
+from . import usage_accounting
+# Import the registry of hosted bots
+from . import bot_registry
+# Import dedup of redelivered updates
+from . import seen_updates
+# Import the persona prompt cache
+from . import persona_cache
+# Import the scheduler of periodic maintenance jobs
+from . import scheduler
 # Import settings
 from .config import settings
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging once for the process: JSON records, written off the event loop
+logging_setup.configure_logging(
+    level=settings.LOG_LEVEL if settings else "INFO",
+    json_format=(settings.LOG_FORMAT if settings else "json") == "json",
+    sample_rates=settings.LOG_SAMPLE_RATES if settings else None
+)
 
 logger = logging.getLogger(__name__)
 
+_IMPORTS_DONE = time.perf_counter()
+
 # --- Configuration --- 
 # Now handled by config.py, remove direct os.getenv calls here
 # try:
@@ -37,86 +79,480 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Code to run on startup
-    logger.info("Application startup: Initializing database pool...")
-    await database.init_db_pool()
-    logger.info("Fetching bot info (username and ID)...")
-    # Fetch and cache the bot info on startup
-    await telegram_utils.fetch_bot_info()
-    if not telegram_utils.BOT_USERNAME or not telegram_utils.BOT_USER_ID:
-        logger.error("CRITICAL: Failed to fetch bot username or ID on startup. Triggering logic might be impaired.")
-        # Decide if the app should fail to start or continue with degraded functionality
+    startup_start = time.perf_counter()
+    if settings and settings.SERVERLESS_MODE:
+        # Serverless: no DB or network I/O on cold start. The pool is created on first
+        # DB use and each bot's username is resolved (config -> DB cache -> getMe) on its first trigger check.
+        logger.info("Application startup (serverless mode): deferring database pool creation.")
+    else:
+        logger.info("Application startup: Initializing database pool...")
+        await database.init_db_pool()
+        logger.info("Resolving bot info (username and ID) for %s bots...", len(bot_registry.registry))
+        # Resolve and cache the bot info on startup
+        if not await telegram_utils.ensure_all_bot_info():
+            logger.error("CRITICAL: Failed to fetch the username or ID of some bots on startup. Triggering logic might be impaired.")
+            # Decide if the app should fail to start or continue with degraded functionality
+        # Long-lived LISTEN connection that keeps the group settings cache coherent across replicas
+        group_cache.start_listener()
+        # Periodic maintenance jobs (needs a long-lived process, so not in serverless mode)
+        scheduler.start()
+    # Periodic bulk flush of per-chat usage rollups
+    usage_accounting.start_flusher()
+    if settings and settings.CAPTURE_UPDATES_PATH:
+        app.state.update_capture = update_capture.open_capture(
+            settings.CAPTURE_UPDATES_PATH, settings.CAPTURE_ANONYMIZE, settings.CAPTURE_ANONYMIZE_SALT,
+            keep_usernames=tuple(bot.username for bot in bot_registry.registry if bot.username),
+            keep_ids=tuple(bot.user_id for bot in bot_registry.registry),
+            anonymize_text=settings.CAPTURE_ANONYMIZE_TEXT
+        )
+    startup_done = time.perf_counter()
+    app.state.cold_start = {
+        "imports_ms": round((_IMPORTS_DONE - _PROCESS_IMPORT_START) * 1000, 1),
+        "startup_ms": round((startup_done - startup_start) * 1000, 1),
+        "total_ms": round((startup_done - _PROCESS_IMPORT_START) * 1000, 1),
+    }
+    logger.info("Cold start complete: %s", app.state.cold_start)
     yield # The application runs while yielding
     # Code to run on shutdown
+    if _burst_tasks:
+        # Let open bursts be answered before the clients and pool go away
+        await asyncio.wait(_burst_tasks, timeout=30)
+    await scheduler.stop()
+    await group_cache.stop_listener()
+    await usage_accounting.stop_flusher()
+    if getattr(app.state, "update_capture", None):
+        app.state.update_capture.close()
+    await telegram_utils.close_client()
     logger.info("Application shutdown: Closing database pool...")
     await database.close_db_pool()
 
-app = FastAPI(lifespan=lifespan)
 
-# Pydantic model for the incoming Telegram Update
-# We use Dict[str, Any] for flexibility as the Update structure is complex
-# and aiogram's models aren't directly used here.
-class TelegramUpdate(BaseModel):
-    update_id: int
-    message: Dict[str, Any] | None = None
-    edited_message: Dict[str, Any] | None = None
-    channel_post: Dict[str, Any] | None = None
-    edited_channel_post: Dict[str, Any] | None = None
-    # Add other potential update types as needed (inline_query, chosen_inline_result, etc.)
-    # Use Dict[str, Any] or more specific Pydantic models if needed
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that serializes with msgspec instead of json.dumps."""
+
+    def render(self, content: Any) -> bytes:
+        return telegram_types.encode(content)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 
 @app.get("/api/hello")
 async def hello():
     return {"message": "Hello from FastAPI - Bot API Endpoint"}
 
+@app.get("/api/startup")
+async def startup_info(request: Request):
+    """Reports how long this instance's cold start took."""
+    return {"serverless_mode": bool(settings and settings.SERVERLESS_MODE),
+            "cold_start": getattr(request.app.state, "cold_start", None)}
+
+@app.get("/api/metrics")
+async def metrics():
+    """Exposes in-process performance counters."""
+    return {"statements": database.statement_stats(),
+            "conversation_buffer": conversation_buffer.buffer.stats(),
+            "load_shedding": load_shedder.shedder.stats(),
+            "model_routing": model_router.stats(),
+            "group_cache": group_cache.cache.stats(),
+            "dedup": dedup.window.stats(),
+            "bursts": burst_coalescer.coalescer.stats(),
+            "usage_accounting": usage_accounting.stats(),
+            "bots": bot_registry.registry.stats(),
+            "redelivered_updates": seen_updates.seen.stats(),
+            "persona_cache": persona_cache.cache.stats()}
+
+def _require_admin(request: Request):
+    """Checks the X-Admin-Token header against ADMIN_API_TOKEN. Admin endpoints don't exist without a token."""
+    token = settings.ADMIN_API_TOKEN if settings else None
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/api/admin/usage")
+async def admin_usage(request: Request, sort: str = "cost", hours: float = 24.0, limit: int = 20):
+    """Top chats over the last `hours` by cost or p95 reply latency (sort=cost|p95)."""
+    _require_admin(request)
+    if sort not in ("cost", "p95"):
+        raise HTTPException(status_code=400, detail="sort must be 'cost' or 'p95'")
+    await usage_accounting.flush(force=True) # Include this instance's unflushed requests
+    chats = await usage_accounting.top_chats(hours, sort, max(1, min(limit, 200)))
+    return {"sort": sort, "hours": hours, "chats": chats}
+
+@app.get("/api/admin/jobs")
+async def admin_jobs(request: Request):
+    """Scheduled maintenance jobs: schedule, next run, last run, duration and failures."""
+    _require_admin(request)
+    return await scheduler.scheduler.status()
+
+def _speaker(user_id) -> str:
+    """Labels a message author for the prompt."""
+    bot = bot_registry.current()
+    if bot and user_id == bot.user_id:
+        return "You (the bot)"
+    return f"User {user_id}"
+
+def default_persona() -> str:
+    """Persona for groups without a custom one: the current bot's, else DEFAULT_PERSONA."""
+    bot = bot_registry.current()
+    return (bot.persona if bot else None) or settings.DEFAULT_PERSONA
+
+def build_llm_messages(persona_prompt: str, relevant_memories, recent_messages, message_text: str) -> list[dict[str, str]]:
+    """Builds the chat completion messages: persona, retrieved memories, recent turns, then the user message."""
+    max_len = 150
+    llm_messages = [{"role": "system", "content": persona_prompt}]
+    if relevant_memories:
+        context_header = "Relevant past messages (most relevant first):\n---"
+        llm_messages.append({"role": "system", "content": context_header})
+        for memory in relevant_memories:
+             mem_ts_str = memory['message_timestamp'].strftime("%Y-%m-%d %H:%M")
+             mem_text = memory['message_text']
+             if len(mem_text) > max_len: mem_text = mem_text[:max_len] + "..."
+             formatted_mem = f"{_speaker(memory['user_id'])} previously said at {mem_ts_str}: {mem_text}"
+             llm_messages.append({"role": "system", "content": formatted_mem})
+        llm_messages.append({"role": "system", "content": "---"})
+    if recent_messages:
+        lines = []
+        for recent in recent_messages:
+            text = recent.text if len(recent.text) <= max_len else recent.text[:max_len] + "..."
+            lines.append(f"{_speaker(recent.user_id)}: {text}")
+        llm_messages.append({"role": "system", "content": "Recent conversation (oldest first):\n" + "\n".join(lines)})
+    if relevant_memories or recent_messages:
+        llm_messages.append({"role": "system", "content": "Respond to the current user message:"})
+    llm_messages.append({"role": "user", "content": message_text})
+    return llm_messages
+
+async def remember_incoming(chat_id: int, messages: list[burst_coalescer.TriggeredMessage]) -> list[list[float] | None]:
+    """
+    Stores triggered messages as memories and returns their embeddings (None where unavailable).
+    Duplicates of stored messages reuse the stored embedding; the rest are embedded in one call.
+    """
+    bot_id = bot_registry.current().user_id
+    embeddings: list[list[float] | None] = [None] * len(messages)
+    to_embed = []
+    for i, message in enumerate(messages):
+        if not (message.message_id and message.sender_user_id and message.date):
+            logger.warning("Missing data for memory storage: msg_id=%s, sender=%s, ts=%s", message.message_id, message.sender_user_id, message.date)
+            continue
+        try:
+            # Repeats of a stored message reuse its embedding and are only counted, not stored
+            embeddings[i] = await database.absorb_duplicate_memory(bot_id, chat_id, message.text, datetime.fromtimestamp(message.date))
+        except Exception as e:
+            logger.error("Error checking message %s for duplicates: %s", message.message_id, e)
+        if embeddings[i]:
+            usage_accounting.record_cache_hit()
+            logger.debug("Message %s is a duplicate; skipped embedding and storage.", message.message_id)
+        else:
+            to_embed.append(i)
+    if not to_embed:
+        return embeddings
+
+    try:
+        logger.debug("Generating embeddings for %s messages...", len(to_embed))
+        if len(to_embed) == 1:
+            generated = [await llm_service.get_embedding(text=messages[to_embed[0]].text)]
+        else:
+            generated = await llm_service.get_embeddings([messages[i].text for i in to_embed]) or [None] * len(to_embed)
+        for i, embedding in zip(to_embed, generated):
+            message = messages[i]
+            if not embedding:
+                logger.warning("Could not generate embedding for message %s.", message.message_id)
+                continue
+            embeddings[i] = embedding
+            logger.debug("Storing message %s and embedding to memory.", message.message_id)
+            await database.add_chat_memory(
+                bot_id=bot_id, chat_id=chat_id, message_id=message.message_id, user_id=message.sender_user_id,
+                message_text=message.text, message_timestamp=datetime.fromtimestamp(message.date), embedding=embedding
+            )
+    except Exception as e:
+        logger.error("Error processing incoming messages for memory: %s", e)
+    return embeddings
+
+async def retrieve_memories(chat_id: int, group_record, embedding, query_text: str, recent_messages,
+                            bot_username: str | None, shed_level: int) -> list:
+    """Finds relevant memories for the prompt, unless the recent turns or load shedding make retrieval unnecessary."""
+    skip_retrieval = (settings.CONVERSATION_SKIP_RETRIEVAL_MIN_TURNS > 0
+                      and len(recent_messages) >= settings.CONVERSATION_SKIP_RETRIEVAL_MIN_TURNS)
+    if skip_retrieval:
+        logger.debug("Skipping memory retrieval: %s recent turns available.", len(recent_messages))
+        return []
+    if shed_level >= load_shedder.LEVEL_SKIP_RETRIEVAL:
+        logger.debug("Skipping memory retrieval (load shedding level %s).", shed_level)
+        return []
+    if not embedding:
+        logger.warning("Skipping memory retrieval because query embedding is missing.")
+        return []
+    logger.debug("Finding relevant memories...")
+    retrieval_mode = group_record.get('retrieval_mode') or settings.MEMORY_RETRIEVAL_MODE
+    with usage_accounting.timed("retrieval"):
+        relevant_memories = await database.find_relevant_memories(
+            bot_id=bot_registry.current().user_id, chat_id=chat_id, query_embedding=embedding,
+            limit=settings.MEMORY_RETRIEVAL_LIMIT, 
+            max_age_days=settings.MEMORY_RETRIEVAL_MAX_AGE_DAYS,
+            mode=retrieval_mode, query_text=query_text,
+            exclude_terms=[bot_username] if bot_username else None
+        )
+    logger.info("Found %s relevant memories (limit=%s, max_age=%s days).", len(relevant_memories), settings.MEMORY_RETRIEVAL_LIMIT, settings.MEMORY_RETRIEVAL_MAX_AGE_DAYS)
+    # Drop memories that are already in the recent turns
+    buffered_ids = conversation_buffer.buffer.message_ids(bot_registry.chat_key(chat_id))
+    return [m for m in relevant_memories if m['message_id'] not in buffered_ids]
+
+async def send_and_store_reply(chat_id: int, bot_response_text: str | None, shed_level: int,
+                               reply_to_message_id: int | None = None):
+    """Sends the generated reply and stores it in the buffer and (unless shedding load) in memory."""
+    if bot_response_text:
+        with usage_accounting.timed("send"):
+            send_result = await telegram_utils.send_telegram_message(
+                chat_id=chat_id, text=bot_response_text, reply_to_message_id=reply_to_message_id
+            )
+        if send_result.get("success"):
+            bot_msg_id = send_result.get("message_id")
+            bot_user_id_to_store = bot_registry.current().user_id
+            conversation_buffer.buffer.add(bot_registry.chat_key(chat_id), bot_msg_id, bot_user_id_to_store, bot_response_text)
+            if shed_level >= load_shedder.LEVEL_SKIP_REPLY_STORAGE:
+                logger.debug("Not storing bot response (load shedding level %s).", shed_level)
+            elif bot_msg_id and bot_user_id_to_store:
+                bot_msg_dt = datetime.now()
+                logger.debug("Storing bot response (msg_id: %s) to memory...", bot_msg_id)                    
+                bot_embedding = await llm_service.get_embedding(text=bot_response_text)
+                if bot_embedding:
+                     await database.add_chat_memory(
+                         bot_id=bot_user_id_to_store, chat_id=chat_id, message_id=bot_msg_id, user_id=bot_user_id_to_store,
+                         message_text=bot_response_text, message_timestamp=bot_msg_dt, embedding=bot_embedding
+                     )
+                     logger.info("Stored bot response (msg_id: %s) to memory.", bot_msg_id)
+                else: logger.warning("Could not generate embedding for bot response.")
+            else: logger.warning("Could not store bot response: Missing bot msg ID or user ID.")
+        else: # Failed to send
+            logger.error("Failed to send bot response message to chat %s.", chat_id)
+    else: # Failed to generate
+        logger.error("LLM failed to generate response for chat %s.", chat_id)
+        await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, error generating response.")
+
+async def generate_reply(llm_messages: list[dict[str, str]], group_record, shed_level: int,
+                         max_tokens: int | None = None, model: str | None = None) -> str | None:
+    """Calls the LLM (routed unless `model` is given), degraded (model/length) according to `shed_level`."""
+    if shed_level >= load_shedder.LEVEL_FAST_MODEL:
+        model = settings.LLM_FAST_MODEL
+    if shed_level >= load_shedder.LEVEL_REDUCED_TOKENS:
+        max_tokens = settings.LOAD_SHED_REDUCED_MAX_TOKENS
+    llm_start = time.perf_counter()
+    bot_response_text = await llm_service.generate_chat_response(
+        messages=llm_messages, model=model, max_tokens=max_tokens, group_tier=group_record.get('model_tier')
+    )
+    load_shedder.shedder.observe_latency(time.perf_counter() - llm_start)
+    if not bot_response_text:
+        usage_accounting.record_error()
+    return bot_response_text
+
+async def respond_to_trigger(
+    chat_id: int,
+    group_record,
+    message: burst_coalescer.TriggeredMessage,
+    bot_username: str | None,
+    shed_level: int = load_shedder.LEVEL_NORMAL
+) -> dict:
+    """Runs the RAG reply pipeline for a triggered message, degraded according to `shed_level`."""
+    # Get Persona
+    persona_prompt = await database.get_group_personality(chat_id) or default_persona()
+    logger.debug("Using persona: %.50s...", persona_prompt)
+
+    # Embed/Store Incoming Message
+    embedding = (await remember_incoming(chat_id, [message]))[0]
+
+    # Recent turns from the in-memory buffer (zero DB cost)
+    recent_messages = conversation_buffer.buffer.recent(
+        bot_registry.chat_key(chat_id), limit=settings.CONVERSATION_PROMPT_TURNS, exclude_message_id=message.message_id
+    )
+
+    # Retrieve Memories
+    relevant_memories = await retrieve_memories(
+        chat_id, group_record, embedding, message.text, recent_messages, bot_username, shed_level
+    )
+
+    # Build Prompt
+    llm_messages = build_llm_messages(persona_prompt, relevant_memories, recent_messages, message.text)
+    logger.debug("Constructed LLM messages (RAG): Count=%s", len(llm_messages))
+
+    # Call LLM, then Send Response & Store Bot Message
+    bot_response_text = await generate_reply(llm_messages, group_record, shed_level)
+    await send_and_store_reply(chat_id, bot_response_text, shed_level)
+    return {"status": "ok"}
+
+def build_burst_message(burst: list[burst_coalescer.TriggeredMessage]) -> str:
+    """Combines a burst of mentions into one user message asking for a single reply to everyone."""
+    lines = [f"{message.speaker}: {message.text}" for message in burst]
+    return ("Several people mentioned you at almost the same time. Answer all of them in one message: "
+            "address each person by name exactly as written before their message, and answer "
+            "similar questions together.\n\n" + "\n".join(lines))
+
+async def respond_to_burst(
+    chat_id: int,
+    group_record,
+    burst: list[burst_coalescer.TriggeredMessage],
+    bot_username: str | None,
+    shed_level: int = load_shedder.LEVEL_NORMAL
+) -> dict:
+    """Answers a burst of triggered messages with one LLM call and one reply (to the latest message)."""
+    persona_prompt = await database.get_group_personality(chat_id) or default_persona()
+
+    # One embedding request for the whole burst
+    embeddings = [e for e in await remember_incoming(chat_id, burst) if e]
+
+    burst_ids = {message.message_id for message in burst}
+    recent_messages = [
+        m for m in conversation_buffer.buffer.recent(bot_registry.chat_key(chat_id), limit=settings.CONVERSATION_PROMPT_TURNS + len(burst))
+        if m.message_id not in burst_ids
+    ][-settings.CONVERSATION_PROMPT_TURNS:] if settings.CONVERSATION_PROMPT_TURNS > 0 else []
+
+    # One search for the whole burst, from the centroid of its embeddings (cosine ignores length)
+    query_embedding = [sum(values) / len(embeddings) for values in zip(*embeddings)] if embeddings else None
+    relevant_memories = await retrieve_memories(
+        chat_id, group_record, query_embedding, " ".join(message.text for message in burst),
+        recent_messages, bot_username, shed_level
+    )
+
+    llm_messages = build_llm_messages(persona_prompt, relevant_memories, recent_messages, build_burst_message(burst))
+    # Routed on the member messages: the combined prompt would always look like one long message
+    model = None
+    if settings.LLM_ROUTING_ENABLED:
+        model = model_router.route(
+            llm_messages, group_record.get('model_tier'), burst_texts=[message.text for message in burst]
+        ).model
+    bot_response_text = await generate_reply(
+        llm_messages, group_record, shed_level, max_tokens=settings.BURST_MAX_TOKENS, model=model
+    )
+    await send_and_store_reply(chat_id, bot_response_text, shed_level, reply_to_message_id=burst[-1].message_id)
+    return {"status": "ok", "detail": f"Burst reply ({len(burst)} messages)"}
+
+# Burst replies run after the leader's webhook request has returned; referenced here until done
+_burst_tasks: set[asyncio.Task] = set()
+
+async def answer_burst(
+    chat_id: int,
+    group_record,
+    burst: "burst_coalescer._Burst",
+    window_seconds: float,
+    bot_username: str | None
+):
+    """Waits out a burst opened by this request's message and answers it. Runs as a background task."""
+    usage_accounting.start(bot_registry.chat_key(chat_id)) # Accounted separately from the webhook request, which has finished
+    try:
+        messages = await burst_coalescer.coalescer.collect(bot_registry.chat_key(chat_id), burst, window_seconds)
+        shed_level = load_shedder.shedder.update() # Load may have changed during the window
+        if shed_level >= load_shedder.LEVEL_BUSY_REPLY:
+            if load_shedder.shedder.busy_notice_due(bot_registry.chat_key(chat_id)):
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text=settings.LOAD_SHED_BUSY_MESSAGE)
+            return
+        with load_shedder.shedder.track(), usage_accounting.timed("total"):
+            if len(messages) > 1:
+                await respond_to_burst(
+                    chat_id=chat_id, group_record=group_record, burst=messages,
+                    bot_username=bot_username, shed_level=shed_level
+                )
+            else:
+                await respond_to_trigger(
+                    chat_id=chat_id, group_record=group_record, message=messages[0],
+                    bot_username=bot_username, shed_level=shed_level
+                )
+    except Exception as e:
+        usage_accounting.record_error()
+        logger.error("Failed to answer burst in chat %s: %s", chat_id, e)
+    finally:
+        usage_accounting.finish()
+
 @app.post("/api/webhook")
-async def telegram_webhook(update: TelegramUpdate):
-    """Handles incoming updates forwarded from the listener."""
-    logger.info(f"Received update via webhook: {update.update_id}")
+async def telegram_webhook(request: Request):
+    """Handles incoming updates for the primary bot (TELEGRAM_BOT_TOKEN), forwarded from the listener."""
+    return await process_webhook(request, bot_registry.registry.primary)
+
+@app.post("/api/webhook/{bot_key}")
+async def bot_webhook(bot_key: str, request: Request):
+    """Handles incoming updates for the hosted bot whose webhook key (bot_registry.webhook_key) is `bot_key`."""
+    return await process_webhook(request, bot_registry.registry.get(bot_key))
+
+async def process_webhook(request: Request, bot: bot_registry.Bot | None):
+    if bot is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    bot_registry.use(bot)
+    logging_setup.bind(bot_id=bot.user_id)
+    # Decode the raw body straight into lean structs; unused Telegram fields are skipped
+    body = await request.body()
+    try:
+        update = telegram_types.decode_update(body)
+    except telegram_types.DecodeError as e:
+        logger.warning("Rejected malformed update: %s", e)
+        return FastJSONResponse({"status": "error", "detail": f"Invalid update: {e}"}, status_code=422)
+    # The listener delivers at least once; a redelivery is acked without storing or replying again
+    update_key = (bot.user_id, update.update_id)
+    if not seen_updates.seen.claim(update_key):
+        logger.info("Ignoring redelivered update %s.", update.update_id)
+        return {"status": "ok", "detail": "Duplicate update ignored"}
+    capture = getattr(request.app.state, "update_capture", None)
+    if capture:
+        capture.write(telegram_types.decode_raw(body))
+    try:
+        received_at = float(request.headers.get("X-Received-At", ""))
+    except ValueError:
+        received_at = None
+    try:
+        return await handle_update(update, received_at)
+    except Exception:
+        seen_updates.seen.release(update_key) # Let the retry handle it
+        raise
+    finally:
+        usage_accounting.finish()
+
+async def handle_update(update: telegram_types.Update, received_at: float | None = None) -> dict:
+    """Handles one update. `received_at` is when the listener got it from Telegram (unix time), if known."""
+    logging_setup.bind(update_id=update.update_id)
+    logger.info("Received update via webhook: %s", update.update_id)
 
     # 1. Handle non-message updates early
     if update.edited_message:
-        chat_id = update.edited_message.get('chat', {}).get('id', 'N/A')
-        msg_id = update.edited_message.get('message_id', 'N/A')
-        logger.info(f"Received edited message {msg_id} in chat {chat_id}. Ignoring.")
+        logger.info("Received edited message %s in chat %s. Ignoring.",
+                    update.edited_message.message_id, update.edited_message.chat.id)
         return {"status": "ok", "detail": "Edited message ignored"}
     if update.channel_post:
-        logger.info(f"Received channel post {update.channel_post.get('message_id', 'N/A')}. Ignoring.")
+        logger.info("Received channel post %s. Ignoring.", update.channel_post.message_id)
         return {"status": "ok", "detail": "Channel post ignored"}
     if not update.message:
-        logger.info(f"Received non-message update type. Ignoring.")
+        logger.info("Received non-message update type. Ignoring.")
         return {"status": "ok", "detail": "Unsupported update type ignored"}
 
     # 2. Process the message
     message_data = update.message
-    chat_id = message_data.get('chat', {}).get('id')
-    message_text = message_data.get('text') # Can be None
+    chat_id = message_data.chat.id
+    message_text = message_data.text # Can be None
+    logging_setup.bind(chat_id=chat_id)
+    usage_accounting.start(bot_registry.chat_key(chat_id))
 
     # 3. Validate essential data
     if not chat_id:
-        logger.error(f"Could not extract chat ID from message. Update: {update.model_dump_json(exclude_none=True)}")
+        logger.error("Could not extract chat ID from message %s.", message_data.message_id)
         return {"status": "error", "detail": "Missing chat ID"}
 
     # 4. Ensure group exists in DB
     group_record = await database.get_or_create_group(chat_id)
     if not group_record:
-        logger.error(f"Failed to get or create group {chat_id}. Skipping.")
+        logger.error("Failed to get or create group %s. Skipping.", chat_id)
         return {"status": "error", "detail": "Database group operation failed"}
     # Optional: Check if group is active: if not group_record['is_active']: return {"status": "ok", "detail": "Bot inactive in group"}
 
     # 5. Handle non-text messages
     if not message_text:
-        logger.info(f"Received non-text message in chat {chat_id}. Ignoring.")
+        logger.info("Received non-text message in chat %s. Ignoring.", chat_id)
         return {"status": "ok", "detail": "Non-text message ignored"}
     # --- End Task 5.5 Handling ---
 
-    logger.info(f"Processing text message in Chat ID: {chat_id} - Message: {message_text[:50]}...")
-    sender_user_id = message_data.get('from', {}).get('id')
+    logger.info("Processing text message in Chat ID: %s - Message: %.50s...", chat_id, message_text)
+    sender_user_id = message_data.sender.id if message_data.sender else None
 
     # 6. Handle Commands
     if message_text.startswith('/'):
         command = message_text.split()[0]
-        logger.debug(f"Detected command: {command}")
+        logger.debug("Detected command: %s", command)
 
         # === /start ===
         if command == '/start':
@@ -132,9 +568,13 @@ Available commands:
 /help - Show this help message
 /set_personality <description> - Set my personality (admins only)
 /get_personality - View my current personality
+/personas - List ready-made personalities (instant with /set_personality)
 /add_admin <user_id> - Add a bot admin (admins only)
 /remove_admin <user_id> - Remove a bot admin (admins only)
 /list_admins - List current bot admins (admins only)
+/set_retrieval <vector|hybrid> - Set how I search past messages (admins only)
+/set_model <auto|fast|default|large> - Set which model answers in this group (admins only)
+/set_burst <off|seconds> - Answer mentions arriving within a few seconds with one reply (admins only)
             """
             await telegram_utils.send_telegram_message(chat_id=chat_id, text=help_text)
             return {"status": "ok", "detail": "Command processed"}
@@ -148,7 +588,7 @@ Available commands:
             new_prompt_desc = command_parts[1].strip()
 
             if not sender_user_id: 
-                logger.error(f"Could not identify sender for /set_personality in chat {chat_id}")
+                logger.error("Could not identify sender for /set_personality in chat %s", chat_id)
                 return {"status": "error", "detail": "Could not identify sender"}
 
             current_admins = await database.get_group_admins(chat_id)
@@ -156,8 +596,8 @@ Available commands:
                 await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, only admins can set the personality.")
                 return {"status": "ok", "detail": "Unauthorized"}
 
-            logger.info(f"Generating persona prompt for chat {chat_id}...")
-            generated_prompt = await llm_service.generate_persona_prompt(user_description=new_prompt_desc)
+            logger.info("Generating persona prompt for chat %s...", chat_id)
+            generated_prompt = await persona_cache.cache.get_prompt(new_prompt_desc)
             if not generated_prompt:
                 await telegram_utils.send_telegram_message(chat_id=chat_id, text="Error: Could not generate personality prompt.")
                 # Return ok because the command was handled, even if unsuccessfully
@@ -180,6 +620,12 @@ Available commands:
                 await telegram_utils.send_telegram_message(chat_id=chat_id, text="No custom personality set.")
             return {"status": "ok", "detail": "Command processed"}
 
+        # === /personas ===
+        elif command == '/personas':
+            names = "\n".join(f"- {name}" for name in persona_cache.library_names())
+            await telegram_utils.send_telegram_message(chat_id=chat_id, text=f"Ready-made personalities:\n{names}\n\nUse /set_personality <name> to pick one.")
+            return {"status": "ok", "detail": "Command processed"}
+
         # === /add_admin ===
         elif command == '/add_admin':
             logger.info("Processing /add_admin command")
@@ -193,7 +639,7 @@ Available commands:
                  return {"status": "ok", "detail": "Invalid user ID"}
 
             if not sender_user_id: 
-                logger.error(f"Could not identify sender for /add_admin in chat {chat_id}")
+                logger.error("Could not identify sender for /add_admin in chat %s", chat_id)
                 return {"status": "error", "detail": "Could not identify sender"}
 
             current_admins = await database.get_group_admins(chat_id)
@@ -226,7 +672,7 @@ Available commands:
                  return {"status": "ok", "detail": "Invalid user ID"}
 
             if not sender_user_id: 
-                logger.error(f"Could not identify sender for /remove_admin in chat {chat_id}")
+                logger.error("Could not identify sender for /remove_admin in chat %s", chat_id)
                 return {"status": "error", "detail": "Could not identify sender"}
 
             current_admins = await database.get_group_admins(chat_id)
@@ -245,7 +691,7 @@ Available commands:
         elif command == '/list_admins':
             logger.info("Processing /list_admins command")
             if not sender_user_id: 
-                 logger.error(f"Could not identify sender for /list_admins in chat {chat_id}")
+                 logger.error("Could not identify sender for /list_admins in chat %s", chat_id)
                  return {"status": "error", "detail": "Could not identify sender"}
                  
             current_admins = await database.get_group_admins(chat_id)
@@ -258,9 +704,72 @@ Available commands:
             await telegram_utils.send_telegram_message(chat_id=chat_id, text=f"Current Admins:\n{admin_list_str}")
             return {"status": "ok", "detail": "Command processed"}
 
+        # === /set_retrieval ===
+        elif command == '/set_retrieval':
+            logger.info("Processing /set_retrieval command")
+            command_parts = message_text.split(maxsplit=1)
+            mode = command_parts[1].strip().lower() if len(command_parts) > 1 else ""
+            if mode not in database.RETRIEVAL_MODES:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Usage: /set_retrieval <vector|hybrid>")
+                return {"status": "ok", "detail": "Invalid retrieval mode"}
+
+            current_admins = await database.get_group_admins(chat_id)
+            if not current_admins or sender_user_id not in current_admins:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, only admins can change retrieval mode.")
+                return {"status": "ok", "detail": "Unauthorized"}
+
+            success = await database.set_group_retrieval_mode(chat_id, mode)
+            await telegram_utils.send_telegram_message(chat_id=chat_id, text=f"Retrieval mode set to {mode}." if success else "Error: Could not save retrieval mode.")
+            return {"status": "ok", "detail": "Command processed"}
+
+        # === /set_model ===
+        elif command == '/set_model':
+            logger.info("Processing /set_model command")
+            command_parts = message_text.split(maxsplit=1)
+            tier = command_parts[1].strip().lower() if len(command_parts) > 1 else ""
+            if tier != "auto" and tier not in model_router.TIERS:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Usage: /set_model <auto|fast|default|large>")
+                return {"status": "ok", "detail": "Invalid model tier"}
+
+            current_admins = await database.get_group_admins(chat_id)
+            if not current_admins or sender_user_id not in current_admins:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, only admins can change the model.")
+                return {"status": "ok", "detail": "Unauthorized"}
+
+            success = await database.set_group_model_tier(chat_id, None if tier == "auto" else tier)
+            await telegram_utils.send_telegram_message(chat_id=chat_id, text=f"Model set to {tier}." if success else "Error: Could not save model setting.")
+            return {"status": "ok", "detail": "Command processed"}
+
+        # === /set_burst ===
+        elif command == '/set_burst':
+            logger.info("Processing /set_burst command")
+            if settings.SERVERLESS_MODE:
+                # The reply is sent after the request returns, which a frozen instance never does
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Burst replies aren't available on this deployment.")
+                return {"status": "ok", "detail": "Burst replies unavailable"}
+            command_parts = message_text.split(maxsplit=1)
+            value = command_parts[1].strip().lower() if len(command_parts) > 1 else ""
+            seconds = None
+            if value != "off":
+                try: seconds = int(value)
+                except ValueError: seconds = 0
+                if not 1 <= seconds <= 60:
+                    await telegram_utils.send_telegram_message(chat_id=chat_id, text="Usage: /set_burst <off|1-60 seconds>")
+                    return {"status": "ok", "detail": "Invalid burst window"}
+
+            current_admins = await database.get_group_admins(chat_id)
+            if not current_admins or sender_user_id not in current_admins:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, only admins can change burst replies.")
+                return {"status": "ok", "detail": "Unauthorized"}
+
+            success = await database.set_group_burst_window(chat_id, seconds)
+            reply = (f"Mentions within {seconds}s will get one combined reply." if seconds else "Burst replies turned off.")
+            await telegram_utils.send_telegram_message(chat_id=chat_id, text=reply if success else "Error: Could not save burst setting.")
+            return {"status": "ok", "detail": "Command processed"}
+
         # === Unrecognized Command ===
         else:
-            logger.info(f"Received unrecognized command: {command}")
+            logger.info("Received unrecognized command: %s", command)
             await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, I don't recognize that command. Use /help.")
             return {"status": "ok", "detail": "Unrecognized command"}
 
@@ -268,112 +777,81 @@ Available commands:
     else:
         logger.debug("Processing as non-command message")
 
+        # Record every text message in the short-term buffer (cheap, no I/O), triggered or not
+        message_id = message_data.message_id
+        message_dt_unix = message_data.date
+        conversation_buffer.buffer.add(
+            bot_registry.chat_key(chat_id), message_id, sender_user_id, message_text,
+            datetime.fromtimestamp(message_dt_unix) if message_dt_unix else None
+        )
+
         # Trigger Check
-        # Use settings if available, otherwise None
-        bot_username = telegram_utils.BOT_USERNAME # Still relies on global cache from fetch_bot_info
-        bot_user_id = telegram_utils.BOT_USER_ID   # Still relies on global cache from fetch_bot_info
+        bot = bot_registry.current()
+        if not bot.username:
+            await telegram_utils.ensure_bot_info(bot) # Lazy resolution in serverless mode
+        bot_username = bot.username # Cached on the bot by ensure_bot_info
+        bot_user_id = bot.user_id   # Known from the token
         
         is_mention = bot_username and bot_username in message_text
         is_reply_to_bot = False
-        reply_info = message_data.get('reply_to_message')
-        if reply_info and bot_user_id and reply_info.get('from', {}).get('id') == bot_user_id:
+        reply_info = message_data.reply_to_message
+        if reply_info and bot_user_id and reply_info.sender and reply_info.sender.id == bot_user_id:
             is_reply_to_bot = True
 
         if not (is_mention or is_reply_to_bot):
-            logger.debug(f"Ignoring message in chat {chat_id} (Not mention or reply to bot).")
+            logger.debug("Ignoring message in chat %s (Not mention or reply to bot).", chat_id)
             return {"status": "ok", "detail": "Message ignored (no trigger)"}
 
         # Triggered: Proceed with RAG
-        logger.info(f"Bot trigger detected (Mention: {is_mention}, Reply: {is_reply_to_bot}). Proceeding...")
-
-        # Get Persona
-        persona_prompt = await database.get_group_personality(chat_id) or settings.DEFAULT_PERSONA
-        logger.debug(f"Using persona: {persona_prompt[:50]}...")
-
-        # Embed/Store Incoming Message
-        embedding = None
-        message_id = message_data.get('message_id')
-        message_dt_unix = message_data.get('date')
-        if message_id and sender_user_id and message_dt_unix:
-            try:
-                message_dt = datetime.fromtimestamp(message_dt_unix)
-                logger.debug(f"Generating embedding for message {message_id}...")
-                embedding = await llm_service.get_embedding(text=message_text)
-                if embedding:
-                    logger.debug(f"Storing message {message_id} and embedding to memory.")
-                    await database.add_chat_memory(
-                        chat_id=chat_id, message_id=message_id, user_id=sender_user_id,
-                        message_text=message_text, message_timestamp=message_dt, embedding=embedding
-                    )
-                else: logger.warning(f"Could not generate embedding for message {message_id}.")
-            except Exception as e:
-                 logger.error(f"Error processing incoming message for memory: {e}")
-                 embedding = None # Ensure embedding is None if error
-        else:
-             logger.warning(f"Missing data for memory storage: msg_id={message_id}, sender={sender_user_id}, ts={message_dt_unix}")
-
-        # Retrieve Memories
-        relevant_memories = []
-        if embedding:
-            logger.debug(f"Finding relevant memories...")
-            relevant_memories = await database.find_relevant_memories(
-                chat_id=chat_id, query_embedding=embedding,
-                limit=settings.MEMORY_RETRIEVAL_LIMIT, 
-                max_age_days=settings.MEMORY_RETRIEVAL_MAX_AGE_DAYS
+        logger.info("Bot trigger detected (Mention: %s, Reply: %s). Proceeding...", is_mention, is_reply_to_bot)
+
+        # Rate limit before any embedding/LLM work
+        allowed, send_notice = await rate_limiter.check_rate_limit(bot_registry.chat_key(chat_id), sender_user_id, group_record)
+        if not allowed:
+            if send_notice:
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text=settings.RATE_LIMIT_COOLDOWN_MESSAGE)
+            return {"status": "ok", "detail": "Rate limited"}
+
+        # Load shedding: queue age is how long the message waited since the listener received it
+        # (since Telegram's date if the listener didn't say). Messages from a backlog drained after an
+        # outage are stale rather than a sign of load, so they don't count and get no busy reply.
+        queued_since = received_at or message_dt_unix
+        queue_age = time.time() - queued_since if queued_since else 0.0
+        stale = queue_age > settings.LOAD_SHED_STALE_SECONDS
+        if queued_since and not stale:
+            load_shedder.shedder.observe_queue_age(queue_age)
+        shed_level = load_shedder.shedder.update()
+        if shed_level >= load_shedder.LEVEL_BUSY_REPLY:
+            if not stale and load_shedder.shedder.busy_notice_due(bot_registry.chat_key(chat_id)):
+                await telegram_utils.send_telegram_message(chat_id=chat_id, text=settings.LOAD_SHED_BUSY_MESSAGE)
+            return {"status": "ok", "detail": "Busy (load shedding)"}
+
+        sender = message_data.sender
+        triggered = burst_coalescer.TriggeredMessage(
+            message_id, sender_user_id,
+            (f"@{sender.username}" if sender.username else sender.first_name or None) if sender else None,
+            message_text, message_dt_unix
+        )
+
+        # Burst coalescing (opt-in per group): mentions within the window get one combined reply
+        burst_window = group_record.get('burst_window_seconds') if not settings.SERVERLESS_MODE else None
+        if burst_window:
+            burst = burst_coalescer.coalescer.join(bot_registry.chat_key(chat_id), triggered)
+            if burst is None:
+                return {"status": "ok", "detail": "Coalesced into burst reply"}
+            # Answered in the background: holding this request open for the window would outlast
+            # the listener's forward timeout and get the update redelivered. The updates count as
+            # handled from here, so the burst is lost if the process stops inside the window.
+            task = asyncio.create_task(answer_burst(chat_id, group_record, burst, burst_window, bot_username))
+            _burst_tasks.add(task)
+            task.add_done_callback(_burst_tasks.discard)
+            return {"status": "ok", "detail": "Burst opened"}
+
+        with load_shedder.shedder.track(), usage_accounting.timed("total"):
+            return await respond_to_trigger(
+                chat_id=chat_id, group_record=group_record, message=triggered,
+                bot_username=bot_username, shed_level=shed_level
             )
-            logger.info(f"Found {len(relevant_memories)} relevant memories (limit={settings.MEMORY_RETRIEVAL_LIMIT}, max_age={settings.MEMORY_RETRIEVAL_MAX_AGE_DAYS} days).")
-        else:
-            logger.warning(f"Skipping memory retrieval because query embedding is missing.")
-
-        # Build Prompt
-        llm_messages = [{"role": "system", "content": persona_prompt}]
-        if relevant_memories:
-            context_header = "Relevant past messages (most relevant first):\n---"
-            llm_messages.append({"role": "system", "content": context_header})
-            bot_user_id_local = telegram_utils.BOT_USER_ID
-            for memory in relevant_memories:
-                 mem_ts_str = memory['message_timestamp'].strftime("%Y-%m-%d %H:%M")
-                 mem_user_id = memory['user_id']
-                 mem_text = memory['message_text']
-                 speaker = f"User {mem_user_id}"
-                 if bot_user_id_local and mem_user_id == bot_user_id_local: speaker = "You (the bot)"
-                 max_len = 150
-                 if len(mem_text) > max_len: mem_text = mem_text[:max_len] + "..."
-                 formatted_mem = f"{speaker} previously said at {mem_ts_str}: {mem_text}"
-                 llm_messages.append({"role": "system", "content": formatted_mem})
-            llm_messages.append({"role": "system", "content": "---\nRespond to the current user message:"})
-        llm_messages.append({"role": "user", "content": message_text})
-        logger.debug(f"Constructed LLM messages (RAG): Count={len(llm_messages)}")
-
-        # Call LLM
-        bot_response_text = await llm_service.generate_chat_response(messages=llm_messages)
-
-        # Send Response & Store Bot Message
-        if bot_response_text:
-            send_result = await telegram_utils.send_telegram_message(chat_id=chat_id, text=bot_response_text)
-            if send_result.get("success"):
-                bot_msg_id = send_result.get("message_id")
-                bot_user_id_to_store = telegram_utils.BOT_USER_ID
-                if bot_msg_id and bot_user_id_to_store:
-                    bot_msg_dt = datetime.now()
-                    logger.debug(f"Storing bot response (msg_id: {bot_msg_id}) to memory...")                    
-                    bot_embedding = await llm_service.get_embedding(text=bot_response_text)
-                    if bot_embedding:
-                         await database.add_chat_memory(
-                             chat_id=chat_id, message_id=bot_msg_id, user_id=bot_user_id_to_store,
-                             message_text=bot_response_text, message_timestamp=bot_msg_dt, embedding=bot_embedding
-                         )
-                         logger.info(f"Stored bot response (msg_id: {bot_msg_id}) to memory.")
-                    else: logger.warning(f"Could not generate embedding for bot response.")
-                else: logger.warning(f"Could not store bot response: Missing bot msg ID or user ID.")
-            else: # Failed to send
-                logger.error(f"Failed to send bot response message to chat {chat_id}.")
-        else: # Failed to generate
-            logger.error(f"LLM failed to generate response for chat {chat_id}.")
-            await telegram_utils.send_telegram_message(chat_id=chat_id, text="Sorry, error generating response.")
-
-        # End of triggered non-command message handling
-        return {"status": "ok"}
 
     # This final return should only be reached if something unexpected happens,
     # as all paths (command, triggered non-command, ignored non-command) should return earlier.
@@ -1,9 +1,15 @@
 import logging
-from typing import Optional
-from openai import OpenAI, OpenAIError, AsyncOpenAI
+import time
+from typing import Optional, TYPE_CHECKING
 
 # Import settings
 from .config import settings
+from . import model_router
+from . import usage_accounting
+
+if TYPE_CHECKING:
+    # openai is imported lazily (see _get_client) to keep serverless cold starts fast
+    from openai import AsyncOpenAI, OpenAIError
 
 # --- Logging Setup ---
 
@@ -13,17 +19,29 @@ logger = logging.getLogger(__name__)
 
 # API_KEY = os.getenv("OPENAI_API_KEY") # Replaced by settings
 
+# The client is created on first use rather than at import time
+client: Optional["AsyncOpenAI"] = None
+
 if not settings or not settings.OPENAI_API_KEY:
     logger.warning("OPENAI_API_KEY not found in settings. LLM functionality will be disabled.")
-    client = None
-else:
+
+def _get_client() -> Optional["AsyncOpenAI"]:
+    """Imports openai and initializes the async client on first call, then returns the cached client."""
+    global client, OpenAIError
+    if client:
+        return client
+    if not settings or not settings.OPENAI_API_KEY:
+        return None
     try:
+        from openai import AsyncOpenAI, OpenAIError
         # Initialize the asynchronous client using key from settings
-        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, timeout=settings.LLM_TIMEOUT_SECONDS,
+                             max_retries=settings.LLM_MAX_RETRIES)
         logger.info("OpenAI client initialized successfully.")
     except Exception as e:
-        logger.error(f"Failed to initialize OpenAI client: {e}")
+        logger.error("Failed to initialize OpenAI client: %s", e)
         client = None
+    return client
 
 # --- Constants ---
 
@@ -36,54 +54,77 @@ Based on this description, generate a concise and effective system prompt (max 1
 
 # --- LLM Functions ---
 
-async def generate_chat_response(messages: list[dict[str, str]], model: str | None = None) -> Optional[str]:
+async def generate_chat_response(
+    messages: list[dict[str, str]],
+    model: str | None = None,
+    max_tokens: int | None = None,
+    group_tier: str | None = None
+) -> Optional[str]:
     """
     Generates a chat response using the OpenAI API based on a list of messages.
 
     Args:
         messages: A list of message dictionaries, e.g., 
                   [{"role": "system", "content": "..."}, {"role": "user", "content": "..."}]
-        model: The OpenAI model to use (defaults to settings.LLM_MODEL).
+        model: The OpenAI model to use. When omitted and LLM_ROUTING_ENABLED is set, the
+               model router picks one from the messages; otherwise settings.LLM_MODEL.
+        max_tokens: Response length limit (defaults to the routed tier's limit, or settings.LLM_MAX_TOKENS).
+        group_tier: The group's pinned routing tier ('fast', 'default', 'large'), if any.
 
     Returns:
         The LLM-generated text or None on failure.
     """
+    client = _get_client()
     if not client:
         logger.error("OpenAI client is not initialized. Cannot generate text.")
         return None
 
-    # Use model from settings if not provided
+    # Explicit model > routed model > model from settings
+    route_max_tokens = None
+    if not model and settings and settings.LLM_ROUTING_ENABLED:
+        route = model_router.route(messages, group_tier)
+        model, route_max_tokens = route.model, route.max_tokens
     model_to_use = model or (settings.LLM_MODEL if settings else "gpt-4o-mini")
+    max_tokens = max_tokens or route_max_tokens or (settings.LLM_MAX_TOKENS if settings else 150)
 
+    started = time.perf_counter()
+    succeeded = False
+    response = None
     try:
-        logger.debug(f"Sending messages to OpenAI ({model_to_use})...") # Log less verbosely
+        logger.debug("Sending messages to OpenAI (%s, max_tokens=%s)...", model_to_use, max_tokens) # Log less verbosely
         response = await client.chat.completions.create(
             model=model_to_use,
             messages=messages, # Pass the list of messages directly
             temperature=0.7, # Adjust creativity (0.0=deterministic, 1.0=creative)
-            max_tokens=150    # Limit response length (adjust as needed)
+            max_tokens=max_tokens # Limit response length
         )
+        succeeded = True
 
         if response and response.choices and len(response.choices) > 0:
             message_content = response.choices[0].message.content
             if message_content:
-                logger.info(f"Generated text: {message_content[:100]}...")
+                logger.info("Generated text: %.100s...", message_content)
                 return message_content
             else:
                 logger.warning("Chat response message content is empty.")
                 return None
         else:
-            logger.warning(f"Invalid or empty chat response received from OpenAI: {response}")
+            logger.warning("Invalid or empty chat response received from OpenAI: %s", response)
             return None
 
     except OpenAIError as e:
         # Handle API errors (e.g., rate limits, authentication issues)
-        logger.error(f"OpenAI API error during chat generation: {e}")
+        logger.error("OpenAI API error during chat generation: %s", e)
         return None
     except Exception as e:
         # Handle other potential errors
-        logger.error(f"An unexpected error occurred during chat generation: {e}")
+        logger.error("An unexpected error occurred during chat generation: %s", e)
         return None
+    finally:
+        elapsed = time.perf_counter() - started
+        # Latency and errors per model steer later routing decisions
+        model_router.record(model_to_use, elapsed, succeeded)
+        usage_accounting.record_completion(model_to_use, getattr(response, "usage", None), elapsed)
 
 async def generate_persona_prompt(user_description: str, model: str | None = None) -> Optional[str]:
     """
@@ -96,6 +137,7 @@ async def generate_persona_prompt(user_description: str, model: str | None = Non
     Returns:
         The LLM-generated system prompt or None on failure.
     """
+    client = _get_client()
     if not client:
         logger.error("OpenAI client is not initialized. Cannot generate persona prompt.")
         return None
@@ -104,8 +146,10 @@ async def generate_persona_prompt(user_description: str, model: str | None = Non
     model_to_use = model or (settings.LLM_MODEL if settings else "gpt-4o-mini")
     
     meta_prompt_filled = META_PROMPT_PERSONA_GENERATION.format(user_description=user_description)
-    logger.info(f"Generating persona using meta-prompt for description: {user_description[:50]}...")
+    logger.info("Generating persona using meta-prompt for description: %.50s...", user_description)
 
+    started = time.perf_counter()
+    response = None
     try:
         response = await client.chat.completions.create(
             model=model_to_use,
@@ -124,68 +168,121 @@ async def generate_persona_prompt(user_description: str, model: str | None = Non
                  # Further clean-up: remove potential surrounding quotes if the LLM adds them
                 if final_content.startswith('"') and final_content.endswith('"'):
                     final_content = final_content[1:-1]
-                logger.info(f"Generated persona prompt: {final_content[:100]}...")
+                logger.info("Generated persona prompt: %.100s...", final_content)
                 return final_content
             else:
                  logger.warning("Persona generation resulted in empty content.")
                  return None
         else:
-            logger.warning(f"Invalid or empty response received during persona generation: {response}")
+            logger.warning("Invalid or empty response received during persona generation: %s", response)
             return None
             
     except OpenAIError as e:
-        logger.error(f"OpenAI API error during persona generation: {e}")
+        logger.error("OpenAI API error during persona generation: %s", e)
         return None
     except Exception as e:
-        logger.error(f"An unexpected error occurred during persona generation: {e}")
+        logger.error("An unexpected error occurred during persona generation: %s", e)
         return None
+    finally:
+        # Charged to the chat whose /set_personality request is being handled
+        usage_accounting.record_completion(model_to_use, getattr(response, "usage", None), time.perf_counter() - started)
 
-async def get_embedding(text: str, model: str | None = None) -> Optional[list[float]]:
+async def get_embedding(text: str, model: str | None = None, dimensions: int | None = None) -> Optional[list[float]]:
     """
     Generates an embedding vector for the given text using the specified OpenAI model.
 
     Args:
         text: The input text to embed.
         model: The OpenAI embedding model to use (defaults to settings.EMBEDDING_MODEL).
+        dimensions: Output dimensions (defaults to settings.EMBEDDING_DIMENSIONS; None = model default).
 
     Returns:
         The embedding vector as a list of floats, or None if an error occurs.
     """
+    client = _get_client()
     if not client:
         logger.error("OpenAI client is not initialized. Cannot generate embedding.")
         return None
         
     # Use model from settings if not provided
     model_to_use = model or (settings.EMBEDDING_MODEL if settings else "text-embedding-3-small")
+    dimensions = dimensions or (settings.EMBEDDING_DIMENSIONS if settings else None)
     
     # OpenAI recommends replacing newlines with spaces for better performance.
     text = text.replace("\n", " ")
     
     try:
-        logger.debug(f"Requesting embedding for text ({model_to_use}): {text[:100]}...")
+        logger.debug("Requesting embedding for text (%s): %.100s...", model_to_use, text)
+        extra_args = {}
+        if dimensions:
+            extra_args["dimensions"] = dimensions # Only supported by text-embedding-3 and later
+        started = time.perf_counter()
         response = await client.embeddings.create(
             input=[text], # API expects a list of strings
-            model=model_to_use
+            model=model_to_use,
+            **extra_args
         )
+        usage_accounting.record_embedding(model_to_use, getattr(response, "usage", None), time.perf_counter() - started)
         
         # Check response structure and extract the embedding
         if response and response.data and len(response.data) > 0:
             embedding_data = response.data[0].embedding
             if embedding_data:
-                logger.debug(f"Successfully generated embedding. Vector dimension: {len(embedding_data)}")
+                logger.debug("Successfully generated embedding. Vector dimension: %s", len(embedding_data))
                 return embedding_data
             else:
-                logger.warning(f"OpenAI embedding response data is empty for model {model_to_use}.")
+                logger.warning("OpenAI embedding response data is empty for model %s.", model_to_use)
                 return None
         else:
-            logger.warning(f"Invalid or empty response received from OpenAI embeddings endpoint: {response}")
+            logger.warning("Invalid or empty response received from OpenAI embeddings endpoint: %s", response)
             return None
             
     except OpenAIError as e:
-        logger.error(f"OpenAI API error during embedding generation: {e}")
+        logger.error("OpenAI API error during embedding generation: %s", e)
+        return None
+    except Exception as e:
+        logger.error("An unexpected error occurred during embedding generation: %s", e)
+        return None
+
+async def get_embeddings(texts: list[str], model: str | None = None, dimensions: int | None = None) -> Optional[list[list[float]]]:
+    """
+    Generates embeddings for several texts in a single API call.
+
+    Args:
+        texts: The input texts (the API accepts up to 2048 per call).
+        model: The OpenAI embedding model to use (defaults to settings.EMBEDDING_MODEL).
+        dimensions: Output dimensions (defaults to settings.EMBEDDING_DIMENSIONS; None = model default).
+
+    Returns:
+        One embedding per input text, in input order, or None if an error occurs.
+    """
+    client = _get_client()
+    if not client:
+        logger.error("OpenAI client is not initialized. Cannot generate embeddings.")
+        return None
+    if not texts:
+        return []
+
+    model_to_use = model or (settings.EMBEDDING_MODEL if settings else "text-embedding-3-small")
+    dimensions = dimensions or (settings.EMBEDDING_DIMENSIONS if settings else None)
+    # Same newline handling as get_embedding; the API rejects empty strings
+    inputs = [text.replace("\n", " ") or " " for text in texts]
+
+    try:
+        extra_args = {"dimensions": dimensions} if dimensions else {}
+        started = time.perf_counter()
+        response = await client.embeddings.create(input=inputs, model=model_to_use, **extra_args)
+        usage_accounting.record_embedding(model_to_use, getattr(response, "usage", None), time.perf_counter() - started)
+        if response and response.data and len(response.data) == len(inputs):
+            # Results carry their input index; sort defensively
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        logger.warning("Embeddings response has %s items for %s inputs.", len(response.data) if response and response.data else 0, len(inputs))
+        return None
+    except OpenAIError as e:
+        logger.error("OpenAI API error during batch embedding generation: %s", e)
         return None
     except Exception as e:
-        logger.error(f"An unexpected error occurred during embedding generation: {e}")
+        logger.error("An unexpected error occurred during batch embedding generation: %s", e)
         return None
 
 # Example Usage (can be run directly for testing if needed, requires API key)
@@ -0,0 +1,139 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable, Optional, List
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Degradation ladder. Each level also applies every degradation below it.
+LEVEL_NORMAL = 0
+LEVEL_SKIP_REPLY_STORAGE = 1 # Don't embed/store the bot's own reply
+LEVEL_SKIP_RETRIEVAL = 2     # No vector retrieval (recent turns from the buffer still used)
+LEVEL_REDUCED_TOKENS = 3     # Cap max_tokens at LOAD_SHED_REDUCED_MAX_TOKENS
+LEVEL_FAST_MODEL = 4         # Use LLM_FAST_MODEL instead of the configured model
+LEVEL_BUSY_REPLY = 5         # Reply with LOAD_SHED_BUSY_MESSAGE, no LLM call
+LEVEL_NAMES = ("normal", "skip_reply_storage", "skip_retrieval", "reduced_max_tokens", "fast_model", "busy_reply")
+
+
+class LoadShedder:
+    """
+    Overload controller for the triggered-message path.
+
+    Pressure is the worst ratio of in-flight requests, LLM latency (EWMA) and queue age
+    (EWMA of the time since the listener received each message) to their targets. The level rises immediately
+    to the highest threshold the pressure crosses, and falls one level at a time once
+    pressure has stayed below the current level for `recovery_seconds`. The EWMAs decay
+    while idle, so the controller recovers even without traffic.
+    """
+
+    def __init__(self, max_in_flight: int, latency_target: float, queue_age_target: float,
+                 thresholds: List[float], recovery_seconds: float, busy_notice_interval: float = 60.0):
+        self.max_in_flight = max_in_flight
+        self.latency_target = latency_target
+        self.queue_age_target = queue_age_target
+        self.thresholds = sorted(thresholds)[:LEVEL_BUSY_REPLY]
+        self.recovery_seconds = recovery_seconds
+        self.in_flight = 0
+        self.level = LEVEL_NORMAL
+        self._latency = 0.0
+        self._latency_at = time.monotonic()
+        self._queue_age = 0.0
+        self._queue_age_at = time.monotonic()
+        self._below_since: Optional[float] = None
+        self.shed_counts = [0] * len(LEVEL_NAMES)
+        self.busy_notice_interval = busy_notice_interval
+        self._busy_notices: Dict[Hashable, float] = {} # Chat key -> last busy reply (monotonic)
+
+    def _decayed(self, value: float, observed_at: float, now: float) -> float:
+        return value * math.exp(-(now - observed_at) / self.recovery_seconds) if self.recovery_seconds > 0 else value
+
+    def _ewma(self, value: float, observed_at: float, sample: float, now: float) -> float:
+        return 0.8 * self._decayed(value, observed_at, now) + 0.2 * sample
+
+    def observe_latency(self, seconds: float):
+        now = time.monotonic()
+        self._latency, self._latency_at = self._ewma(self._latency, self._latency_at, seconds, now), now
+
+    def observe_queue_age(self, seconds: float):
+        now = time.monotonic()
+        self._queue_age, self._queue_age_at = self._ewma(self._queue_age, self._queue_age_at, max(0.0, seconds), now), now
+
+    def pressure(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(
+            self.in_flight / self.max_in_flight if self.max_in_flight else 0.0,
+            self._decayed(self._latency, self._latency_at, now) / self.latency_target if self.latency_target else 0.0,
+            self._decayed(self._queue_age, self._queue_age_at, now) / self.queue_age_target if self.queue_age_target else 0.0,
+        )
+
+    def update(self) -> int:
+        """Recomputes and returns the current level."""
+        if not settings or not settings.LOAD_SHED_ENABLED:
+            return LEVEL_NORMAL
+        now = time.monotonic()
+        pressure = self.pressure(now)
+        target = sum(1 for threshold in self.thresholds if pressure >= threshold)
+        if target > self.level:
+            logger.warning("Load shedding: level %s -> %s (%s), pressure %.2f", self.level, target, LEVEL_NAMES[target], pressure)
+            self.level = target
+            self._below_since = None
+        elif target < self.level:
+            if self._below_since is None:
+                self._below_since = now
+            elif now - self._below_since >= self.recovery_seconds:
+                self.level -= 1
+                self._below_since = now
+                logger.info("Load shedding: recovered to level %s (%s), pressure %.2f", self.level, LEVEL_NAMES[self.level], pressure)
+        else:
+            self._below_since = None
+        self.shed_counts[self.level] += 1
+        return self.level
+
+    def busy_notice_due(self, chat_key: Hashable) -> bool:
+        """True if the chat should get a busy reply now; at most one per `busy_notice_interval`."""
+        now = time.monotonic()
+        last = self._busy_notices.get(chat_key)
+        if last is not None and now - last < self.busy_notice_interval:
+            return False
+        if len(self._busy_notices) >= 10_000:
+            self._busy_notices = {key: at for key, at in self._busy_notices.items() if now - at < self.busy_notice_interval}
+        self._busy_notices[chat_key] = now
+        return True
+
+    @contextmanager
+    def track(self):
+        """Counts a request as in flight for the duration of the block."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "level": self.level,
+            "level_name": LEVEL_NAMES[self.level],
+            "pressure": round(self.pressure(), 3),
+            "in_flight": self.in_flight,
+            "llm_latency_ewma_s": round(self._decayed(self._latency, self._latency_at, time.monotonic()), 3),
+            "queue_age_ewma_s": round(self._decayed(self._queue_age, self._queue_age_at, time.monotonic()), 3),
+            "requests_by_level": dict(zip(LEVEL_NAMES, self.shed_counts)),
+        }
+
+
+shedder = LoadShedder(
+    max_in_flight=settings.LOAD_SHED_MAX_IN_FLIGHT if settings else 20,
+    latency_target=settings.LOAD_SHED_LATENCY_TARGET_SECONDS if settings else 4.0,
+    queue_age_target=settings.LOAD_SHED_QUEUE_AGE_TARGET_SECONDS if settings else 15.0,
+    thresholds=settings.LOAD_SHED_THRESHOLDS if settings else [1.0, 1.25, 1.5, 2.0, 3.0],
+    recovery_seconds=settings.LOAD_SHED_RECOVERY_SECONDS if settings else 30.0,
+    busy_notice_interval=settings.LOAD_SHED_BUSY_NOTICE_INTERVAL_SECONDS if settings else 60.0,
+)
+
+if settings and settings.LOAD_SHED_ENABLED and settings.LLM_FAST_MODEL == settings.LLM_MODEL:
+    logger.warning("LLM_FAST_MODEL is the same as LLM_MODEL (%s); the fast_model load-shedding level won't reduce load.",
+                   settings.LLM_MODEL)
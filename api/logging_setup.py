@@ -0,0 +1,139 @@
+"""
+Process-wide logging configuration.
+
+Call configure_logging() once at startup. Log calls then only build a record and put it
+on an in-memory queue (QueueHandler); a QueueListener thread serializes and writes it, so no
+log I/O happens on the event loop. Messages should use %-style arguments, e.g.
+logger.info("Sent message to chat %s", chat_id), so records that are filtered out are never
+formatted. The message itself is merged on the calling thread, while its arguments still
+hold the values they had at the log call.
+
+Records carry the update_id/chat_id bound to the current request with bind(), and are
+written as one JSON object per line (or plain text). INFO and DEBUG records can be
+sampled per category (logger name prefix) to cut the volume of hot-path logs; warnings
+and errors are never sampled.
+
+Standard library only, so the bot listener can use it too.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Optional
+
+# Fields bound to the current request/task (bot_id, update_id, chat_id, ...)
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+_CONTEXT_FIELDS = ("bot_id", "update_id", "chat_id")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def bind(**fields):
+    """Adds fields to every record logged from the current task (and tasks it creates afterwards)."""
+    _context.set({**_context.get(), **fields})
+
+def clear_context():
+    _context.set({})
+
+
+class _ContextFilter(logging.Filter):
+    """Copies the bound context onto the record. Runs on the calling thread, where the context is visible."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    """Keeps a fraction of records below WARNING for configured logger-name prefixes."""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        # Longest prefix first, so "api.llm_service" overrides "api"
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        category = getattr(record, "category", None) or record.name
+        for prefix, rate in self.rates:
+            if category == prefix or category.startswith(prefix + "."):
+                if rate >= 1.0 or random.random() < rate:
+                    return True
+                self.dropped += 1
+                return False
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves serialization (JSON, tracebacks) to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge `msg % args` now: arguments may be mutated by the caller before the listener
+        # gets to the record. The default prepare() would also format the whole line here.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in _CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        context = " ".join(f"{key}={getattr(record, key)}" for key in _CONTEXT_FIELDS if getattr(record, key, None) is not None)
+        return f"{text} [{context}]" if context else text
+
+
+def configure_logging(level: str = "INFO", json_format: bool = True, sample_rates: Optional[dict[str, float]] = None):
+    """Routes all logging through a queue to a background writer. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else _TextFormatter("%(levelname)s:%(name)s:%(message)s"))
+
+    log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(_SamplingFilter(sample_rates or {})) # Drop sampled-out records before any other work
+    handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Flushes queued records and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,80 @@
+"""
+Maintenance jobs run by the scheduler (see scheduler.py). Default schedules are in UTC and can be
+changed or turned off per job with SCHEDULER_SCHEDULES.
+"""
+
+import asyncio
+import logging
+
+# Import settings
+from .config import settings
+from . import database
+from . import persona_cache
+
+logger = logging.getLogger(__name__)
+
+# Dead rows as a share of live rows above which the ANALYZE job suggests a manual VACUUM
+DEAD_ROW_HINT_RATIO = 0.2
+MEMORY_PRUNE_BATCH_SIZE = 5000
+# Buckets refill within minutes, so one idle this long is full and equivalent to no row at all
+RATE_LIMIT_BUCKET_IDLE_SECONDS = 3600.0
+
+
+async def _repository():
+    repo = await database.get_repository()
+    if not repo:
+        raise RuntimeError("database unavailable")
+    return repo
+
+async def analyze_chat_memories() -> dict:
+    """Refreshes planner statistics for chat_memories and flags dead-row bloat that autovacuum hasn't caught up with."""
+    repo = await _repository()
+    await repo.analyze_table("chat_memories")
+    health = await repo.table_health("chat_memories")
+    if not health:
+        return {}
+    live, dead = health["n_live_tup"], health["n_dead_tup"]
+    dead_ratio = dead / live if live else 0.0
+    if dead_ratio > DEAD_ROW_HINT_RATIO:
+        logger.warning("chat_memories has %s dead rows (%.0f%% of live rows, last vacuum %s). Consider "
+                       "VACUUM (ANALYZE) chat_memories, or a lower autovacuum_vacuum_scale_factor for the table.",
+                       dead, dead_ratio * 100, health["last_autovacuum"] or health["last_vacuum"])
+    return {"live_rows": live, "dead_rows": dead, "dead_ratio": round(dead_ratio, 3)}
+
+async def prune_memories() -> dict:
+    """Deletes memories older than MEMORY_RETENTION_DAYS, in batches so no statement runs long."""
+    repo = await _repository()
+    deleted = 0
+    while True:
+        batch = await repo.delete_memories_before(settings.MEMORY_RETENTION_DAYS, MEMORY_PRUNE_BATCH_SIZE)
+        deleted += batch
+        if batch < MEMORY_PRUNE_BATCH_SIZE:
+            return {"deleted": deleted}
+        await asyncio.sleep(0.1) # Let other work use the pool between batches
+
+async def prune_usage_rollups() -> dict:
+    repo = await _repository()
+    return {"deleted": await repo.delete_usage_before(settings.USAGE_RETENTION_DAYS)}
+
+async def prune_rate_limit_buckets() -> dict:
+    repo = await _repository()
+    return {"deleted": await repo.delete_idle_rate_limit_buckets(RATE_LIMIT_BUCKET_IDLE_SECONDS)}
+
+async def warm_persona_cache() -> dict:
+    """Preloads the most used persona prompts, so /set_personality with a popular description skips the database."""
+    repo = await _repository()
+    rows = await repo.top_persona_prompts(settings.PERSONA_CACHE_WARM_COUNT)
+    return {"loaded": len(rows), "cached": persona_cache.cache.warm(rows)}
+
+
+def register(scheduler):
+    scheduler.add("analyze_chat_memories", analyze_chat_memories, "30 3 * * *")
+    if settings.MEMORY_RETENTION_DAYS:
+        scheduler.add("prune_memories", prune_memories, "15 4 * * *")
+    if settings.USAGE_RETENTION_DAYS:
+        scheduler.add("prune_usage_rollups", prune_usage_rollups, "45 4 * * *")
+    if settings.RATE_LIMIT_SHARED:
+        scheduler.add("prune_rate_limit_buckets", prune_rate_limit_buckets, "every 15m")
+    if settings.PERSONA_CACHE_ENABLED and settings.PERSONA_CACHE_WARM_COUNT:
+        # Warms this replica's cache, so it runs on every replica
+        scheduler.add("warm_persona_cache", warm_persona_cache, "every 1h", leader_only=False, run_on_start=True)
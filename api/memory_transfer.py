@@ -0,0 +1,320 @@
+"""
+Bulk export/import of chats' settings and memories in a compact binary file.
+
+Export streams chat_memories out with binary COPY and re-frames each tuple into the file;
+import streams the file back in with binary COPY. Both run in constant memory, so they
+scale to millions of rows.
+
+File format (all integers big-endian):
+    magic       8 bytes  b"TLFYMEM\\x01"
+    header      u32 length + UTF-8 JSON (format_version, created_at, chat_ids, vector_format)
+    records     u8 kind + u32 payload length + payload, where kind is
+                  1 = group row as UTF-8 JSON
+                  2 = memory:  i64 chat_id, i64 message_id, i64 user_id,
+                               i64 message_timestamp (microseconds since 2000-01-01 UTC, PostgreSQL's epoch),
+                               i64 bot_id (format_version >= 2),
+                               u32 text length + UTF-8 text,
+                               u16 model length (0xFFFF = NULL) + UTF-8 embedding_model,
+                               u16 dimensions + dimensions * raw float32 (big-endian, as sent by PostgreSQL)
+                  0 = end marker, payload is UTF-8 JSON with record counts
+
+Usage:
+    python -m api.memory_transfer export --chat-id <ID> [--chat-id <ID> ...] | --all  [--bot-id <ID>] -o chats.tfm
+    python -m api.memory_transfer import chats.tfm [--bot-id <ID>]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import struct
+import time
+from datetime import datetime, timezone
+from typing import Optional, List, AsyncIterator
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"TLFYMEM\x01"
+FORMAT_VERSION = 2
+KIND_END, KIND_GROUP, KIND_MEMORY = 0, 1, 2
+NULL_U16 = 0xFFFF
+READ_CHUNK_BYTES = 1 << 20
+
+PG_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PG_COPY_HEADER = PG_COPY_SIGNATURE + struct.pack(">ii", 0, 0)
+PG_COPY_TRAILER = struct.pack(">h", -1)
+
+# Column order shared by the export query and the import staging table
+MEMORY_COLUMNS = "chat_id, message_id, user_id, message_timestamp, bot_id, message_text, embedding_model, embedding"
+GROUP_COLUMNS = (
+    "chat_id", "is_active", "admin_ids", "personality_prompt", "created_at",
+    "rate_limit_user_per_minute", "rate_limit_chat_per_minute", "retrieval_mode", "model_tier",
+    "burst_window_seconds",
+)
+
+
+class CopyBinaryParser:
+    """Incremental parser for PostgreSQL binary COPY output; yields tuples of raw field bytes."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._header_done = False
+
+    def feed(self, data: bytes) -> List[List[Optional[bytes]]]:
+        buf = self._buffer
+        buf += data
+        rows, pos = [], 0
+        if not self._header_done:
+            if len(buf) < 19:
+                return rows
+            if buf[:11] != PG_COPY_SIGNATURE:
+                raise ValueError("Not a PostgreSQL binary COPY stream")
+            extension_len = struct.unpack_from(">I", buf, 15)[0]
+            if len(buf) < 19 + extension_len:
+                return rows
+            pos = 19 + extension_len
+            self._header_done = True
+        while len(buf) - pos >= 2:
+            field_count = struct.unpack_from(">h", buf, pos)[0]
+            if field_count == -1: # Trailer
+                pos += 2
+                break
+            cursor, fields = pos + 2, []
+            for _ in range(field_count):
+                if len(buf) - cursor < 4:
+                    break
+                field_len = struct.unpack_from(">i", buf, cursor)[0]
+                cursor += 4
+                if field_len == -1:
+                    fields.append(None)
+                    continue
+                if len(buf) - cursor < field_len:
+                    break
+                fields.append(bytes(buf[cursor:cursor + field_len]))
+                cursor += field_len
+            if len(fields) < field_count:
+                break # Incomplete tuple; wait for more data
+            rows.append(fields)
+            pos = cursor
+        del buf[:pos]
+        return rows
+
+
+def _record(kind: int, payload: bytes) -> bytes:
+    return struct.pack(">BI", kind, len(payload)) + payload
+
+def encode_memory(fields: List[Optional[bytes]]) -> bytes:
+    """Re-frames one COPY tuple (MEMORY_COLUMNS order) as a memory record."""
+    chat_id, message_id, user_id, timestamp, bot_id, text, model, vector = fields
+    model_part = struct.pack(">H", NULL_U16) if model is None else struct.pack(">H", len(model)) + model
+    # vector wire format: u16 dims, u16 unused, float32 values; keep dims and the raw values
+    payload = b"".join((chat_id, message_id, user_id, timestamp, bot_id, struct.pack(">I", len(text)), text,
+                        model_part, vector[:2], vector[4:]))
+    return _record(KIND_MEMORY, payload)
+
+def memory_to_copy_tuple(payload: bytes, format_version: int = FORMAT_VERSION, bot_id: int = 0) -> bytes:
+    """
+    Converts a memory record payload back into a binary COPY tuple (MEMORY_COLUMNS order).
+    Format 1 records have no bot_id; they get `bot_id`.
+    """
+    fixed = 40 if format_version >= 2 else 32
+    pos = fixed
+    text_len = struct.unpack_from(">I", payload, pos)[0]
+    pos += 4
+    text = payload[pos:pos + text_len]
+    pos += text_len
+    model_len = struct.unpack_from(">H", payload, pos)[0]
+    pos += 2
+    model = None
+    if model_len != NULL_U16:
+        model = payload[pos:pos + model_len]
+        pos += model_len
+    dims, floats = payload[pos:pos + 2], payload[pos + 2:]
+
+    parts = [struct.pack(">h", 8)]
+    for offset in range(0, 32, 8): # chat_id, message_id, user_id, message_timestamp
+        parts += (b"\x00\x00\x00\x08", payload[offset:offset + 8])
+    parts += (b"\x00\x00\x00\x08", payload[32:40] if fixed == 40 else struct.pack(">q", bot_id))
+    parts += (struct.pack(">i", len(text)), text)
+    parts += (struct.pack(">i", -1),) if model is None else (struct.pack(">i", len(model)), model)
+    parts += (struct.pack(">i", 4 + len(floats)), dims, b"\x00\x00", floats)
+    return b"".join(parts)
+
+def iter_records(path: str):
+    """Yields (kind, payload) from a transfer file, reading it in fixed-size chunks."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Telefy memory transfer file")
+        header_len = struct.unpack(">I", f.read(4))[0]
+        yield None, f.read(header_len)
+        buf = bytearray()
+        while True:
+            while len(buf) >= 5:
+                kind, length = struct.unpack_from(">BI", buf)
+                if len(buf) < 5 + length:
+                    break
+                payload = bytes(buf[5:5 + length])
+                del buf[:5 + length]
+                yield kind, payload
+                if kind == KIND_END:
+                    return
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                raise ValueError(f"{path} is truncated (no end marker)")
+            buf += chunk
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Unserializable value: {value!r}")
+
+
+async def export_chats(connection, chat_ids: Optional[List[int]], path: str, bot_id: Optional[int] = None) -> dict:
+    """Writes the given chats (all chats if None) to `path`, optionally one bot's memories only. Returns record counts."""
+    counts = {"groups": 0, "memories": 0}
+    with open(path, "wb") as out:
+        header = json.dumps({
+            "format_version": FORMAT_VERSION,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "chat_ids": chat_ids,
+            "bot_id": bot_id,
+            "vector_format": "float32-be",
+        }).encode()
+        out.write(MAGIC + struct.pack(">I", len(header)) + header)
+
+        groups = await connection.fetch(
+            f"SELECT {', '.join(GROUP_COLUMNS)} FROM groups WHERE $1::BIGINT[] IS NULL OR chat_id = ANY($1::BIGINT[])",
+            chat_ids
+        )
+        for group in groups:
+            out.write(_record(KIND_GROUP, json.dumps(dict(group), default=_json_default).encode()))
+            counts["groups"] += 1
+
+        parser = CopyBinaryParser()
+
+        async def write_chunk(chunk: bytes):
+            rows = parser.feed(chunk)
+            out.write(b"".join(encode_memory(fields) for fields in rows))
+            counts["memories"] += len(rows)
+
+        await connection.copy_from_query(
+            f"SELECT chat_id, message_id, user_id, message_timestamp, bot_id, message_text, embedding_model, embedding::vector "
+            f"FROM chat_memories WHERE ($1::BIGINT[] IS NULL OR chat_id = ANY($1::BIGINT[])) "
+            f"AND ($2::BIGINT IS NULL OR bot_id = $2) ORDER BY chat_id, memory_id",
+            chat_ids, bot_id, output=write_chunk, format="binary"
+        )
+        out.write(_record(KIND_END, json.dumps(counts).encode()))
+    return counts
+
+
+async def import_file(connection, path: str, bot_id: Optional[int] = None) -> dict:
+    """
+    Loads a transfer file: upserts group settings and inserts memories (existing messages are kept).
+    `bot_id` reassigns the memories to that bot; it is required for format 1 files, which predate bot IDs.
+    """
+    groups: List[dict] = []
+    counts = {"groups": 0, "memories": 0}
+    format_version = FORMAT_VERSION
+
+    async def copy_source() -> AsyncIterator[bytes]:
+        nonlocal format_version
+        chunk, size = [PG_COPY_HEADER], len(PG_COPY_HEADER)
+        for kind, payload in iter_records(path):
+            if kind is None:
+                format_version = json.loads(payload).get("format_version", 1)
+                if format_version < 2 and bot_id is None:
+                    raise ValueError(f"{path} has no bot IDs (format {format_version}); pass --bot-id")
+            elif kind == KIND_MEMORY:
+                tuple_bytes = memory_to_copy_tuple(payload, format_version, bot_id or 0)
+                chunk.append(tuple_bytes)
+                size += len(tuple_bytes)
+                counts["memories"] += 1
+                if size >= READ_CHUNK_BYTES:
+                    yield b"".join(chunk)
+                    chunk, size = [], 0
+            elif kind == KIND_GROUP:
+                groups.append(json.loads(payload)) # Group rows are small; kept until the memories are staged
+        chunk.append(PG_COPY_TRAILER)
+        yield b"".join(chunk)
+
+    async with connection.transaction():
+        await connection.execute(
+            "CREATE TEMP TABLE memory_import (chat_id BIGINT, message_id BIGINT, user_id BIGINT, "
+            "message_timestamp TIMESTAMPTZ, bot_id BIGINT, message_text TEXT, embedding_model TEXT, embedding VECTOR) ON COMMIT DROP"
+        )
+        await connection.copy_to_table(
+            "memory_import", source=copy_source(), columns=MEMORY_COLUMNS.split(", "), format="binary"
+        )
+        for group in groups:
+            await connection.execute(
+                """
+                INSERT INTO groups (chat_id, is_active, admin_ids, personality_prompt, created_at,
+                                    rate_limit_user_per_minute, rate_limit_chat_per_minute, retrieval_mode, model_tier,
+                                    burst_window_seconds)
+                VALUES ($1, $2, $3, $4, $5::TEXT::TIMESTAMPTZ, $6, $7, $8, $9, $10)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    is_active = EXCLUDED.is_active, admin_ids = EXCLUDED.admin_ids,
+                    personality_prompt = EXCLUDED.personality_prompt,
+                    rate_limit_user_per_minute = EXCLUDED.rate_limit_user_per_minute,
+                    rate_limit_chat_per_minute = EXCLUDED.rate_limit_chat_per_minute,
+                    retrieval_mode = EXCLUDED.retrieval_mode, model_tier = EXCLUDED.model_tier,
+                    burst_window_seconds = EXCLUDED.burst_window_seconds
+                """,
+                *(group.get(column) for column in GROUP_COLUMNS) # Files from older versions may lack newer columns
+            )
+            counts["groups"] += 1
+        # Cast to the live column type (vector or halfvec) and skip messages that already exist
+        column_type = await connection.fetchval(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = 'chat_memories'::regclass AND attname = 'embedding' AND NOT attisdropped"
+        )
+        result = await connection.execute(
+            f"INSERT INTO chat_memories ({MEMORY_COLUMNS}) "
+            f"SELECT chat_id, message_id, user_id, message_timestamp, COALESCE($1, bot_id), message_text, embedding_model, "
+            f"embedding::{column_type} FROM memory_import ON CONFLICT (bot_id, chat_id, message_id) DO NOTHING",
+            bot_id
+        )
+        counts["inserted"] = int(result.split()[-1])
+    return counts
+
+
+async def run(args):
+    await database.init_db_pool()
+    repo = database.repository
+    if not repo:
+        print("Database is not available.")
+        return
+    try:
+        began = time.perf_counter()
+        async with repo.connection() as connection:
+            if args.command == "export":
+                counts = await export_chats(connection, None if args.all else args.chat_id, args.output, args.bot_id)
+            else:
+                counts = await import_file(connection, args.path, args.bot_id)
+        elapsed = time.perf_counter() - began
+        print(f"{args.command} finished in {elapsed:.1f}s: {counts} "
+              f"({counts['memories'] / max(elapsed, 1e-9):.0f} memories/s)")
+    finally:
+        await database.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export/import chats' settings and memories.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("--chat-id", type=int, action="append")
+    export_parser.add_argument("--all", action="store_true")
+    export_parser.add_argument("-o", "--output", required=True)
+    export_parser.add_argument("--bot-id", type=int, help="Only this bot's memories (default: all bots)")
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--bot-id", type=int, help="Assign the memories to this bot (required for format 1 files)")
+    args = parser.parse_args()
+    if args.command == "export" and not (args.all or args.chat_id):
+        parser.error("export needs --chat-id or --all")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
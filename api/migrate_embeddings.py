@@ -0,0 +1,131 @@
+"""
+Online migration of chat_memories.embedding to a new dimension and/or storage type.
+
+text-embedding-3 vectors can be shortened by truncating and re-normalizing them, which
+matches what the API returns for the `dimensions` parameter. So existing rows are
+converted in the database with subvector() + l2_normalize(), with no re-embedding.
+
+Steps (run all at once, or one at a time with --step):
+    add       add the embedding_new column
+    backfill  fill embedding_new in small memory_id batches (resumable, short transactions)
+    index     build the HNSW index on embedding_new CONCURRENTLY
+    swap      under a brief lock: catch up new rows, drop the old column, rename the new one
+
+Required order, with replicas running throughout:
+    1. Run add, backfill and index. Live traffic keeps writing `embedding` at the old size.
+    2. Run swap. Each replica's next statement on the column is stale: Repository prepares it
+       again and reads the new column type, and from then on embeddings are shortened to the
+       column's dimensions before they are written or queried (database._fit_embedding). Calls
+       in flight at the swap may fail once.
+    3. Deploy the API with matching EMBEDDING_DIMENSIONS / EMBEDDING_STORAGE_TYPE, so embeddings
+       are requested at the new size. Setting them before the swap makes every write and query
+       fail until the swap, since a shorter embedding can't fit the old column.
+Shortening only works for models trained for it (text-embedding-3); others must be re-embedded
+with reembed_memories.py instead.
+
+Usage:
+    python -m api.migrate_embeddings --dimensions 512 --type halfvec [--batch-size 5000] [--step all]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from . import database
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+STEPS = ("add", "backfill", "index", "swap")
+STORAGE_TYPES = ("vector", "halfvec")
+
+def _convert_expr(storage_type: str, dimensions: int) -> str:
+    return f"l2_normalize(subvector(embedding::vector, 1, {dimensions}))::{storage_type}({dimensions})"
+
+async def add_column(connection, storage_type: str, dimensions: int):
+    await connection.execute(
+        f"ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS embedding_new {storage_type}({dimensions})"
+    )
+    print(f"Added column embedding_new {storage_type}({dimensions}).")
+
+async def backfill(connection, storage_type: str, dimensions: int, batch_size: int):
+    bounds = await connection.fetchrow("SELECT min(memory_id) AS lo, max(memory_id) AS hi FROM chat_memories")
+    if bounds["lo"] is None:
+        print("chat_memories is empty; nothing to backfill.")
+        return
+    convert = _convert_expr(storage_type, dimensions)
+    start, total, began = bounds["lo"] - 1, 0, time.perf_counter()
+    while start < bounds["hi"]:
+        end = start + batch_size
+        # Each batch commits on its own so row locks are held only briefly
+        result = await connection.execute(
+            f"UPDATE chat_memories SET embedding_new = {convert} "
+            f"WHERE memory_id > $1 AND memory_id <= $2 AND embedding_new IS NULL",
+            start, end
+        )
+        total += int(result.split()[-1])
+        elapsed = time.perf_counter() - began
+        print(f"Backfilled up to memory_id {end}: {total} rows ({total / max(elapsed, 1e-9):.0f} rows/s)")
+        start = end
+
+async def build_index(connection, storage_type: str):
+    began = time.perf_counter()
+    await connection.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_memories_embedding_new_hnsw "
+        f"ON chat_memories USING hnsw (embedding_new {storage_type}_cosine_ops) WITH (m = 16, ef_construction = 64)"
+    )
+    print(f"Built HNSW index on embedding_new in {time.perf_counter() - began:.1f}s.")
+
+async def swap(connection, storage_type: str, dimensions: int):
+    async with connection.transaction():
+        await connection.execute("LOCK TABLE chat_memories IN ACCESS EXCLUSIVE MODE")
+        # Rows written by live traffic since the backfill
+        result = await connection.execute(
+            f"UPDATE chat_memories SET embedding_new = {_convert_expr(storage_type, dimensions)} WHERE embedding_new IS NULL"
+        )
+        print(f"Caught up {result.split()[-1]} rows written during the backfill.")
+        await connection.execute("ALTER TABLE chat_memories DROP COLUMN embedding") # Also drops its index
+        await connection.execute("ALTER TABLE chat_memories RENAME COLUMN embedding_new TO embedding")
+        await connection.execute("ALTER TABLE chat_memories ALTER COLUMN embedding SET NOT NULL")
+        await connection.execute(
+            "ALTER INDEX idx_chat_memories_embedding_new_hnsw RENAME TO idx_chat_memories_embedding_hnsw"
+        )
+    print(f"Swapped: chat_memories.embedding is now {storage_type}({dimensions}). Now deploy the API with matching settings.")
+
+async def run(storage_type: str, dimensions: int, batch_size: int, step: str):
+    await database.init_db_pool()
+    repo = database.repository
+    if not repo:
+        print("Database is not available.")
+        return
+    try:
+        current = await repo.embedding_column_type()
+        print(f"Current column type: {current}")
+        async with repo.connection() as connection:
+            if step in ("all", "add"):
+                await add_column(connection, storage_type, dimensions)
+            if step in ("all", "backfill"):
+                await backfill(connection, storage_type, dimensions, batch_size)
+            if step in ("all", "index"):
+                await build_index(connection, storage_type)
+            if step in ("all", "swap"):
+                await swap(connection, storage_type, dimensions)
+    finally:
+        await database.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate chat_memories.embedding to a new dimension/storage type.")
+    parser.add_argument("--dimensions", type=int, default=settings.EMBEDDING_DIMENSIONS if settings else None)
+    parser.add_argument("--type", dest="storage_type", choices=STORAGE_TYPES,
+                        default=settings.EMBEDDING_STORAGE_TYPE if settings else "vector")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--step", choices=("all",) + STEPS, default="all")
+    args = parser.parse_args()
+    if not args.dimensions:
+        parser.error("--dimensions is required (or set EMBEDDING_DIMENSIONS)")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args.storage_type, args.dimensions, args.batch_size, args.step))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import logging
+import math
+import re
+import time
+from typing import Optional
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Tiers in ascending cost. A group can pin one with /set_model; NULL means automatic routing.
+TIER_FAST = "fast"
+TIER_DEFAULT = "default"
+TIER_LARGE = "large"
+TIERS = (TIER_FAST, TIER_DEFAULT, TIER_LARGE)
+
+# Cheap local classifier inputs
+_MENTION_OR_URL = re.compile(r"@\w+|https?://\S+")
+_SMALL_TALK = re.compile(
+    r"^(gm|gn|gg|hi+|hey+|hello+|yo+|sup|thanks?|thx|ty|lol+|lmao|haha+|ok(ay)?|k|nice|cool|wow|"
+    r"good (morning|night|evening)|wagmi|ngmi|\W*)[\s!.?\W]*$",
+    re.IGNORECASE,
+)
+_COMPLEX_WORDS = re.compile(
+    r"\b(explain|why|how (do|does|can|would|should|to)|compare|difference|analy[sz]e|summari[sz]e|"
+    r"step[- ]by[- ]step|pros and cons|write|code|debug|calculate|plan|strategy|translate)\b",
+    re.IGNORECASE,
+)
+
+
+class Route:
+    __slots__ = ("tier", "model", "max_tokens", "reason")
+
+    def __init__(self, tier: str, model: str, max_tokens: int, reason: str):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.reason = reason
+
+
+def classify(message_text: str, context_chars: int = 0) -> tuple[str, str]:
+    """Heuristically picks a tier for a message. Returns (tier, reason)."""
+    text = _MENTION_OR_URL.sub("", message_text or "").strip()
+    if _SMALL_TALK.match(text):
+        return TIER_FAST, "small talk"
+    if len(text) <= settings.LLM_ROUTING_SHORT_MESSAGE_CHARS and "?" not in text:
+        return TIER_FAST, "short message"
+
+    score, reasons = 0, []
+    if len(text) >= settings.LLM_ROUTING_LONG_MESSAGE_CHARS:
+        score += 2
+        reasons.append("long message")
+    if "```" in text or text.count("`") >= 2:
+        score += 2
+        reasons.append("code")
+    complex_words = len(_COMPLEX_WORDS.findall(text))
+    if complex_words:
+        score += min(complex_words, 2)
+        reasons.append("complex ask")
+    if text.count("?") >= 2:
+        score += 1
+        reasons.append("several questions")
+    if context_chars >= settings.LLM_ROUTING_LARGE_CONTEXT_CHARS:
+        score += 1
+        reasons.append("large context")
+    if score >= 2:
+        return TIER_LARGE, ", ".join(reasons)
+    return TIER_DEFAULT, ", ".join(reasons) or "default"
+
+
+class ModelHealth:
+    """
+    Per-model latency and error-rate EWMAs. Both decay towards zero with
+    LLM_ROUTING_STATS_HALF_LIFE_SECONDS while a model gets no traffic, so a model
+    that was avoided is retried eventually.
+    """
+
+    __slots__ = ("latency", "error_rate", "updated_at", "calls", "errors")
+
+    def __init__(self):
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.updated_at = time.monotonic()
+        self.calls = 0
+        self.errors = 0
+
+    def _decay(self, now: float) -> float:
+        half_life = settings.LLM_ROUTING_STATS_HALF_LIFE_SECONDS
+        return math.exp(-math.log(2) * (now - self.updated_at) / half_life) if half_life > 0 else 1.0
+
+    def record(self, latency: float, ok: bool):
+        now = time.monotonic()
+        decay = self._decay(now)
+        self.latency = 0.8 * self.latency * decay + 0.2 * latency
+        self.error_rate = 0.8 * self.error_rate * decay + (0.0 if ok else 0.2)
+        self.updated_at = now
+        self.calls += 1
+        self.errors += 0 if ok else 1
+
+    def current(self) -> tuple[float, float]:
+        decay = self._decay(time.monotonic())
+        return self.latency * decay, self.error_rate * decay
+
+    def healthy(self) -> bool:
+        latency, error_rate = self.current()
+        return latency <= settings.LLM_ROUTING_LATENCY_BUDGET_SECONDS and error_rate <= settings.LLM_ROUTING_MAX_ERROR_RATE
+
+
+health: dict[str, ModelHealth] = {}
+route_counts: dict[str, int] = {tier: 0 for tier in TIERS}
+fallback_count = 0
+
+def _tier_config(tier: str) -> tuple[str, int]:
+    if tier == TIER_FAST:
+        return settings.LLM_FAST_MODEL, settings.LLM_FAST_MAX_TOKENS
+    if tier == TIER_LARGE:
+        return settings.LLM_LARGE_MODEL, settings.LLM_LARGE_MAX_TOKENS
+    return settings.LLM_MODEL, settings.LLM_MAX_TOKENS
+
+def _healthy(model: str) -> bool:
+    stats = health.get(model)
+    return stats is None or stats.healthy()
+
+def route(messages: list[dict[str, str]], group_tier: Optional[str] = None,
+          burst_texts: Optional[list[str]] = None) -> Route:
+    """
+    Picks model and max_tokens for a chat completion. The last message is the user's
+    message; everything before it counts as context. A tier pinned by the group skips
+    the classifier. For a burst reply, `burst_texts` are the combined messages: each is
+    classified on its own and the most demanding tier wins, so neither the instructions
+    wrapping them nor their combined length count as one long message. If the chosen
+    tier's model is slow or failing, the next cheaper healthy tier is used instead.
+    """
+    global fallback_count
+    if group_tier in TIERS:
+        tier, reason = group_tier, "group setting"
+    elif burst_texts:
+        tier, reason = max((classify(text) for text in burst_texts), key=lambda result: TIERS.index(result[0]))
+        reason = f"burst of {len(burst_texts)}, {reason}"
+    else:
+        context_chars = sum(len(m.get("content") or "") for m in messages[:-1])
+        tier, reason = classify(messages[-1].get("content", "") if messages else "", context_chars)
+
+    chosen = tier
+    for candidate in reversed(TIERS[:TIERS.index(tier) + 1]):
+        if _healthy(_tier_config(candidate)[0]):
+            chosen = candidate
+            break
+    if chosen != tier:
+        fallback_count += 1
+        reason = f"{reason}; {_tier_config(tier)[0]} unhealthy"
+    elif not _healthy(_tier_config(tier)[0]):
+        reason = f"{reason}; no healthy fallback"
+
+    route_counts[chosen] += 1
+    model, max_tokens = _tier_config(chosen)
+    logger.debug("Routed to %s tier (%s, max_tokens=%s): %s", chosen, model, max_tokens, reason)
+    return Route(chosen, model, max_tokens, reason)
+
+def record(model: str, latency: float, ok: bool):
+    """Feeds an LLM call outcome back into the model's health stats."""
+    stats = health.get(model)
+    if stats is None:
+        stats = health[model] = ModelHealth()
+    stats.record(latency, ok)
+
+def stats() -> dict:
+    models = {}
+    for model, model_health in health.items():
+        latency, error_rate = model_health.current()
+        models[model] = {
+            "latency_ewma_s": round(latency, 3),
+            "error_rate_ewma": round(error_rate, 3),
+            "healthy": model_health.healthy(),
+            "calls": model_health.calls,
+            "errors": model_health.errors,
+        }
+    return {"enabled": bool(settings and settings.LLM_ROUTING_ENABLED), "routes": dict(route_counts),
+            "fallbacks": fallback_count, "models": models}
@@ -0,0 +1,167 @@
+"""
+Persona prompt cache for /set_personality.
+
+Popular descriptions ("pirate", "degen trader") are requested in many groups, so generated prompts
+are cached by (normalized description, model):
+
+1. PERSONA_LIBRARY: hand-written prompts for common personas, used with no LLM call or DB round trip.
+2. An in-process LRU of recently generated prompts.
+3. The persona_prompts table, shared by all replicas and kept across restarts.
+4. The LLM. Concurrent requests for the same key in this process share one generation.
+
+Failed generations are not cached, so the next request tries again.
+"""
+
+import asyncio
+import logging
+import re
+from collections import OrderedDict
+from typing import Optional
+
+# Import settings
+from .config import settings
+from . import database
+from . import llm_service
+from . import usage_accounting
+
+logger = logging.getLogger(__name__)
+
+# Pre-generated personas, keyed by normalized description (see normalize_description)
+PERSONA_LIBRARY: dict[str, str] = {
+    "pirate": (
+        "You are a salty, good-humoured pirate captain hanging out in a Telegram group. Speak in pirate slang "
+        "(\"arr\", \"matey\", \"ye\"), refer to the chat as your crew and to questions as treasure hunts. "
+        "Keep replies short and playful, but still answer questions correctly and helpfully underneath the accent. "
+        "Never be cruel; tease gently, and drop the act briefly if someone needs a clear or serious answer."
+    ),
+    "degen trader": (
+        "You are a hyped-up crypto degen trader in a Telegram group. Talk in trader slang (\"wagmi\", \"ngmi\", "
+        "\"aping in\", \"ser\", \"few understand\"), celebrate green candles and mourn red ones with drama. "
+        "Keep replies short and punchy. Joke about risk, but never give real financial advice: when asked for it, "
+        "remind people to do their own research and never to bet more than they can afford to lose."
+    ),
+    "sarcastic": (
+        "You are a dry, sarcastic member of a Telegram group. Answer questions correctly, but with deadpan wit, "
+        "understatement and the occasional eye-roll. Keep replies brief. Aim the sarcasm at situations, never at "
+        "people's looks, identity or real problems, and drop it when someone is genuinely upset or asks for help "
+        "with something serious."
+    ),
+    "helpful assistant": (
+        "You are a friendly, knowledgeable assistant in a Telegram group chat. Give clear, accurate and concise "
+        "answers, ask a short clarifying question when a request is ambiguous, and admit when you don't know "
+        "something. Match the group's language and tone, keep replies short enough for a chat, and use plain "
+        "text rather than heavy formatting."
+    ),
+    "hype man": (
+        "You are the group's over-the-top hype man. Meet every message with big energy, encouragement and "
+        "celebration, in short replies with the occasional emoji. Cheer people on, turn small wins into big "
+        "moments and keep the mood upbeat, while still giving real answers when someone asks a question."
+    ),
+    "philosopher": (
+        "You are a thoughtful philosopher taking part in a Telegram group. Answer questions directly first, then "
+        "add a brief reflective angle, a relevant thinker or a question that invites the group to think further. "
+        "Stay concise and approachable, avoid jargon, and never lecture; the goal is good conversation."
+    ),
+    "shakespeare": (
+        "You are William Shakespeare, somehow a member of a Telegram group. Reply in playful Early Modern English "
+        "(\"thou\", \"hath\", \"prithee\"), with the odd flourish of verse or a well-placed insult from the plays, "
+        "aimed only in jest. Keep replies short, and make sure the actual answer to any question is still clear."
+    ),
+}
+
+_ARTICLE = re.compile(r"^(?:a|an|the)\s+")
+
+def normalize_description(description: str) -> str:
+    """Case, spacing, surrounding quotes/punctuation and a leading article don't change the persona."""
+    key = " ".join(description.casefold().split())
+    key = key.strip(" \"'`.!?,;:")
+    return _ARTICLE.sub("", key)
+
+def library_names() -> list[str]:
+    return sorted(PERSONA_LIBRARY)
+
+
+class PersonaCache:
+    """Resolves persona prompts through the library, an LRU of `max_entries` prompts, the database and the LLM."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._prompts: "OrderedDict[tuple[str, str], str]" = OrderedDict()
+        self._in_flight: dict[tuple[str, str], asyncio.Task] = {}
+        self.library_hits = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.shared_generations = 0 # Requests that joined a generation already in flight
+        self.generations = 0
+
+    def _remember(self, key: tuple[str, str], prompt: str):
+        self._prompts[key] = prompt
+        self._prompts.move_to_end(key)
+        while len(self._prompts) > self.max_entries:
+            self._prompts.popitem(last=False)
+
+    async def get_prompt(self, description: str, model: Optional[str] = None) -> Optional[str]:
+        """Returns the persona prompt for a description, generating it only if nothing is cached. None on failure."""
+        description_key = normalize_description(description)
+        library_prompt = PERSONA_LIBRARY.get(description_key)
+        if library_prompt:
+            self.library_hits += 1
+            usage_accounting.record_cache_hit()
+            return library_prompt
+
+        if not settings or not settings.PERSONA_CACHE_ENABLED:
+            return await llm_service.generate_persona_prompt(user_description=description, model=model)
+
+        key = (description_key, model or settings.LLM_MODEL)
+        prompt = self._prompts.get(key)
+        if prompt is not None:
+            self._prompts.move_to_end(key)
+            self.memory_hits += 1
+            usage_accounting.record_cache_hit()
+            return prompt
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.create_task(self._load(key, description))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.shared_generations += 1
+            usage_accounting.record_cache_hit()
+        # Shielded so a caller going away doesn't cancel the generation others are waiting for
+        return await asyncio.shield(task)
+
+    async def _load(self, key: tuple[str, str], description: str) -> Optional[str]:
+        description_key, model = key
+        prompt = await database.get_persona_prompt(description_key, model)
+        if prompt:
+            self.db_hits += 1
+            logger.debug("Persona prompt for '%.50s' loaded from the database.", description_key)
+        else:
+            self.generations += 1
+            prompt = await llm_service.generate_persona_prompt(user_description=description, model=model)
+            if not prompt:
+                return None
+            await database.save_persona_prompt(description_key, model, prompt)
+        self._remember(key, prompt)
+        return prompt
+
+    def warm(self, rows: list) -> int:
+        """Preloads (description_key, model, prompt) rows, e.g. the most used prompts in persona_prompts."""
+        for description_key, model, prompt in rows:
+            if (description_key, model) not in self._prompts and len(self._prompts) < self.max_entries:
+                self._prompts[(description_key, model)] = prompt
+        return len(self._prompts)
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._prompts),
+            "in_flight": len(self._in_flight),
+            "library_hits": self.library_hits,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "shared_generations": self.shared_generations,
+            "generations": self.generations,
+        }
+
+
+cache = PersonaCache(max_entries=settings.PERSONA_CACHE_MAX_ENTRIES if settings else 1000)
@@ -0,0 +1,136 @@
+import logging
+import time
+from typing import Optional, Dict, Tuple, Any
+
+# Import settings
+from .config import settings
+# Import database functions (shared bucket mode)
+from . import database
+
+logger = logging.getLogger(__name__)
+
+# --- Token Buckets ---
+
+class TokenBucketLimiter:
+    """
+    In-process token buckets keyed by arbitrary hashable keys.
+
+    Each bucket holds up to `capacity` tokens and refills continuously at
+    `refill_per_minute`. Buckets are stored as [tokens, last_refill, capacity,
+    refill_per_second] lists (the limits of their last use, since user and chat
+    buckets and per-group overrides differ) and idle (full) buckets are pruned
+    once more than `max_keys` are tracked.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: Dict[Any, list] = {}
+
+    def _refilled(self, bucket: list, capacity: float, refill_per_second: float, now: float) -> float:
+        return min(capacity, bucket[0] + (now - bucket[1]) * refill_per_second)
+
+    def peek(self, key: Any, capacity: float, refill_per_minute: float, now: Optional[float] = None) -> bool:
+        """Returns True if the bucket currently has a token, without consuming it."""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return capacity >= 1
+        return self._refilled(bucket, capacity, refill_per_minute / 60.0, now) >= 1
+
+    def consume(self, key: Any, capacity: float, refill_per_minute: float, now: Optional[float] = None) -> bool:
+        """Takes one token if available. Returns True if the request is allowed."""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = [float(capacity), now, 0.0, 0.0]
+        tokens = self._refilled(bucket, capacity, refill_per_minute / 60.0, now)
+        bucket[1] = now
+        bucket[2] = capacity
+        bucket[3] = refill_per_minute / 60.0
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        bucket[0] = tokens
+        return False
+
+    def _prune(self, now: float):
+        """Drops buckets that would be full by now under their own limits; they are indistinguishable from new ones."""
+        before = len(self._buckets)
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if self._refilled(bucket, bucket[2], bucket[3], now) < bucket[2]
+        }
+        logger.debug("Pruned rate limit buckets: %s -> %s", before, len(self._buckets))
+
+
+limiter = TokenBucketLimiter(max_keys=settings.RATE_LIMIT_MAX_TRACKED_KEYS if settings else 100_000)
+
+# (bot_id, chat_id, user_id) that have already been told to cool down in the current throttle episode.
+# Denials by the chat bucket use user_id 0, so a raid gets one notice per chat rather than one per user.
+_notified: Dict[Tuple[int, int, int], float] = {}
+
+def _limits_for_group(group_record) -> Tuple[float, float]:
+    """Returns (user_per_minute, chat_per_minute), honoring per-group overrides from the groups table."""
+    user_rate = settings.RATE_LIMIT_USER_PER_MINUTE
+    chat_rate = settings.RATE_LIMIT_CHAT_PER_MINUTE
+    if group_record is not None:
+        user_rate = group_record.get("rate_limit_user_per_minute") or user_rate
+        chat_rate = group_record.get("rate_limit_chat_per_minute") or chat_rate
+    return float(user_rate), float(chat_rate)
+
+async def _consume_shared(key: str, capacity: float, refill_per_minute: float) -> bool:
+    """Consumes a token from the Postgres-backed bucket, falling back to the local one on DB errors."""
+    allowed = await database.consume_rate_limit_token(key, capacity, refill_per_minute / 60.0)
+    if allowed is None:
+        return limiter.consume(key, capacity, refill_per_minute)
+    return allowed
+
+async def check_rate_limit(chat_key: Tuple[int, int], user_id: Optional[int], group_record=None) -> Tuple[bool, bool]:
+    """
+    Checks and consumes the per-user and per-chat buckets for a triggered message.
+    `chat_key` is (bot_id, chat_id), so each hosted bot has its own limits in a chat.
+
+    Returns (allowed, send_notice). send_notice is True only for the first throttled
+    message of a user's throttle episode, so spammers get a single cooldown notice, or
+    of the chat's episode when the chat bucket is what denied it.
+    """
+    if not settings or not settings.RATE_LIMIT_ENABLED:
+        return True, False
+
+    user_rate, chat_rate = _limits_for_group(group_record)
+    user_capacity = float(settings.RATE_LIMIT_USER_BURST)
+    chat_capacity = float(settings.RATE_LIMIT_CHAT_BURST)
+    bot_id, chat_id = chat_key
+    user_key = (bot_id, chat_id, user_id or 0)
+    chat_notice_key = (bot_id, chat_id, 0)
+
+    if settings.RATE_LIMIT_SHARED:
+        # Shared mode: buckets live in Postgres so all replicas see the same counts.
+        # The user bucket is consumed first; a chat-level denial after that costs the user one token.
+        user_ok = await _consume_shared(f"u:{bot_id}:{chat_id}:{user_id or 0}", user_capacity, user_rate)
+        chat_ok = user_ok and await _consume_shared(f"c:{bot_id}:{chat_id}", chat_capacity, chat_rate)
+    else:
+        now = time.monotonic()
+        # Check both buckets before consuming so a chat-level denial doesn't cost the user a token
+        user_ok = limiter.peek(user_key, user_capacity, user_rate, now)
+        chat_ok = user_ok and limiter.peek(chat_key, chat_capacity, chat_rate, now)
+        if chat_ok:
+            limiter.consume(user_key, user_capacity, user_rate, now)
+            limiter.consume(chat_key, chat_capacity, chat_rate, now)
+
+    if chat_ok:
+        _notified.pop(user_key, None)
+        _notified.pop(chat_notice_key, None)
+        return True, False
+
+    notice_key = user_key if not user_ok else chat_notice_key
+    send_notice = notice_key not in _notified
+    if send_notice:
+        if len(_notified) >= limiter.max_keys:
+            _notified.clear()
+        _notified[notice_key] = time.monotonic()
+    logger.info("Rate limited user %s in chat %s by the %s bucket (notice: %s).",
+                user_id, chat_id, "user" if not user_ok else "chat", send_notice)
+    return False, send_notice
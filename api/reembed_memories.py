@@ -0,0 +1,204 @@
+"""
+Resumable re-embedding of chat_memories with the current (or a given) embedding model.
+
+Streams rows whose embedding_model differs from the target with a server-side cursor
+ordered by memory_id, embeds them in large batched API calls with at most --concurrency
+calls in flight, and writes results back with one executemany per batch. Progress is
+checkpointed to a JSON file as the highest memory_id below which every batch is written,
+so an interrupted run resumes where it left off.
+
+Live webhook traffic is unaffected: each batch commits on its own, the cursor is reopened
+every --cursor-rows rows so no transaction stays open for long, and --max-rows-per-second
+can cap the load.
+
+Usage:
+    python -m api.reembed_memories [--model text-embedding-3-small] [--dimensions 512]
+                                   [--batch-size 256] [--concurrency 4] [--checkpoint reembed.checkpoint.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from . import database
+from . import llm_service
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+STREAM_QUERY = """
+    SELECT memory_id, message_text FROM chat_memories
+    WHERE memory_id > $1 AND embedding_model IS DISTINCT FROM $2
+    ORDER BY memory_id
+    LIMIT $3
+"""
+UPDATE_QUERY = "UPDATE chat_memories SET embedding = $2, embedding_model = $3 WHERE memory_id = $1"
+
+MAX_RETRIES = 5
+
+def load_checkpoint(path: str, model: str) -> dict:
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("model") == model:
+            return checkpoint
+        print(f"Checkpoint {path} is for model {checkpoint.get('model')}; starting over for {model}.")
+    return {"model": model, "last_memory_id": 0, "rows_done": 0}
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path) # Atomic, so a crash never leaves a truncated checkpoint
+
+
+class Reembedder:
+    def __init__(self, repo, model: str, dimensions: int | None, batch_size: int, concurrency: int,
+                 checkpoint_path: str, max_rows_per_second: float | None):
+        self.repo = repo
+        self.model = model
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = load_checkpoint(checkpoint_path, model)
+        self.max_rows_per_second = max_rows_per_second
+        # Batches in read order: [last_memory_id, row_count, done]
+        self.in_order: deque = deque()
+        self.failure: Exception | None = None
+        self.started = time.perf_counter()
+        self.rows_this_run = 0
+        self.last_report = 0.0
+
+    async def _embed_with_retries(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(MAX_RETRIES):
+            embeddings = await llm_service.get_embeddings(texts, model=self.model, dimensions=self.dimensions)
+            if embeddings is not None:
+                return embeddings
+            delay = 2 ** attempt
+            logger.warning(f"Embedding batch failed (attempt {attempt + 1}/{MAX_RETRIES}); retrying in {delay}s.")
+            await asyncio.sleep(delay)
+        raise RuntimeError(f"Embedding batch failed after {MAX_RETRIES} attempts.")
+
+    async def _process(self, entry: list, rows: list):
+        try:
+            embeddings = await self._embed_with_retries([row["message_text"] for row in rows])
+            async with self.repo.connection() as connection:
+                await connection.executemany(
+                    UPDATE_QUERY,
+                    [(row["memory_id"], embedding, self.model) for row, embedding in zip(rows, embeddings)]
+                )
+            entry[2] = True
+            self.rows_this_run += len(rows)
+            self._advance_checkpoint()
+        except Exception as e:
+            self.failure = self.failure or e
+        finally:
+            self.semaphore.release()
+
+    def _advance_checkpoint(self):
+        """Moves the checkpoint past every leading batch that has been written."""
+        advanced = False
+        while self.in_order and self.in_order[0][2]:
+            last_id, count, _ = self.in_order.popleft()
+            self.checkpoint["last_memory_id"] = last_id
+            self.checkpoint["rows_done"] += count
+            advanced = True
+        if advanced:
+            save_checkpoint(self.checkpoint_path, self.checkpoint)
+        now = time.perf_counter()
+        if now - self.last_report >= 5:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"{self.rows_this_run} rows this run ({self.rows_this_run / max(elapsed, 1e-9):.0f} rows/s), "
+              f"{self.checkpoint['rows_done']} total, checkpoint memory_id {self.checkpoint['last_memory_id']}")
+
+    async def _throttle(self):
+        if self.max_rows_per_second:
+            expected = self.rows_this_run / self.max_rows_per_second
+            ahead = expected - (time.perf_counter() - self.started)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+    async def run(self, cursor_rows: int):
+        print(f"Re-embedding with {self.model} (dimensions={self.dimensions or 'default'}) "
+              f"from memory_id > {self.checkpoint['last_memory_id']}")
+        read_from = self.checkpoint["last_memory_id"]
+        tasks = set()
+        while self.failure is None:
+            fetched = 0
+            batch: list = []
+            # A short read-only transaction per cursor window keeps vacuum and live writes unaffected
+            async with self.repo.connection() as connection:
+                async with connection.transaction(readonly=True):
+                    async for row in connection.cursor(STREAM_QUERY, read_from, self.model, cursor_rows,
+                                                       prefetch=self.batch_size):
+                        batch.append(row)
+                        fetched += 1
+                        read_from = row["memory_id"]
+                        if len(batch) >= self.batch_size:
+                            tasks.add(await self._dispatch(batch))
+                            batch = []
+                        if self.failure is not None:
+                            break
+            if batch and self.failure is None:
+                tasks.add(await self._dispatch(batch))
+            tasks = {t for t in tasks if not t.done()}
+            if fetched < cursor_rows:
+                break
+        if tasks:
+            await asyncio.gather(*tasks)
+        self.report()
+        if self.failure is not None:
+            raise self.failure
+        print("Re-embedding complete.")
+
+    async def _dispatch(self, rows: list) -> asyncio.Task:
+        await self._throttle()
+        await self.semaphore.acquire() # Caps concurrent embedding calls (and writer connections)
+        entry = [rows[-1]["memory_id"], len(rows), False]
+        self.in_order.append(entry)
+        return asyncio.create_task(self._process(entry, rows))
+
+
+async def run(args):
+    await database.init_db_pool()
+    repo = database.repository
+    if not repo:
+        print("Database is not available.")
+        return
+    try:
+        reembedder = Reembedder(
+            repo, args.model, args.dimensions, args.batch_size, args.concurrency,
+            args.checkpoint, args.max_rows_per_second
+        )
+        await reembedder.run(args.cursor_rows)
+    finally:
+        await database.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed chat_memories with a new embedding model.")
+    parser.add_argument("--model", default=settings.EMBEDDING_MODEL if settings else "text-embedding-3-small")
+    parser.add_argument("--dimensions", type=int, default=settings.EMBEDDING_DIMENSIONS if settings else None)
+    parser.add_argument("--batch-size", type=int, default=256, help="Texts per embeddings API call (max 2048)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embedding calls in flight")
+    parser.add_argument("--cursor-rows", type=int, default=50_000, help="Rows read per cursor transaction")
+    parser.add_argument("--max-rows-per-second", type=float, default=None)
+    parser.add_argument("--checkpoint", default="reembed.checkpoint.json")
+    args = parser.parse_args()
+    if settings and args.concurrency >= settings.DB_POOL_MAX_SIZE:
+        parser.error(f"--concurrency must be below DB_POOL_MAX_SIZE ({settings.DB_POOL_MAX_SIZE}); one connection streams rows")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
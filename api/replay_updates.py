@@ -0,0 +1,212 @@
+"""
+Replays a capture of Telegram updates (see update_capture.py) against /api/webhook to
+test capacity before an event.
+
+Arrival schedule, one of:
+    --speed N        original inter-arrival times divided by N (2 = twice as fast)
+    --curve SPEC     a rate curve of "seconds:updates_per_second" points, linearly
+                     interpolated, e.g. "0:5,60:200,300:200,360:5" for a launch spike.
+                     The capture is cycled as often as needed to fill the curve.
+
+Every replayed update gets a fresh update_id, and its message date is set to the send time
+(unless --keep-dates), so queue age and load shedding behave as in production. When the
+capture is cycled, message_ids are offset per cycle so memory rows don't collide.
+Replies go to whatever bot token the target API runs with, so point this at a staging
+deployment with a test bot, never production.
+
+Reports achieved throughput, latency percentiles, errors, the webhook's response details
+(e.g. how many requests were rate limited or shed) and how far the sender fell behind schedule.
+
+Usage:
+    python -m api.replay_updates capture.jsonl.gz [--url http://localhost:8000/api/webhook]
+                                 (--speed 10 | --curve 0:5,60:200,300:200) [--concurrency 200] [--limit N]
+"""
+
+import argparse
+import asyncio
+import copy
+import time
+from collections import Counter
+from typing import Iterator
+
+import httpx
+
+from .update_capture import read_capture
+
+PROGRESS_INTERVAL_SECONDS = 5.0
+_CURVE_STEP_SECONDS = 0.001
+
+def parse_curve(spec: str) -> list[tuple[float, float]]:
+    points = []
+    for item in spec.split(","):
+        at, rate = item.split(":")
+        points.append((float(at), float(rate)))
+    points.sort()
+    if len(points) < 2 or points[0][0] != 0:
+        raise ValueError("a curve needs at least two points, starting at 0 seconds")
+    return points
+
+def curve_arrivals(points: list[tuple[float, float]]) -> Iterator[float]:
+    """Yields arrival offsets (seconds) whose rate follows the piecewise-linear curve."""
+    pending = 0.0
+    for (t0, r0), (t1, r1) in zip(points, points[1:]):
+        t = t0
+        while t < t1:
+            rate = r0 + (r1 - r0) * (t - t0) / (t1 - t0)
+            pending += rate * _CURVE_STEP_SECONDS
+            while pending >= 1.0:
+                pending -= 1.0
+                yield t
+            t += _CURVE_STEP_SECONDS
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Replay:
+    def __init__(self, url: str, concurrency: int, keep_dates: bool):
+        self.url = url
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.keep_dates = keep_dates
+        self.update_id = int(time.time() * 1000) # Unique across runs
+        self.sent = 0
+        self.completed = 0
+        self.latencies_ms: list[float] = []
+        self.errors: Counter = Counter()
+        self.details: Counter = Counter()
+        self.max_lag = 0.0
+        self.started = 0.0
+
+    def _prepare(self, update: dict, cycle: int, message_id_span: int) -> dict:
+        update = copy.deepcopy(update)
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+            message = update.get(key)
+            if message:
+                if cycle and "message_id" in message:
+                    message["message_id"] += cycle * message_id_span
+                if not self.keep_dates:
+                    message["date"] = int(time.time())
+        return update
+
+    async def _send(self, client: httpx.AsyncClient, update: dict):
+        start = time.perf_counter()
+        try:
+            response = await client.post(self.url, json=update)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if response.status_code >= 400:
+                self.errors[f"HTTP {response.status_code}"] += 1
+            else:
+                self.latencies_ms.append(elapsed_ms)
+                try:
+                    self.details[response.json().get("detail", "ok")] += 1
+                except ValueError:
+                    self.details["non-JSON response"] += 1
+        except httpx.HTTPError as e:
+            self.errors[type(e).__name__] += 1
+        finally:
+            self.completed += 1
+            self.semaphore.release()
+
+    async def run(self, schedule: Iterator[tuple[float, dict, int]], message_id_span: int):
+        tasks = set()
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0), limits=limits) as client:
+            progress = asyncio.create_task(self._progress())
+            self.started = time.perf_counter()
+            for offset, update, cycle in schedule:
+                delay = self.started + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.semaphore.acquire() # Bounded in flight; waiting here shows up as lag
+                self.max_lag = max(self.max_lag, time.perf_counter() - (self.started + offset))
+                task = asyncio.create_task(self._send(client, self._prepare(update, cycle, message_id_span)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                self.sent += 1
+            if tasks:
+                await asyncio.gather(*tasks)
+            progress.cancel()
+        self.report()
+
+    async def _progress(self):
+        last_completed, last_time = 0, time.perf_counter()
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+            now = time.perf_counter()
+            rate = (self.completed - last_completed) / (now - last_time)
+            recent = sorted(self.latencies_ms[-1000:])
+            print(f"[{now - self.started:6.0f}s] sent {self.sent}, done {self.completed}, "
+                  f"in flight {self.sent - self.completed}, {rate:.1f} req/s, "
+                  f"p95 {_percentile(recent, 0.95):.0f} ms, errors {sum(self.errors.values())}")
+            last_completed, last_time = self.completed, now
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(self.latencies_ms)
+        print(f"\nSent {self.sent} updates in {elapsed:.1f}s: {self.completed / max(elapsed, 1e-9):.1f} req/s achieved")
+        print(f"OK {len(latencies)}, errors {sum(self.errors.values())}, max schedule lag {self.max_lag * 1000:.0f} ms")
+        print("Latency ms: " + ", ".join(
+            f"p{int(q * 100)} {_percentile(latencies, q):.0f}" for q in (0.5, 0.9, 0.95, 0.99)
+        ) + f", max {latencies[-1] if latencies else 0:.0f}")
+        for error, count in self.errors.most_common():
+            print(f"  error {error}: {count}")
+        for detail, count in self.details.most_common(10):
+            print(f"  response '{detail}': {count}")
+
+
+def load_capture(path: str, limit: int | None) -> list[tuple[float, dict]]:
+    records = []
+    for received_at, update in read_capture(path):
+        records.append((received_at, update))
+        if limit and len(records) >= limit:
+            break
+    records.sort(key=lambda record: record[0])
+    return records
+
+def speed_schedule(records: list, speed: float) -> Iterator[tuple[float, dict, int]]:
+    first = records[0][0]
+    for received_at, update in records:
+        yield (received_at - first) / speed, update, 0
+
+def curve_schedule(records: list, points: list) -> Iterator[tuple[float, dict, int]]:
+    for i, offset in enumerate(curve_arrivals(points)):
+        cycle, index = divmod(i, len(records))
+        yield offset, records[index][1], cycle
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured Telegram updates against the webhook.")
+    parser.add_argument("capture", help="gzip JSONL capture file")
+    parser.add_argument("--url", default="http://localhost:8000/api/webhook")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--speed", type=float, help="Replay at N times the captured arrival rate")
+    mode.add_argument("--curve", help='Arrival rate curve, "seconds:updates_per_second,..."')
+    parser.add_argument("--concurrency", type=int, default=200, help="Max requests in flight")
+    parser.add_argument("--limit", type=int, default=None, help="Use only the first N captured updates")
+    parser.add_argument("--keep-dates", action="store_true", help="Keep captured message dates")
+    args = parser.parse_args()
+
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        parser.error("the capture file contains no updates")
+    if args.curve:
+        try:
+            schedule = curve_schedule(records, parse_curve(args.curve))
+        except ValueError as e:
+            parser.error(f"invalid --curve: {e}")
+    else:
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+        schedule = speed_schedule(records, args.speed)
+    message_ids = [u[key]["message_id"] for _, u in records
+                   for key in ("message", "edited_message", "channel_post", "edited_channel_post")
+                   if isinstance(u.get(key), dict) and "message_id" in u[key]]
+    message_id_span = max(message_ids, default=0) + 1
+    print(f"Replaying {len(records)} captured updates against {args.url}")
+    asyncio.run(Replay(args.url, args.concurrency, args.keep_dates).run(schedule, message_id_span))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,698 @@
+import logging
+import re
+import struct
+import time
+from typing import Optional, List, Dict, Any, Iterable, TYPE_CHECKING
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+if TYPE_CHECKING:
+    import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# --- Statements ---
+
+# Group setting changes are broadcast on this channel so every replica can drop its cached copy.
+# The notify_group_change trigger on groups (schema.sql) sends them, so manual SQL changes are covered too.
+GROUP_INVALIDATION_CHANNEL = "group_settings_changed"
+
+# Hot statements, prepared once per pooled connection in the pool `init` hook.
+# Keep parameters positional and typed so each statement has a single stable plan.
+STATEMENTS: Dict[str, str] = {
+    "get_group": """
+        SELECT chat_id, is_active, admin_ids, created_at, updated_at,
+               rate_limit_user_per_minute, rate_limit_chat_per_minute, retrieval_mode, model_tier, burst_window_seconds
+        FROM groups WHERE chat_id = $1
+    """,
+    "insert_group": """
+        INSERT INTO groups (chat_id) VALUES ($1)
+        ON CONFLICT (chat_id) DO NOTHING
+        RETURNING chat_id, is_active, admin_ids, created_at, updated_at,
+                  rate_limit_user_per_minute, rate_limit_chat_per_minute, retrieval_mode, model_tier, burst_window_seconds
+    """,
+    "get_groups": """
+        SELECT chat_id, is_active, admin_ids, created_at, updated_at,
+               rate_limit_user_per_minute, rate_limit_chat_per_minute, retrieval_mode, model_tier, burst_window_seconds
+        FROM groups WHERE chat_id = ANY($1::BIGINT[])
+    """,
+    "set_group_activity": """
+        UPDATE groups SET is_active = $1 WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "set_group_retrieval_mode": """
+        UPDATE groups SET retrieval_mode = $1 WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "set_group_model_tier": """
+        UPDATE groups SET model_tier = $1 WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "set_group_burst_window": """
+        UPDATE groups SET burst_window_seconds = $1 WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "get_group_admins": """
+        SELECT admin_ids FROM groups WHERE chat_id = $1
+    """,
+    "set_group_personality": """
+        UPDATE groups SET personality_prompt = $1 WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "get_group_personality": """
+        SELECT personality_prompt FROM groups WHERE chat_id = $1
+    """,
+    "add_group_admin": """
+        UPDATE groups
+        SET admin_ids = array_append(COALESCE(admin_ids, ARRAY[]::BIGINT[]), $1)
+        WHERE chat_id = $2 AND (admin_ids IS NULL OR NOT admin_ids @> ARRAY[$1]::BIGINT[])
+        RETURNING chat_id
+    """,
+    "remove_group_admin": """
+        UPDATE groups SET admin_ids = array_remove(admin_ids, $1) WHERE chat_id = $2 RETURNING chat_id
+    """,
+    "add_chat_memory": """
+        INSERT INTO chat_memories
+            (bot_id, chat_id, message_id, user_id, message_text, message_timestamp, embedding, embedding_model,
+             text_hash, simhash)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+        ON CONFLICT (bot_id, chat_id, message_id) DO NOTHING
+        RETURNING memory_id
+    """,
+    # Memory reads take the bot's IDs as an array: the primary bot also owns rows from before bot_id (0).
+    # Latest memory of the bot in the chat with the same normalized-text hash, no older than $4
+    "find_duplicate_memory": """
+        SELECT memory_id FROM chat_memories
+        WHERE bot_id = ANY($1::BIGINT[]) AND chat_id = $2 AND text_hash = $3 AND message_timestamp >= $4
+        ORDER BY memory_id DESC
+        LIMIT 1
+    """,
+    # Counts a suppressed duplicate on the stored row and returns its embedding for reuse
+    "record_duplicate_memory": """
+        UPDATE chat_memories
+        SET duplicate_count = duplicate_count + 1, last_duplicate_at = $2
+        WHERE memory_id = $1
+        RETURNING embedding
+    """,
+    # $3 is the max age in days; NULL disables the age filter
+    "find_relevant_memories": """
+        SELECT memory_id, message_id, message_text, user_id, message_timestamp, text_hash
+        FROM chat_memories
+        WHERE bot_id = ANY($1::BIGINT[]) AND chat_id = $2
+          AND ($3::INT IS NULL OR message_timestamp >= NOW() - make_interval(days => $3::INT))
+        ORDER BY embedding <=> $4
+        LIMIT $5
+    """,
+    # Hybrid search: vector and full-text candidates in one round trip, merged with
+    # reciprocal rank fusion. $5 = to_tsquery text (NULL skips the lexical side),
+    # $6 = candidates per side, $7 = RRF k constant, $8 = final limit.
+    "find_relevant_memories_hybrid": """
+        WITH vector_hits AS (
+            SELECT memory_id, ROW_NUMBER() OVER (ORDER BY embedding <=> $4) AS rank
+            FROM chat_memories
+            WHERE bot_id = ANY($1::BIGINT[]) AND chat_id = $2
+              AND ($3::INT IS NULL OR message_timestamp >= NOW() - make_interval(days => $3::INT))
+            ORDER BY embedding <=> $4
+            LIMIT $6
+        ),
+        text_hits AS (
+            SELECT memory_id, ROW_NUMBER() OVER (ORDER BY ts_rank_cd(message_tsv, query) DESC) AS rank
+            FROM chat_memories, to_tsquery('simple', $5::TEXT) AS query
+            WHERE $5::TEXT IS NOT NULL
+              AND bot_id = ANY($1::BIGINT[]) AND chat_id = $2
+              AND ($3::INT IS NULL OR message_timestamp >= NOW() - make_interval(days => $3::INT))
+              AND message_tsv @@ query
+            ORDER BY ts_rank_cd(message_tsv, query) DESC
+            LIMIT $6
+        ),
+        fused AS (
+            SELECT memory_id,
+                   COALESCE(1.0 / ($7 + v.rank), 0) + COALESCE(1.0 / ($7 + t.rank), 0) AS rrf_score
+            FROM vector_hits v FULL OUTER JOIN text_hits t USING (memory_id)
+        )
+        SELECT m.memory_id, m.message_id, m.message_text, m.user_id, m.message_timestamp, m.text_hash, f.rrf_score
+        FROM fused f JOIN chat_memories m USING (memory_id)
+        ORDER BY f.rrf_score DESC
+        LIMIT $8
+    """,
+    "get_memories_by_ids": """
+        SELECT memory_id, chat_id, message_id, user_id, message_text, message_timestamp
+        FROM chat_memories WHERE memory_id = ANY($1::BIGINT[])
+    """,
+    # Atomic refill-and-take on a shared token bucket. $2 = capacity, $3 = refill per second.
+    # All SET expressions see the old row, so `allowed` and `tokens` use the same refilled value.
+    "consume_rate_limit_token": """
+        INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, allowed, updated_at)
+        VALUES ($1, $2::FLOAT8 - 1, true, clock_timestamp())
+        ON CONFLICT (bucket_key) DO UPDATE SET
+            allowed = LEAST($2::FLOAT8, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * $3::FLOAT8) >= 1,
+            tokens = LEAST($2::FLOAT8, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * $3::FLOAT8)
+                     - CASE WHEN LEAST($2::FLOAT8, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * $3::FLOAT8) >= 1
+                            THEN 1 ELSE 0 END,
+            updated_at = clock_timestamp()
+        RETURNING allowed
+    """,
+    "get_bot_identity": """
+        SELECT username FROM bot_identity WHERE bot_user_id = $1
+    """,
+    "save_bot_identity": """
+        INSERT INTO bot_identity (bot_user_id, username)
+        VALUES ($1, $2)
+        ON CONFLICT (bot_user_id) DO UPDATE SET username = EXCLUDED.username, updated_at = now()
+    """,
+    "get_persona_prompt": """
+        UPDATE persona_prompts SET uses = uses + 1
+        WHERE description_key = $1 AND model = $2
+        RETURNING prompt
+    """,
+    "save_persona_prompt": """
+        INSERT INTO persona_prompts (description_key, model, prompt)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (description_key, model) DO NOTHING
+    """,
+}
+
+# Usage rollups (see usage_accounting.py). Written in bulk every flush interval rather than per
+# request, so they are not prepared on every pooled connection.
+USAGE_HISTOGRAM_COLUMNS = ("total", "llm", "embedding", "retrieval", "send")
+
+def _add_histograms(column: str) -> str:
+    return (f"{column} = ARRAY(SELECT COALESCE(a, 0) + COALESCE(b, 0) "
+            f"FROM unnest(u.{column}, EXCLUDED.{column}) WITH ORDINALITY AS h(a, b, i) ORDER BY i)")
+
+RECORD_CHAT_USAGE = f"""
+    INSERT INTO chat_usage_hourly AS u (
+        bot_id, chat_id, hour, model, requests, errors, prompt_tokens, completion_tokens, embedding_tokens,
+        cost_usd, cache_hits, {", ".join(f"{stage}_latency_hist" for stage in USAGE_HISTOGRAM_COLUMNS)}
+    )
+    VALUES ($1, $2, to_timestamp($3), $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16)
+    ON CONFLICT (bot_id, chat_id, hour, model) DO UPDATE SET
+        requests = u.requests + EXCLUDED.requests,
+        errors = u.errors + EXCLUDED.errors,
+        prompt_tokens = u.prompt_tokens + EXCLUDED.prompt_tokens,
+        completion_tokens = u.completion_tokens + EXCLUDED.completion_tokens,
+        embedding_tokens = u.embedding_tokens + EXCLUDED.embedding_tokens,
+        cost_usd = u.cost_usd + EXCLUDED.cost_usd,
+        cache_hits = u.cache_hits + EXCLUDED.cache_hits,
+        {(","+chr(10)+"        ").join(_add_histograms(f"{stage}_latency_hist") for stage in USAGE_HISTOGRAM_COLUMNS)}
+"""
+
+# Ranks (bot, chat) pairs by summed cost, or by the p95 bucket of their merged total-latency histograms.
+# $3 holds the bucket upper bounds; the overflow bucket maps to the last bound.
+TOP_CHAT_USAGE = """
+    WITH recent AS (
+        SELECT * FROM chat_usage_hourly WHERE hour >= to_timestamp($1) - interval '1 hour'
+    ), totals AS (
+        SELECT bot_id, chat_id, sum(cost_usd) AS cost_usd, sum(requests) AS requests FROM recent GROUP BY bot_id, chat_id
+    ), buckets AS (
+        SELECT bot_id, chat_id, i, sum(n) AS n
+        FROM recent, unnest(recent.total_latency_hist) WITH ORDINALITY AS h(n, i)
+        GROUP BY bot_id, chat_id, i
+    ), cumulative AS (
+        SELECT bot_id, chat_id, i, sum(n) OVER (PARTITION BY bot_id, chat_id ORDER BY i) AS running,
+               sum(n) OVER (PARTITION BY bot_id, chat_id) AS total
+        FROM buckets
+    ), p95 AS (
+        SELECT bot_id, chat_id, min(i)::INT AS bucket FROM cumulative
+        WHERE total > 0 AND running >= 0.95 * total GROUP BY bot_id, chat_id
+    )
+    SELECT t.bot_id, t.chat_id, t.cost_usd, t.requests,
+           ($3::INT[])[LEAST(p.bucket, array_length($3::INT[], 1))] AS p95_ms
+    FROM totals t LEFT JOIN p95 p USING (bot_id, chat_id)
+    ORDER BY CASE WHEN $2 = 'p95' THEN ($3::INT[])[LEAST(p.bucket, array_length($3::INT[], 1))] END DESC NULLS LAST,
+             t.cost_usd DESC
+    LIMIT $4
+"""
+
+# Scheduled jobs (see scheduler.py). A replica holding the job's advisory lock claims a run unless
+# the job was started less than $2 seconds ago, so each period runs once across all replicas, or its
+# last run hasn't finished and was started less than $3 seconds ago (after that its replica is presumed gone).
+CLAIM_JOB_RUN = """
+    INSERT INTO scheduled_jobs AS j (name, last_started_at) VALUES ($1, now())
+    ON CONFLICT (name) DO UPDATE SET last_started_at = now()
+    WHERE j.last_started_at < now() - make_interval(secs => $2)
+      AND (j.last_finished_at >= j.last_started_at OR j.last_started_at < now() - make_interval(secs => $3))
+    RETURNING true
+"""
+
+FINISH_JOB_RUN = """
+    UPDATE scheduled_jobs SET
+        last_finished_at = clock_timestamp(), last_status = $2, last_duration_ms = $3, last_error = $4,
+        runs = runs + 1, failures = failures + CASE WHEN $2 = 'ok' THEN 0 ELSE 1 END
+    WHERE name = $1
+"""
+
+# Variants that also return each candidate's embedding, for local reranking
+STATEMENTS["find_relevant_memories_with_vectors"] = STATEMENTS["find_relevant_memories"].replace(
+    "SELECT memory_id, message_id, message_text, user_id, message_timestamp, text_hash",
+    "SELECT memory_id, message_id, message_text, user_id, message_timestamp, text_hash, embedding", 1
+)
+STATEMENTS["find_relevant_memories_hybrid_with_vectors"] = STATEMENTS["find_relevant_memories_hybrid"].replace(
+    "SELECT m.memory_id, m.message_id, m.message_text, m.user_id, m.message_timestamp, m.text_hash, f.rrf_score",
+    "SELECT m.memory_id, m.message_id, m.message_text, m.user_id, m.message_timestamp, m.text_hash, f.rrf_score, m.embedding", 1
+)
+
+# --- pgvector binary codecs ---
+
+# pgvector's binary format: int16 dimensions, int16 unused, then big-endian float4 values
+# (vector) or float2 values (halfvec).
+def encode_vector(value: Iterable[float]) -> bytes:
+    """Encodes a list of floats in pgvector's binary wire format."""
+    values = list(value)
+    return struct.pack(f">HH{len(values)}f", len(values), 0, *values)
+
+def decode_vector(data: bytes) -> List[float]:
+    """Decodes pgvector's binary wire format into a list of floats."""
+    dim = struct.unpack_from(">H", data)[0]
+    return list(struct.unpack_from(f">{dim}f", data, 4))
+
+def encode_halfvec(value: Iterable[float]) -> bytes:
+    """Encodes a list of floats in pgvector's halfvec (float16) binary wire format."""
+    values = list(value)
+    return struct.pack(f">HH{len(values)}e", len(values), 0, *values)
+
+def decode_halfvec(data: bytes) -> List[float]:
+    """Decodes pgvector's halfvec binary wire format into a list of floats."""
+    dim = struct.unpack_from(">H", data)[0]
+    return list(struct.unpack_from(f">{dim}e", data, 4))
+
+_TYPE_DIMENSIONS_RE = re.compile(r"\((\d+)\)")
+
+# (type name, encoder, decoder); halfvec requires pgvector >= 0.7
+VECTOR_CODECS = (
+    ("vector", encode_vector, decode_vector),
+    ("halfvec", encode_halfvec, decode_halfvec),
+)
+
+_connection_class = None
+
+def _get_connection_class():
+    """
+    Builds (once) an asyncpg.Connection subclass that carries its prepared statements.
+    Built lazily so asyncpg is only imported when a pool is actually created.
+    """
+    global _connection_class
+    if _connection_class is None:
+        import asyncpg
+
+        class PreparedConnection(asyncpg.Connection):
+            __slots__ = ("prepared_statements",)
+
+        _connection_class = PreparedConnection
+    return _connection_class
+
+
+class Repository:
+    """
+    Data access object that owns the asyncpg pool.
+
+    Every hot statement in STATEMENTS is prepared once per connection when the pool
+    opens that connection, so calls skip the parse/plan round trip. When
+    `prepare_statements` is False (PgBouncer transaction mode) the same SQL is sent
+    as plain text instead. Per-statement call counts and latencies are kept in memory
+    and exposed through statement_stats().
+
+    A prepared statement that a schema change invalidated (e.g. the embedding column
+    swap in migrate_embeddings.py) is prepared again and retried once, and the live
+    embedding column is read again (see embedding_dimensions).
+    """
+
+    def __init__(self, dsn: str, prepare_statements: bool = True, **pool_kwargs: Any):
+        self.dsn = dsn
+        self.prepare_statements = prepare_statements
+        self.pool_kwargs = pool_kwargs
+        self.pool: Optional["asyncpg.Pool"] = None
+        # name -> [calls, total_seconds, max_seconds]
+        self._timings: Dict[str, List[float]] = {}
+        # Declared dimensions of chat_memories.embedding (None until read, or if undeclared)
+        self.embedding_dimensions: Optional[int] = None
+
+    # --- Lifecycle ---
+
+    async def open(self) -> "asyncpg.Pool":
+        """Creates the pool. Statements are prepared per connection by _init_connection."""
+        import asyncpg
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            init=self._init_connection,
+            connection_class=_get_connection_class(),
+            **self.pool_kwargs
+        )
+        return self.pool
+
+    async def close(self):
+        """Closes the pool if it is open."""
+        if self.pool:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    async def _init_connection(self, connection):
+        """Pool `init` hook: registers the binary vector codecs, reads the embedding column type and prepares the hot statements."""
+        for type_name, encoder, decoder in VECTOR_CODECS:
+            try:
+                await connection.set_type_codec(
+                    type_name, schema="public", encoder=encoder, decoder=decoder, format="binary"
+                )
+            except ValueError:
+                # The type doesn't exist (pgvector not enabled, or too old for halfvec)
+                log = logger.warning if type_name == "vector" else logger.debug
+                log(f"pgvector type '{type_name}' not found; codec not registered. Is the vector extension enabled?")
+
+        try:
+            await self.refresh_embedding_dimensions(connection)
+        except Exception as e:
+            logger.warning("Could not inspect chat_memories.embedding column type: %s", e)
+
+        connection.prepared_statements = {}
+        if not self.prepare_statements:
+            return
+        start = time.perf_counter()
+        for name, sql in STATEMENTS.items():
+            try:
+                connection.prepared_statements[name] = await connection.prepare(sql)
+            except Exception as e:
+                # E.g. a table from a newer schema.sql that hasn't been applied yet
+                logger.warning("Could not prepare statement '%s': %s", name, e)
+        logger.debug("Prepared %s statements in %.1f ms", len(connection.prepared_statements), (time.perf_counter() - start) * 1000)
+
+    @asynccontextmanager
+    async def connection(self):
+        """Acquires a pooled connection for running several statements together."""
+        async with self.pool.acquire() as connection:
+            yield connection
+
+    # --- Execution helpers ---
+
+    async def _run(self, connection, name: str, method: str, *args: Any) -> Any:
+        """Runs a named statement with fetch/fetchrow/fetchval, prepared if available."""
+        import asyncpg
+        start = time.perf_counter()
+        try:
+            statement = getattr(connection, "prepared_statements", {}).get(name)
+            if statement is None:
+                return await getattr(connection, method)(STATEMENTS[name], *args)
+            try:
+                return await getattr(statement, method)(*args)
+            except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.FeatureNotSupportedError) as e:
+                # The statement's plan predates a schema change; asyncpg won't prepare it again by itself
+                logger.warning("Statement '%s' is stale after a schema change (%s); preparing it again.", name, e)
+                del connection.prepared_statements[name]
+                if connection.is_in_transaction():
+                    raise # The transaction is aborted; later calls send the SQL as text on this connection
+                await self.refresh_embedding_dimensions(connection)
+                statement = connection.prepared_statements[name] = await connection.prepare(STATEMENTS[name])
+                return await getattr(statement, method)(*args)
+        finally:
+            self._record_timing(name, time.perf_counter() - start)
+
+    async def _call(self, name: str, method: str, *args: Any) -> Any:
+        """Acquires a connection and runs a single named statement."""
+        async with self.pool.acquire() as connection:
+            return await self._run(connection, name, method, *args)
+
+    def _record_timing(self, name: str, elapsed: float):
+        timing = self._timings.get(name)
+        if timing is None:
+            timing = self._timings[name] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += elapsed
+        if elapsed > timing[2]:
+            timing[2] = elapsed
+        logger.debug("Statement '%s' took %.2f ms", name, elapsed * 1000)
+
+    def statement_stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns per-statement call counts and latencies in milliseconds."""
+        return {
+            name: {
+                "calls": calls,
+                "total_ms": round(total * 1000, 2),
+                "avg_ms": round(total * 1000 / calls, 3) if calls else 0.0,
+                "max_ms": round(max_elapsed * 1000, 2),
+            }
+            for name, (calls, total, max_elapsed) in self._timings.items()
+        }
+
+    # --- Groups ---
+
+    async def get_or_create_group(self, chat_id: int) -> Optional["asyncpg.Record"]:
+        """Fetches the group row, inserting a default row first if it doesn't exist."""
+        async with self.pool.acquire() as connection:
+            group_record = await self._run(connection, "get_group", "fetchrow", chat_id)
+            if group_record:
+                return group_record
+            logger.info("Group %s not found. Creating new entry.", chat_id)
+            group_record = await self._run(connection, "insert_group", "fetchrow", chat_id)
+            if group_record is None:
+                # Another process inserted it concurrently (ON CONFLICT DO NOTHING returned no row)
+                logger.warning("Race condition: Group %s was created concurrently. Fetching again.", chat_id)
+                group_record = await self._run(connection, "get_group", "fetchrow", chat_id)
+            return group_record
+
+    async def get_groups(self, chat_ids: List[int]) -> Dict[int, "asyncpg.Record"]:
+        """Batch lookup of several groups in one round trip, keyed by chat_id."""
+        if not chat_ids:
+            return {}
+        records = await self._call("get_groups", "fetch", list(chat_ids))
+        return {record["chat_id"]: record for record in records}
+
+    async def set_group_activity(self, chat_id: int, is_active: bool) -> bool:
+        return await self._call("set_group_activity", "fetchval", is_active, chat_id) is not None
+
+    async def set_group_retrieval_mode(self, chat_id: int, mode: Optional[str]) -> bool:
+        return await self._call("set_group_retrieval_mode", "fetchval", mode, chat_id) is not None
+
+    async def set_group_model_tier(self, chat_id: int, tier: Optional[str]) -> bool:
+        return await self._call("set_group_model_tier", "fetchval", tier, chat_id) is not None
+
+    async def set_group_burst_window(self, chat_id: int, seconds: Optional[int]) -> bool:
+        return await self._call("set_group_burst_window", "fetchval", seconds, chat_id) is not None
+
+    async def get_group_admins(self, chat_id: int) -> Optional[List[int]]:
+        return await self._call("get_group_admins", "fetchval", chat_id)
+
+    async def set_group_personality(self, chat_id: int, personality_prompt: str) -> bool:
+        return await self._call("set_group_personality", "fetchval", personality_prompt, chat_id) is not None
+
+    async def get_group_personality(self, chat_id: int) -> Optional[str]:
+        return await self._call("get_group_personality", "fetchval", chat_id)
+
+    async def add_group_admin(self, chat_id: int, user_id: int) -> bool:
+        """Returns True if the user was appended (False if group missing or already an admin)."""
+        return await self._call("add_group_admin", "fetchval", user_id, chat_id) is not None
+
+    async def remove_group_admin(self, chat_id: int, user_id: int) -> bool:
+        """Returns True if the group exists (the user is removed if present)."""
+        return await self._call("remove_group_admin", "fetchval", user_id, chat_id) is not None
+
+    # --- Memories ---
+
+    async def add_chat_memory(
+        self,
+        bot_id: int,
+        chat_id: int,
+        message_id: int,
+        user_id: int,
+        message_text: str,
+        message_timestamp: datetime,
+        embedding: List[float],
+        embedding_model: Optional[str] = None,
+        text_hash: Optional[int] = None,
+        simhash: Optional[int] = None
+    ) -> Optional[int]:
+        """Inserts a memory and returns its memory_id, or None if the message was already stored."""
+        return await self._call(
+            "add_chat_memory", "fetchval",
+            bot_id, chat_id, message_id, user_id, message_text, message_timestamp, embedding, embedding_model,
+            text_hash, simhash
+        )
+
+    async def add_chat_memories(self, rows: List[tuple]) -> None:
+        """
+        Bulk insert of (bot_id, chat_id, message_id, user_id, message_text, message_timestamp, embedding,
+        embedding_model, text_hash, simhash) tuples in a single executemany round trip.
+        """
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as connection:
+                await connection.executemany(STATEMENTS["add_chat_memory"], rows)
+        finally:
+            self._record_timing("add_chat_memories", time.perf_counter() - start)
+
+    async def find_duplicate_memory(self, bot_ids: List[int], chat_id: int, text_hash: int, since: datetime) -> Optional[int]:
+        return await self._call("find_duplicate_memory", "fetchval", bot_ids, chat_id, text_hash, since)
+
+    async def record_duplicate_memory(self, memory_id: int, seen_at: datetime) -> Optional[List[float]]:
+        """Bumps the row's duplicate counter; returns its embedding, or None if the row is gone."""
+        return await self._call("record_duplicate_memory", "fetchval", memory_id, seen_at)
+
+    async def find_relevant_memories(
+        self,
+        bot_ids: List[int],
+        chat_id: int,
+        query_embedding: List[float],
+        limit: int,
+        max_age_days: Optional[int],
+        with_vectors: bool = False
+    ) -> List["asyncpg.Record"]:
+        age = max_age_days if max_age_days is not None and max_age_days > 0 else None
+        name = "find_relevant_memories_with_vectors" if with_vectors else "find_relevant_memories"
+        return await self._call(name, "fetch", bot_ids, chat_id, age, query_embedding, limit)
+
+    async def find_relevant_memories_hybrid(
+        self,
+        bot_ids: List[int],
+        chat_id: int,
+        query_embedding: List[float],
+        tsquery: Optional[str],
+        limit: int,
+        max_age_days: Optional[int],
+        candidates: int,
+        rrf_k: int,
+        with_vectors: bool = False
+    ) -> List["asyncpg.Record"]:
+        age = max_age_days if max_age_days is not None and max_age_days > 0 else None
+        name = "find_relevant_memories_hybrid_with_vectors" if with_vectors else "find_relevant_memories_hybrid"
+        return await self._call(
+            name, "fetch",
+            bot_ids, chat_id, age, query_embedding, tsquery, candidates, rrf_k, limit
+        )
+
+    async def get_memories_by_ids(self, memory_ids: List[int]) -> List["asyncpg.Record"]:
+        """Bulk fetch of memory rows by ID in one round trip."""
+        if not memory_ids:
+            return []
+        return await self._call("get_memories_by_ids", "fetch", list(memory_ids))
+
+    async def embedding_column_type(self, connection=None) -> Optional[str]:
+        """Returns the declared type of chat_memories.embedding, e.g. 'vector(1536)' or 'halfvec(512)'."""
+        if connection is None:
+            async with self.pool.acquire() as connection:
+                return await self.embedding_column_type(connection)
+        return await connection.fetchval(
+            """
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'chat_memories'::regclass AND attname = 'embedding' AND NOT attisdropped
+            """
+        )
+
+    async def refresh_embedding_dimensions(self, connection=None) -> Optional[str]:
+        """Reads the embedding column type into embedding_dimensions and returns it."""
+        column_type = await self.embedding_column_type(connection)
+        match = _TYPE_DIMENSIONS_RE.search(column_type or "")
+        dimensions = int(match.group(1)) if match else None
+        if dimensions != self.embedding_dimensions:
+            logger.info("chat_memories.embedding is %s.", column_type)
+        self.embedding_dimensions = dimensions
+        return column_type
+
+    # --- Rate limiting ---
+
+    async def consume_rate_limit_token(self, bucket_key: str, capacity: float, refill_per_second: float) -> bool:
+        return await self._call("consume_rate_limit_token", "fetchval", bucket_key, capacity, refill_per_second)
+
+    # --- Usage accounting ---
+
+    async def record_chat_usage(self, rows: List[tuple]) -> None:
+        """Adds (chat_id, hour (unix), model, counters..., histograms...) rows to the hourly rollups."""
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as connection:
+                await connection.executemany(RECORD_CHAT_USAGE, rows)
+        finally:
+            self._record_timing("record_chat_usage", time.perf_counter() - start)
+
+    async def top_chat_usage(self, since: float, sort: str, limit: int, bucket_bounds: List[int]) -> List["asyncpg.Record"]:
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(TOP_CHAT_USAGE, since, sort, bucket_bounds, limit)
+
+    async def chat_usage_rows(self, chat_ids: List[int], since: float) -> List["asyncpg.Record"]:
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(
+                "SELECT * FROM chat_usage_hourly WHERE chat_id = ANY($1::BIGINT[]) "
+                "AND hour >= to_timestamp($2) - interval '1 hour'",
+                chat_ids, since
+            )
+
+    # --- Scheduled jobs ---
+
+    async def claim_job_run(self, name: str, lock_key: int, min_gap_seconds: float, stale_after_seconds: float) -> bool:
+        """
+        Claims a run of a scheduled job: True if this replica got the job's advisory lock, the job
+        wasn't started in the last `min_gap_seconds` and its last run finished (or was started over
+        `stale_after_seconds` ago). The claim commits at once, so the job runs without holding a
+        connection or transaction; transaction-scoped, so it also works through PgBouncer.
+        """
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if not await connection.fetchval("SELECT pg_try_advisory_xact_lock($1)", lock_key):
+                    return False
+                return bool(await connection.fetchval(CLAIM_JOB_RUN, name, min_gap_seconds, stale_after_seconds))
+
+    async def finish_job_run(self, name: str, status: str, duration_ms: int, error: Optional[str] = None):
+        async with self.pool.acquire() as connection:
+            await connection.execute(FINISH_JOB_RUN, name, status, duration_ms, error)
+
+    async def scheduled_job_runs(self) -> List["asyncpg.Record"]:
+        async with self.pool.acquire() as connection:
+            return await connection.fetch("SELECT * FROM scheduled_jobs ORDER BY name")
+
+    # --- Maintenance ---
+
+    async def table_health(self, table: str) -> Optional["asyncpg.Record"]:
+        async with self.pool.acquire() as connection:
+            return await connection.fetchrow(
+                "SELECT n_live_tup, n_dead_tup, last_vacuum, last_autovacuum, last_analyze, last_autoanalyze "
+                "FROM pg_stat_user_tables WHERE relname = $1",
+                table
+            )
+
+    async def analyze_table(self, table: str) -> None:
+        async with self.pool.acquire() as connection:
+            await connection.execute(f'ANALYZE "{table}"')
+
+    async def delete_memories_before(self, max_age_days: int, batch_size: int) -> int:
+        """Deletes up to `batch_size` memories older than `max_age_days`. Returns the number deleted."""
+        async with self.pool.acquire() as connection:
+            status = await connection.execute(
+                "DELETE FROM chat_memories WHERE memory_id IN ("
+                "SELECT memory_id FROM chat_memories WHERE message_timestamp < now() - make_interval(days => $1) LIMIT $2)",
+                max_age_days, batch_size
+            )
+        return int(status.split()[-1])
+
+    async def delete_usage_before(self, max_age_days: int) -> int:
+        async with self.pool.acquire() as connection:
+            status = await connection.execute(
+                "DELETE FROM chat_usage_hourly WHERE hour < now() - make_interval(days => $1)", max_age_days
+            )
+        return int(status.split()[-1])
+
+    async def delete_idle_rate_limit_buckets(self, idle_seconds: float) -> int:
+        """A bucket idle this long has refilled, so dropping it changes nothing."""
+        async with self.pool.acquire() as connection:
+            status = await connection.execute(
+                "DELETE FROM rate_limit_buckets WHERE updated_at < now() - make_interval(secs => $1)", idle_seconds
+            )
+        return int(status.split()[-1])
+
+    async def top_persona_prompts(self, limit: int) -> List["asyncpg.Record"]:
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(
+                "SELECT description_key, model, prompt FROM persona_prompts ORDER BY uses DESC LIMIT $1", limit
+            )
+
+    # --- Bot identity ---
+
+    async def get_bot_identity(self, bot_user_id: int) -> Optional[str]:
+        return await self._call("get_bot_identity", "fetchval", bot_user_id)
+
+    async def save_bot_identity(self, bot_user_id: int, username: str) -> None:
+        await self._call("save_bot_identity", "fetch", bot_user_id, username)
+
+    # --- Persona prompts ---
+
+    async def get_persona_prompt(self, description_key: str, model: str) -> Optional[str]:
+        """Returns the cached persona prompt (counting the use), or None."""
+        return await self._call("get_persona_prompt", "fetchval", description_key, model)
+
+    async def save_persona_prompt(self, description_key: str, model: str, prompt: str) -> None:
+        await self._call("save_persona_prompt", "fetch", description_key, model, prompt)
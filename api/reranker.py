@@ -0,0 +1,94 @@
+import logging
+import math
+from typing import Optional, List, Sequence
+from datetime import datetime, timezone
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+def mmr_select(
+    query_embedding: Sequence[float],
+    candidate_embeddings: Sequence[Sequence[float]],
+    ages_hours: Sequence[float],
+    limit: int,
+    mmr_lambda: float,
+    recency_weight: float,
+    half_life_hours: float,
+    base_relevance: Optional[Sequence[float]] = None
+) -> List[int]:
+    """
+    Picks up to `limit` candidate indices by maximal marginal relevance.
+
+    Relevance is a blend of cosine similarity to the query (or `base_relevance`, e.g.
+    normalized fusion scores) and an exponential time decay with the given half-life.
+    Each step picks the candidate maximizing
+        mmr_lambda * relevance - (1 - mmr_lambda) * max similarity to already picked ones,
+    so near-duplicates of a picked memory are pushed down. All math is vectorized in NumPy.
+    """
+    import numpy as np # Imported lazily to keep cold starts fast
+
+    vectors = np.asarray(candidate_embeddings, dtype=np.float32)
+    if vectors.ndim != 2 or len(vectors) == 0:
+        return []
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+
+    if base_relevance is not None:
+        relevance = np.asarray(base_relevance, dtype=np.float32)
+    else:
+        relevance = vectors @ query
+    if recency_weight > 0 and half_life_hours > 0:
+        recency = np.exp(-math.log(2) * np.asarray(ages_hours, dtype=np.float32) / half_life_hours)
+        relevance = (1.0 - recency_weight) * relevance + recency_weight * recency
+
+    similarity = vectors @ vectors.T
+    count = min(limit, len(vectors))
+    selected: List[int] = []
+    max_similarity = np.zeros(len(vectors), dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    for _ in range(count):
+        scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = similarity[best] if len(selected) == 1 else np.maximum(max_similarity, similarity[best])
+    return selected
+
+def rerank_memories(query_embedding: Sequence[float], memories: list, limit: int, now: Optional[datetime] = None) -> list:
+    """
+    Reranks over-fetched memory records (which must include `embedding`) for diversity and
+    recency, using the MEMORY_MMR_LAMBDA / MEMORY_RECENCY_* settings. Returns at most `limit` records.
+    """
+    if len(memories) <= 1:
+        return memories[:limit]
+    now = now or datetime.now(timezone.utc)
+    ages_hours = []
+    for memory in memories:
+        timestamp = memory['message_timestamp']
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        ages_hours.append(max(0.0, (now - timestamp).total_seconds() / 3600.0))
+
+    base_relevance = None
+    if 'rrf_score' in memories[0].keys():
+        # Hybrid results: lexical hits may have low cosine similarity, so rank on normalized fusion scores
+        top = max(float(m['rrf_score']) for m in memories) or 1.0
+        base_relevance = [float(m['rrf_score']) / top for m in memories]
+
+    try:
+        order = mmr_select(
+            query_embedding, [m['embedding'] for m in memories], ages_hours, limit,
+            mmr_lambda=settings.MEMORY_MMR_LAMBDA,
+            recency_weight=settings.MEMORY_RECENCY_WEIGHT,
+            half_life_hours=settings.MEMORY_RECENCY_HALF_LIFE_HOURS,
+            base_relevance=base_relevance
+        )
+    except Exception as e:
+        # Fall back to the database ordering rather than losing context
+        logger.error("Memory reranking failed, using database order: %s", e)
+        return memories[:limit]
+    return [memories[i] for i in order]
@@ -0,0 +1,279 @@
+"""
+Lightweight scheduler for periodic maintenance jobs, started from the app lifespan.
+
+Each job has a schedule ("every 10m" or a 5-field cron spec in UTC), a random jitter added to
+every run, and a timeout after which the run is cancelled. Leader-only jobs (the default) run on
+one replica per scheduled run: the replica takes the job's Postgres advisory lock and claims the
+run in scheduled_jobs (see Repository.claim_job_run); the others skip it, as do all replicas while
+the last run is unfinished. The claim and the result are short transactions of their own, so no
+connection is held while the job runs. Other jobs (e.g. cache warmups) run on every replica.
+
+Status per job is kept in memory for this replica and in scheduled_jobs for the last run anywhere.
+"""
+
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
+
+# Import settings
+from .config import settings
+from . import database
+
+logger = logging.getLogger(__name__)
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# A claimed run that never finished (its replica died) blocks new runs for its timeout plus this
+STALE_RUN_GRACE_SECONDS = 300.0
+
+
+class IntervalSchedule:
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError("interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, now: float) -> float:
+        return now + self.seconds
+
+    def period(self, now: float) -> float:
+        return self.seconds
+
+
+class CronSchedule:
+    """minute hour day-of-month month day-of-week, in UTC. Fields take *, */n, a, a-b, a-b/n and lists."""
+    __slots__ = ("minutes", "hours", "days", "months", "weekdays", "any_day", "any_weekday")
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron spec needs 5 fields, got {len(fields)}: {spec!r}")
+        self.minutes = _cron_field(fields[0], 0, 59)
+        self.hours = _cron_field(fields[1], 0, 23)
+        self.days = _cron_field(fields[2], 1, 31)
+        self.months = _cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _cron_field(fields[4], 0, 7)} # 0 and 7 are Sunday
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, t: datetime) -> bool:
+        day_ok = t.day in self.days
+        weekday_ok = (t.isoweekday() % 7) in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok # Like cron: either restricted field may match
+
+    def next_after(self, now: float) -> float:
+        start = datetime.fromtimestamp(now, timezone.utc)
+        t = start.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while t.year <= start.year + 5:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t.timestamp()
+        raise ValueError("cron spec never matches")
+
+    def period(self, now: float) -> float:
+        first = self.next_after(now)
+        return self.next_after(first) - first
+
+
+def _cron_field(field: str, low: int, high: int) -> set[int]:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f"invalid cron field {field!r}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_schedule(spec: str):
+    """Parses "every <n><s|m|h|d>" (e.g. "every 15m") or a 5-field cron spec."""
+    spec = spec.strip()
+    if spec.startswith("every "):
+        amount = spec[6:].strip()
+        unit = _UNITS.get(amount[-1:])
+        return IntervalSchedule(float(amount[:-1]) * unit if unit else float(amount))
+    return CronSchedule(spec)
+
+def _lock_key(name: str) -> int:
+    """Stable 64-bit advisory lock key per job name."""
+    return int.from_bytes(hashlib.sha256(f"scheduled_job:{name}".encode()).digest()[:8], "big", signed=True)
+
+
+class Job:
+    __slots__ = ("name", "func", "spec", "schedule", "leader_only", "run_on_start", "timeout",
+                 "next_run_at", "last_started_at", "last_duration_ms", "last_status", "last_error",
+                 "last_result", "runs", "failures", "skipped")
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[Any]], spec: str, leader_only: bool,
+                 run_on_start: bool, timeout: float):
+        self.name = name
+        self.func = func # Returns an optional JSON-able summary of the run
+        self.spec = spec
+        self.schedule = parse_schedule(spec)
+        self.leader_only = leader_only
+        self.run_on_start = run_on_start
+        self.timeout = timeout
+        self.next_run_at: Optional[float] = None
+        self.last_started_at: Optional[float] = None
+        self.last_duration_ms: Optional[int] = None
+        self.last_status: Optional[str] = None # 'ok', 'failed', 'timeout', or 'skipped' (ran elsewhere)
+        self.last_error: Optional[str] = None
+        self.last_result: Any = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def status(self) -> dict:
+        def iso(ts: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+        return {
+            "schedule": self.spec,
+            "leader_only": self.leader_only,
+            "next_run_at": iso(self.next_run_at),
+            "last_started_at": iso(self.last_started_at),
+            "last_duration_ms": self.last_duration_ms,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "last_result": self.last_result,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+        }
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add(self, name: str, func: Callable[[], Awaitable[Any]], spec: str, leader_only: bool = True,
+            run_on_start: bool = False, timeout: Optional[float] = None):
+        """Registers a job. SCHEDULER_SCHEDULES can override its spec, or disable it with "off"."""
+        spec = (settings.SCHEDULER_SCHEDULES.get(name, spec) if settings else spec).strip()
+        if spec == "off":
+            logger.info("Scheduled job '%s' is disabled.", name)
+            return
+        try:
+            self.jobs[name] = Job(name, func, spec, leader_only, run_on_start,
+                                  timeout or (settings.SCHEDULER_JOB_TIMEOUT_SECONDS if settings else 600.0))
+        except ValueError as e:
+            logger.error("Not scheduling job '%s': invalid schedule %r (%s)", name, spec, e)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._loop(job)) for job in self.jobs.values()]
+        logger.info("Scheduler started with %s jobs: %s", len(self.jobs), ", ".join(self.jobs))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self, job: Job):
+        jitter = settings.SCHEDULER_JITTER_SECONDS if settings else 0.0
+        first = True
+        while True:
+            now = time.time()
+            due = now if first and job.run_on_start else job.schedule.next_after(now)
+            job.next_run_at = due + random.uniform(0, jitter)
+            first = False
+            await asyncio.sleep(max(0.0, job.next_run_at - time.time()))
+            try:
+                await self.run(job)
+            except Exception as e:
+                logger.error("Scheduled job '%s' could not be started: %s", job.name, e)
+
+    async def run(self, job: Job):
+        """Runs a job once: on this replica, or for leader-only jobs if this replica wins the run."""
+        if not job.leader_only:
+            await self._execute(job)
+            return
+        repo = await database.get_repository()
+        if not repo:
+            job.skipped += 1
+            job.last_status, job.last_error = "skipped", "database unavailable"
+            return
+        # Runs of one period are claimed once; a little under the period leaves room for jitter
+        min_gap = job.schedule.period(time.time()) * 0.5
+        if not await repo.claim_job_run(job.name, _lock_key(job.name), min_gap, job.timeout + STALE_RUN_GRACE_SECONDS):
+            job.skipped += 1
+            job.last_status, job.last_error = "skipped", None
+            logger.debug("Scheduled job '%s' is running or ran on another replica.", job.name)
+            return
+        await self._execute(job)
+        try:
+            await repo.finish_job_run(job.name, job.last_status, job.last_duration_ms, job.last_error)
+        except Exception as e:
+            logger.warning("Could not record the run of scheduled job '%s': %s", job.name, e)
+
+    async def _execute(self, job: Job):
+        job.last_started_at = time.time()
+        started = time.perf_counter()
+        job.last_error = None
+        try:
+            job.last_result = await asyncio.wait_for(job.func(), job.timeout)
+            job.last_status = "ok"
+        except asyncio.TimeoutError:
+            job.last_status, job.last_error = "timeout", f"cancelled after {job.timeout:g}s"
+            job.failures += 1
+            logger.error("Scheduled job '%s' timed out after %gs.", job.name, job.timeout)
+        except Exception as e:
+            job.last_status, job.last_error = "failed", str(e)
+            job.failures += 1
+            logger.error("Scheduled job '%s' failed: %s", job.name, e)
+        job.runs += 1
+        job.last_duration_ms = int((time.perf_counter() - started) * 1000)
+        if job.last_status == "ok":
+            logger.info("Scheduled job '%s' finished in %s ms: %s", job.name, job.last_duration_ms, job.last_result)
+
+    async def status(self) -> dict:
+        """This replica's view of each job, plus the last run of each job on any replica."""
+        shared = []
+        repo = database.repository # Never creates the pool just for a status request
+        if repo and repo.pool:
+            try:
+                shared = [dict(row) for row in await repo.scheduled_job_runs()]
+            except Exception as e:
+                logger.warning("Could not read shared scheduled job runs: %s", e)
+        return {"running": bool(self._tasks),
+                "jobs": {name: job.status() for name, job in self.jobs.items()},
+                "last_runs": shared}
+
+
+scheduler = Scheduler()
+
+def start():
+    """Registers the maintenance jobs and starts the scheduler (from the app lifespan)."""
+    if not settings or not settings.SCHEDULER_ENABLED:
+        return
+    from . import maintenance
+    maintenance.register(scheduler)
+    scheduler.start()
+
+async def stop():
+    await scheduler.stop()
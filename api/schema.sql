@@ -94,4 +94,173 @@ WITH (m = 16, ef_construction = 64);
 
 -- Note: The persona information will be added in a later phase (e.g., in this table or a separate one).
 -- Note: You need to connect to your Vercel Postgres instance and run this SQL
--- using psql or the Vercel dashboard SQL editor to create the table. 
\ No newline at end of file
+-- using psql or the Vercel dashboard SQL editor to create the table. 
+-- ========= Bot Identity Cache =========
+
+-- Caches the getMe result so serverless cold starts don't need a network call.
+-- The bot user ID is the numeric prefix of the bot token, so only the username is looked up here.
+CREATE TABLE IF NOT EXISTS bot_identity (
+    bot_user_id BIGINT PRIMARY KEY,
+    username TEXT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- ========= Rate Limiting =========
+
+-- Optional per-group overrides of RATE_LIMIT_USER_PER_MINUTE / RATE_LIMIT_CHAT_PER_MINUTE (NULL = use settings)
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS rate_limit_user_per_minute REAL NULL;
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS rate_limit_chat_per_minute REAL NULL;
+
+-- Shared token buckets, used when RATE_LIMIT_SHARED is enabled (multi-replica deployments).
+-- Rows are small and hot; UNLOGGED avoids WAL traffic since losing them on crash only resets limits.
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    bucket_key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL DEFAULT true,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- ========= Hybrid (Lexical + Vector) Retrieval =========
+
+-- Full-text vector over message_text. The 'simple' configuration doesn't stem or drop stopwords,
+-- so ticker symbols, wallet addresses and usernames match exactly.
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS message_tsv TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('simple', message_text)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_chat_memories_message_tsv ON chat_memories USING GIN (message_tsv);
+
+-- Per-group retrieval mode override ('vector' or 'hybrid'; NULL = MEMORY_RETRIEVAL_MODE setting)
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS retrieval_mode TEXT NULL
+    CHECK (retrieval_mode IN ('vector', 'hybrid'));
+
+-- Per-group model tier ('fast', 'default', 'large'; NULL = automatic routing per message)
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS model_tier TEXT NULL
+    CHECK (model_tier IN ('fast', 'default', 'large'));
+
+-- Per-group burst coalescing window in seconds (NULL = off): mentions arriving within it get one combined reply
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS burst_window_seconds SMALLINT NULL
+    CHECK (burst_window_seconds BETWEEN 1 AND 60);
+
+-- ========= Duplicate Suppression =========
+
+-- Fingerprints written with each memory (see dedup.py): hash of the normalized text for exact
+-- duplicates and a 64-bit SimHash for near duplicates. Repeats of a stored message are not
+-- embedded or stored again; they bump duplicate_count on the existing row instead.
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS text_hash BIGINT NULL;
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS simhash BIGINT NULL;
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS duplicate_count INT NOT NULL DEFAULT 0;
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS last_duplicate_at TIMESTAMP WITH TIME ZONE NULL;
+
+CREATE INDEX IF NOT EXISTS idx_chat_memories_text_hash ON chat_memories (chat_id, text_hash)
+    WHERE text_hash IS NOT NULL;
+
+-- ========= Usage Accounting =========
+
+-- Hourly per-chat rollups, added to in bulk by usage_accounting.py. `model` is the chat completion
+-- model of the requests ('' when a request made no completion call). The *_latency_hist columns
+-- count requests per latency bucket (usage_accounting.LATENCY_BUCKETS_MS, plus an overflow bucket),
+-- so rows can be summed and percentiles computed over any range. cost_usd uses
+-- USAGE_PRICES_PER_MILLION_TOKENS at the time of the request.
+CREATE TABLE IF NOT EXISTS chat_usage_hourly (
+    chat_id BIGINT NOT NULL,
+    hour TIMESTAMP WITH TIME ZONE NOT NULL,
+    model TEXT NOT NULL DEFAULT '',
+    requests INT NOT NULL DEFAULT 0,
+    errors INT NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    embedding_tokens BIGINT NOT NULL DEFAULT 0,
+    cost_usd DOUBLE PRECISION NOT NULL DEFAULT 0,
+    cache_hits INT NOT NULL DEFAULT 0,
+    total_latency_hist INT[] NOT NULL,
+    llm_latency_hist INT[] NOT NULL,
+    embedding_latency_hist INT[] NOT NULL,
+    retrieval_latency_hist INT[] NOT NULL,
+    send_latency_hist INT[] NOT NULL,
+    PRIMARY KEY (chat_id, hour, model)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_usage_hourly_hour ON chat_usage_hourly (hour);
+
+-- ========= Embedding Size / Storage Type =========
+
+-- chat_memories.embedding above is VECTOR(1536). To store smaller embeddings, e.g. 512-dim float16
+-- (EMBEDDING_DIMENSIONS=512, EMBEDDING_STORAGE_TYPE=halfvec, pgvector >= 0.7), migrate existing rows with:
+--   python -m api.migrate_embeddings --dimensions 512 --type halfvec
+-- which ends with the equivalent of:
+--   embedding HALFVEC(512) NOT NULL
+--   CREATE INDEX idx_chat_memories_embedding_hnsw ON chat_memories USING hnsw (embedding halfvec_cosine_ops)
+--   WITH (m = 16, ef_construction = 64);
+-- Change the settings only after the swap; see migrate_embeddings.py for the order.
+
+-- ========= Embedding Provenance =========
+
+-- Model that produced each row's embedding (NULL = written before this column existed).
+-- Lets reembed_memories.py find rows that are stale after EMBEDDING_MODEL changes.
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS embedding_model TEXT NULL;
+
+-- ========= Multi-Bot Hosting =========
+
+-- Bot (Telegram user ID of the bot, see bot_registry.py) whose memory each row is. Every memory
+-- query filters on it, so bots hosted by the same API keep separate memories, also in a chat they share.
+-- Rows written before this column get 0 and are read as the primary bot's (database.memory_bot_ids),
+-- which keeps them without rewriting the whole table and its HNSW index.
+ALTER TABLE chat_memories ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+
+-- Each bot receives (and stores) its own copy of a message, so message IDs are unique per bot and chat
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_memories_bot_chat_message ON chat_memories (bot_id, chat_id, message_id);
+ALTER TABLE chat_memories DROP CONSTRAINT IF EXISTS chat_memories_chat_id_message_id_key;
+
+-- Usage rollups are kept per bot too, so bots sharing a chat don't add up into one row
+-- (rows from before this column get 0)
+ALTER TABLE chat_usage_hourly ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_usage_hourly_bot_chat_hour_model
+    ON chat_usage_hourly (bot_id, chat_id, hour, model);
+ALTER TABLE chat_usage_hourly DROP CONSTRAINT IF EXISTS chat_usage_hourly_pkey;
+
+-- ========= Persona Prompt Cache =========
+
+-- Persona prompts generated by /set_personality (see persona_cache.py), keyed by the normalized
+-- description and the model that generated them, so a popular description is generated only once.
+CREATE TABLE IF NOT EXISTS persona_prompts (
+    description_key TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (description_key, model)
+);
+
+-- ========= Scheduled Jobs =========
+
+-- Last run of each maintenance job (see scheduler.py), shared by all replicas. Replicas take the job's
+-- advisory lock and claim a run here, so each scheduled run happens on one replica only.
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    name TEXT PRIMARY KEY,
+    last_started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_finished_at TIMESTAMP WITH TIME ZONE NULL,
+    last_status TEXT NULL, -- 'ok', 'failed' or 'timeout'
+    last_duration_ms INT NULL,
+    last_error TEXT NULL,
+    runs BIGINT NOT NULL DEFAULT 0,
+    failures BIGINT NOT NULL DEFAULT 0
+);
+
+-- ========= Group Settings Cache Invalidation =========
+
+-- API replicas cache group rows (see group_cache.py) and LISTEN on this channel
+-- (repository.GROUP_INVALIDATION_CHANNEL). Notifying from a trigger covers every change, including
+-- manual SQL such as rate limit overrides. Notifications are sent on commit, once per chat per transaction.
+CREATE OR REPLACE FUNCTION notify_group_change()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM pg_notify('group_settings_changed', COALESCE(NEW.chat_id, OLD.chat_id)::TEXT);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notify_group_change ON groups;
+CREATE TRIGGER notify_group_change
+AFTER UPDATE OR DELETE ON groups
+FOR EACH ROW
+EXECUTE FUNCTION notify_group_change();
@@ -0,0 +1,56 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+# Import settings
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SeenUpdates:
+    """
+    Recently received update IDs, keyed by (bot_id, update_id), so redelivered updates are acked
+    without being handled again.
+
+    The listener's spool delivers at least once: a forward that times out after the API has
+    handled the update is posted again. An update is claimed when it arrives, and released if
+    handling fails, so the retry of a failed update still runs. Entries expire after
+    `ttl_seconds` (longer than the spool's retry backoff) and the oldest are evicted beyond
+    `max_entries`. State is per process, so a redelivery that reaches another replica is handled again.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict() # Key -> arrival (monotonic), oldest first
+        self.duplicates = 0
+
+    def claim(self, key: Hashable) -> bool:
+        """Returns True for the first arrival of an update, False for a redelivery."""
+        now = time.monotonic()
+        cutoff = now - self.ttl_seconds
+        while self._seen:
+            oldest_key, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) < self.max_entries:
+                break
+            del self._seen[oldest_key]
+        if key in self._seen:
+            self.duplicates += 1
+            return False
+        self._seen[key] = now
+        return True
+
+    def release(self, key: Hashable):
+        """Forgets an update whose handling failed, so its redelivery is handled."""
+        self._seen.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._seen), "duplicates": self.duplicates}
+
+
+seen = SeenUpdates(
+    ttl_seconds=settings.UPDATE_DEDUP_TTL_SECONDS if settings else 900.0,
+    max_entries=settings.UPDATE_DEDUP_MAX_ENTRIES if settings else 100_000,
+)
@@ -0,0 +1,88 @@
+"""
+Lean typed view of Telegram updates, decoded straight from request bytes with msgspec.
+
+Only the fields the webhook pipeline reads are declared; everything else in the payload
+(entities, photos, names, ...) is skipped by the decoder without being materialized.
+Structs are created with gc=False since they never form reference cycles.
+
+The getUpdates envelope is decoded the same way, with each update left as a Raw slice of
+the response body so the listener can forward the original bytes untouched.
+"""
+
+from typing import Optional
+
+import msgspec
+
+
+class User(msgspec.Struct, gc=False):
+    id: int
+    username: Optional[str] = None
+    first_name: str = ""
+
+
+class Chat(msgspec.Struct, gc=False):
+    id: int
+    type: str = ""
+
+
+class RepliedMessage(msgspec.Struct, gc=False):
+    message_id: int = 0
+    sender: Optional[User] = msgspec.field(default=None, name="from")
+
+
+class Message(msgspec.Struct, gc=False):
+    message_id: int
+    date: int
+    chat: Chat
+    sender: Optional[User] = msgspec.field(default=None, name="from")
+    text: Optional[str] = None
+    reply_to_message: Optional[RepliedMessage] = None
+
+
+class Update(msgspec.Struct, gc=False):
+    update_id: int
+    message: Optional[Message] = None
+    edited_message: Optional[Message] = None
+    channel_post: Optional[Message] = None
+    edited_channel_post: Optional[Message] = None
+
+
+class ResponseParameters(msgspec.Struct, gc=False):
+    retry_after: Optional[int] = None
+
+
+class GetUpdatesResponse(msgspec.Struct, gc=False):
+    ok: bool
+    result: list[msgspec.Raw] = []
+    description: str = ""
+    parameters: Optional[ResponseParameters] = None
+
+
+class _UpdateId(msgspec.Struct, gc=False):
+    update_id: int
+
+
+_decoder = msgspec.json.Decoder(Update)
+_get_updates_decoder = msgspec.json.Decoder(GetUpdatesResponse)
+_update_id_decoder = msgspec.json.Decoder(_UpdateId)
+_encoder = msgspec.json.Encoder()
+
+# Raised by decode_update for malformed JSON (and, as ValidationError, for missing/mistyped fields)
+DecodeError = msgspec.DecodeError
+
+def decode_update(body: bytes) -> Update:
+    return _decoder.decode(body)
+
+def decode_get_updates(body: bytes) -> GetUpdatesResponse:
+    return _get_updates_decoder.decode(body)
+
+def peek_update_id(raw: msgspec.Raw) -> int:
+    """Reads update_id from a raw update, skipping the rest of it."""
+    return _update_id_decoder.decode(raw).update_id
+
+def decode_raw(body: bytes) -> dict:
+    """Decodes the full payload as plain dicts/lists (e.g. for update capture)."""
+    return msgspec.json.decode(body)
+
+def encode(value) -> bytes:
+    return _encoder.encode(value)
@@ -1,3 +1,4 @@
+import asyncio
 import httpx
 import os
 import logging
@@ -5,106 +6,145 @@ from typing import Optional
 
 # Import settings
 from .config import settings
+# Import database functions (bot identity cache)
+from . import database
+# Import the hosted bots (token and identity per bot)
+from . import bot_registry
+from .bot_registry import Bot
 
 logger = logging.getLogger(__name__)
 
-# BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") # Replaced by settings
-if not settings or not settings.TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN not found in settings. Cannot send messages or fetch bot info.")
-    # Allow running, but functions will fail
+# One client for all bots, so connections to api.telegram.org are reused across requests
+_client: Optional[httpx.AsyncClient] = None
 
-BOT_USERNAME: Optional[str] = None # To store the bot's username
-BOT_USER_ID: Optional[int] = None  # To store the bot's user ID
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return _client
 
-async def fetch_bot_info():
-    """Gets the bot's username and ID using the getMe method and stores them globally."""
-    global BOT_USERNAME, BOT_USER_ID # Allow modification of global variables
-    if BOT_USERNAME and BOT_USER_ID: # Return if cached already
+async def close_client():
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+async def ensure_bot_info(bot: Optional[Bot] = None) -> bool:
+    """
+    Resolves a bot's username (the current bot by default) as cheaply as possible: settings first,
+    then the cached bot_identity row, and only then the getMe API (whose result is cached for next time).
+    The user ID is known from the token. Returns True if both username and ID are available.
+    """
+    bot = bot or bot_registry.current()
+    if not bot:
+        return False
+    if bot.username and bot.user_id:
+        return True
+
+    cached_username = await database.get_bot_identity(bot.user_id)
+    if cached_username:
+        logger.info("Loaded bot identity from database cache: Username=%s, ID=%s", cached_username, bot.user_id)
+        bot.username = cached_username
+        return True
+
+    await fetch_bot_info(bot)
+    if bot.username and bot.user_id:
+        await database.save_bot_identity(bot.user_id, bot.username)
+        return True
+    return False
+
+async def ensure_all_bot_info() -> bool:
+    """Resolves every hosted bot's identity concurrently. Returns True if all were resolved."""
+    results = await asyncio.gather(*(ensure_bot_info(bot) for bot in bot_registry.registry))
+    return all(results)
+
+async def fetch_bot_info(bot: Bot):
+    """Gets the bot's username and ID using the getMe method and stores them on the bot."""
+    if bot.username and bot.user_id: # Return if cached already
         logger.debug("Bot info already cached.")
         return
-        
-    if not settings or not settings.TELEGRAM_BOT_TOKEN:
-        logger.error("Cannot get bot info: TELEGRAM_BOT_TOKEN not configured.")
-        return
 
-    api_url = f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/getMe"
+    api_url = f"https://api.telegram.org/bot{bot.token}/getMe"
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(api_url, timeout=10.0)
-            response_data = response.json()
-            
-            if response.status_code == 200 and response_data.get("ok"):
-                bot_info = response_data.get("result", {})
-                username = bot_info.get("username")
-                user_id = bot_info.get("id")
-                
-                if username and user_id:
-                    full_username = f"@{username}"
-                    logger.info(f"Successfully retrieved bot info: Username={full_username}, ID={user_id}")
-                    BOT_USERNAME = full_username # Cache the username with @
-                    BOT_USER_ID = user_id        # Cache the user ID
-                else:
-                    logger.error(f"Failed to extract username or ID from getMe response: {bot_info}")
+        response = await get_client().get(api_url)
+        response_data = response.json()
+
+        if response.status_code == 200 and response_data.get("ok"):
+            bot_info = response_data.get("result", {})
+            username = bot_info.get("username")
+            user_id = bot_info.get("id")
+
+            if username and user_id:
+                full_username = f"@{username}"
+                logger.info("Successfully retrieved bot info: Username=%s, ID=%s", full_username, user_id)
+                bot.username = full_username # Cache the username with @ (the ID is the token's prefix)
             else:
-                error_description = response_data.get('description', 'Unknown error')
-                status_code = response.status_code
-                logger.error(f"Failed to call getMe. Status: {status_code}, Error: {error_description}")
-                
+                logger.error("Failed to extract username or ID from getMe response: %s", bot_info)
+        else:
+            error_description = response_data.get('description', 'Unknown error')
+            status_code = response.status_code
+            logger.error("Failed to call getMe for bot %s. Status: %s, Error: %s", bot.user_id, status_code, error_description)
+
     except httpx.RequestError as e:
-        logger.error(f"HTTP request failed during getMe call: {e}")
+        logger.error("HTTP request failed during getMe call for bot %s: %s", bot.user_id, e)
     except Exception as e:
-        logger.error(f"Unexpected error during getMe call: {e}")
+        logger.error("Unexpected error during getMe call for bot %s: %s", bot.user_id, e)
 
-async def send_telegram_message(chat_id: int, text: str) -> dict:
+async def send_telegram_message(chat_id: int, text: str, reply_to_message_id: Optional[int] = None,
+                                bot: Optional[Bot] = None) -> dict:
     """
     Sends a text message to a specific Telegram chat using the Bot API.
 
     Args:
         chat_id: The target chat ID.
         text: The message text to send.
+        reply_to_message_id: Optional message to reply to (sent as a normal message if it was deleted).
+        bot: The bot to send as (defaults to the bot of the current request).
 
     Returns:
         A dictionary: {"success": True, "message_id": int} on success,
         or {"success": False} on failure.
     """
-    if not settings or not settings.TELEGRAM_BOT_TOKEN:
-        logger.error("Cannot send message: TELEGRAM_BOT_TOKEN not configured.")
+    bot = bot or bot_registry.current()
+    if not bot:
+        logger.error("Cannot send message: no bot configured.")
         return {"success": False}
 
-    api_url = f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage"
+    api_url = f"https://api.telegram.org/bot{bot.token}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text,
         # Optional: Add parse_mode="MarkdownV2" or "HTML" if needed
-        # "parse_mode": "MarkdownV2" 
+        # "parse_mode": "MarkdownV2"
     }
+    if reply_to_message_id:
+        payload["reply_parameters"] = {"message_id": reply_to_message_id, "allow_sending_without_reply": True}
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(api_url, json=payload, timeout=10.0)
-            response_data = response.json()
-            
-            if response.status_code == 200 and response_data.get("ok"):
-                logger.info(f"Successfully sent message to chat {chat_id}")
-                # Extract the message_id of the sent message
-                sent_message_id = response_data.get("result", {}).get("message_id")
-                if sent_message_id:
-                    return {"success": True, "message_id": sent_message_id}
-                else:
-                    logger.error(f"Sent message OK, but could not extract message_id from response: {response_data}")
-                    return {"success": False} # Treat as failure if ID is missing
+        response = await get_client().post(api_url, json=payload)
+        response_data = response.json()
+
+        if response.status_code == 200 and response_data.get("ok"):
+            logger.info("Successfully sent message to chat %s", chat_id)
+            # Extract the message_id of the sent message
+            sent_message_id = response_data.get("result", {}).get("message_id")
+            if sent_message_id:
+                return {"success": True, "message_id": sent_message_id}
             else:
-                # Log the error description provided by Telegram API
-                error_description = response_data.get('description', 'Unknown error')
-                status_code = response.status_code
-                logger.error(f"Failed to send message to chat {chat_id}. Status: {status_code}, Error: {error_description}")
-                logger.debug(f"Telegram API raw error response: {response_data}")
-                return {"success": False}
-                
+                logger.error("Sent message OK, but could not extract message_id from response: %s", response_data)
+                return {"success": False} # Treat as failure if ID is missing
+        else:
+            # Log the error description provided by Telegram API
+            error_description = response_data.get('description', 'Unknown error')
+            status_code = response.status_code
+            logger.error("Failed to send message to chat %s. Status: %s, Error: %s", chat_id, status_code, error_description)
+            logger.debug("Telegram API raw error response: %s", response_data)
+            return {"success": False}
+
     except httpx.RequestError as e:
-        logger.error(f"HTTP request failed when sending message to chat {chat_id}: {e}")
+        logger.error("HTTP request failed when sending message to chat %s: %s", chat_id, e)
         return {"success": False}
     except Exception as e:
-        logger.error(f"Unexpected error sending message to chat {chat_id}: {e}")
-        return {"success": False} 
\ No newline at end of file
+        logger.error("Unexpected error sending message to chat %s: %s", chat_id, e)
+        return {"success": False}
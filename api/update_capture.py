@@ -0,0 +1,161 @@
+"""
+Capture of incoming Telegram updates to a gzip-compressed JSONL file, for load replay
+(see replay_updates.py).
+
+Each line is {"t": <unix receive time>, "update": <update payload>}. Writes go through a
+queue to a background thread, so recording never blocks the event loop; if the queue is
+full, updates are dropped and counted rather than delaying the caller.
+
+With anonymization, chat/user IDs are replaced by stable keyed hashes (so per-chat and
+per-user arrival patterns survive), names are dropped, and usernames are replaced, except
+the bots' own user IDs and usernames, which keep reply and mention triggers working on replay. With
+anonymize_text, message text is also replaced by filler of the same length, keeping
+/commands, @mentions and whitespace.
+
+This module only uses the standard library so the bot listener can import it too.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import re
+import secrets
+import threading
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+_ID_FIELDS = ("id", "user_id", "sender_chat_id")
+_DROPPED_FIELDS = ("first_name", "last_name", "title", "phone_number", "bio", "description", "url")
+_TEXT_FIELDS = ("text", "caption")
+_KEPT_TOKEN_RE = re.compile(r"(^/\w+(@\w+)?|@\w+|\s+)")
+
+
+class Anonymizer:
+    def __init__(self, salt: str, keep_usernames: tuple = (), anonymize_text: bool = False, keep_ids: tuple = ()):
+        self.salt = salt.encode()
+        self.keep_usernames = {u.lower().lstrip("@") for u in keep_usernames if u}
+        self.keep_ids = {int(i) for i in keep_ids if str(i).isdigit()}
+        self.anonymize_text = anonymize_text
+
+    def _hash(self, value: Any) -> int:
+        digest = hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], "big") # 48 bits: fits Telegram's ID range
+
+    def anon_id(self, value: int) -> int:
+        if value in self.keep_ids:
+            return value
+        # Keep the sign: negative IDs mark group chats
+        return -self._hash(value) if value < 0 else self._hash(value)
+
+    def anon_username(self, username: str) -> str:
+        if username.lower() in self.keep_usernames:
+            return username
+        # Same length as the original, so message entity offsets stay valid
+        digest = hmac.new(self.salt, username.lower().encode(), hashlib.sha256).hexdigest()
+        return ("u" + digest)[:len(username)]
+
+    def anon_text(self, text: str) -> str:
+        parts = []
+        for part in _KEPT_TOKEN_RE.split(text):
+            if not part:
+                continue
+            if _KEPT_TOKEN_RE.fullmatch(part):
+                parts.append(part if not part.startswith("@") else "@" + self.anon_username(part[1:]))
+            else:
+                parts.append("x" * len(part))
+        return "".join(parts)
+
+    def apply(self, value: Any, key: Optional[str] = None) -> Any:
+        if isinstance(value, dict):
+            result = {}
+            for k, v in value.items():
+                if k in _DROPPED_FIELDS:
+                    continue
+                result[k] = self.apply(v, k)
+            return result
+        if isinstance(value, list):
+            return [self.apply(v, key) for v in value]
+        if key in _ID_FIELDS and isinstance(value, int) and not isinstance(value, bool):
+            return self.anon_id(value)
+        if key == "username" and isinstance(value, str):
+            return self.anon_username(value)
+        if key in _TEXT_FIELDS and isinstance(value, str):
+            if self.anonymize_text:
+                return self.anon_text(value)
+            # Mentions of other users are still replaced
+            return re.sub(r"@(\w+)", lambda m: "@" + self.anon_username(m.group(1)), value)
+        return value
+
+
+class CaptureWriter:
+    """Appends updates to a gzip JSONL capture file from a background thread."""
+
+    def __init__(self, path: str, anonymizer: Optional[Anonymizer] = None, max_queue: int = 10_000):
+        self.path = path
+        self.anonymizer = anonymizer
+        self.written = 0
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="update-capture", daemon=True)
+        self._thread.start()
+        logger.info("Capturing updates to %s (anonymized=%s).", path, anonymizer is not None)
+
+    def write(self, update: dict):
+        try:
+            self._queue.put_nowait((time.time(), update))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        # Append mode: gzip members concatenate, so restarts extend the same capture
+        with gzip.open(self.path, "at", encoding="utf-8", compresslevel=6) as out:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                received_at, update = item
+                try:
+                    if self.anonymizer:
+                        update = self.anonymizer.apply(update)
+                    out.write(json.dumps({"t": round(received_at, 3), "update": update}, separators=(",", ":")))
+                    out.write("\n")
+                    self.written += 1
+                except Exception as e:
+                    logger.error("Failed to capture update: %s", e)
+                if self._queue.empty():
+                    out.flush()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        logger.info("Update capture closed: %s written, %s dropped.", self.written, self.dropped)
+
+    def stats(self) -> dict:
+        return {"path": self.path, "written": self.written, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+
+def open_capture(path: Optional[str], anonymize: bool, salt: Optional[str] = None, keep_usernames: tuple = (),
+                 anonymize_text: bool = False, keep_ids: tuple = ()) -> Optional[CaptureWriter]:
+    """
+    Returns a CaptureWriter for `path`, or None when capture is disabled (no path).
+    Without a salt, a random one is used, so hashed IDs differ between runs.
+    `keep_usernames` and `keep_ids` are the hosted bots' usernames and user IDs, kept as is.
+    """
+    if not path:
+        return None
+    salt = salt or secrets.token_hex(16)
+    anonymizer = Anonymizer(salt, keep_usernames, anonymize_text, keep_ids) if anonymize else None
+    return CaptureWriter(path, anonymizer)
+
+def read_capture(path: str):
+    """Yields (receive_time, update) from a capture file."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record["t"], record["update"]
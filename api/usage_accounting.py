@@ -0,0 +1,308 @@
+"""
+Per-chat usage and latency accounting.
+
+Each webhook request gets a RequestUsage in a context variable (start()/finish()). The LLM
+and embedding wrappers add token counts and call latencies to it, and the reply pipeline
+times its stages with timed(). When the request finishes, its totals are added to in-memory
+aggregates keyed by (bot, chat, hour, completion model). A background task writes the aggregates
+to chat_usage_hourly in one bulk upsert every USAGE_FLUSH_INTERVAL_SECONDS.
+
+Latencies are kept as histograms over LATENCY_BUCKETS_MS, which add up across requests,
+flushes and replicas, so percentiles can be computed for any time range afterwards.
+
+Replies never wait on accounting: recording only touches in-memory counters, and a flush
+is skipped (and retried next interval) when the pool has no idle connection.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Optional
+
+# Import settings
+from .config import settings
+from . import database
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets; a final bucket counts everything slower
+LATENCY_BUCKETS_MS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000)
+STAGES = ("total", "llm", "embedding", "retrieval", "send")
+
+
+class RequestUsage:
+    """Usage of one webhook request."""
+    __slots__ = ("bot_id", "chat_id", "model", "prompt_tokens", "completion_tokens", "embedding_tokens",
+                 "cost_usd", "cache_hits", "error", "stages")
+
+    def __init__(self, bot_id: int, chat_id: int):
+        self.bot_id = bot_id
+        self.chat_id = chat_id
+        self.model = "" # Completion model; "" if the request made no chat completion
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.cost_usd = 0.0
+        self.cache_hits = 0
+        self.error = False
+        self.stages: dict[str, float] = {} # Stage -> seconds, summed over the request
+
+    def add_stage(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @property
+    def empty(self) -> bool:
+        return not (self.stages or self.embedding_tokens or self.prompt_tokens)
+
+
+class ChatUsage:
+    """Aggregated usage for one (bot, chat, hour, model)."""
+    __slots__ = ("requests", "errors", "prompt_tokens", "completion_tokens", "embedding_tokens",
+                 "cost_usd", "cache_hits", "histograms")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.cost_usd = 0.0
+        self.cache_hits = 0
+        self.histograms = {stage: [0] * (len(LATENCY_BUCKETS_MS) + 1) for stage in STAGES}
+
+    def add(self, usage: RequestUsage):
+        self.requests += 1
+        self.errors += usage.error
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.embedding_tokens += usage.embedding_tokens
+        self.cost_usd += usage.cost_usd
+        self.cache_hits += usage.cache_hits
+        for stage, seconds in usage.stages.items():
+            histogram = self.histograms.get(stage)
+            if histogram is not None:
+                histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def merge(self, other: "ChatUsage"):
+        for name in ("requests", "errors", "prompt_tokens", "completion_tokens", "embedding_tokens", "cost_usd", "cache_hits"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for stage, histogram in other.histograms.items():
+            self.histograms[stage] = [a + b for a, b in zip(self.histograms[stage], histogram)]
+
+
+def percentile_ms(histogram: list[int], q: float) -> Optional[int]:
+    """Upper bound of the bucket containing the q-th percentile (the last bound for the overflow bucket)."""
+    total = sum(histogram)
+    if not total:
+        return None
+    running = 0
+    for i, count in enumerate(histogram):
+        running += count
+        if running >= q * total:
+            return LATENCY_BUCKETS_MS[min(i, len(LATENCY_BUCKETS_MS) - 1)]
+    return LATENCY_BUCKETS_MS[-1]
+
+
+_current: contextvars.ContextVar[Optional[RequestUsage]] = contextvars.ContextVar("request_usage", default=None)
+_pending: dict[tuple[int, int, int, str], ChatUsage] = {} # (bot_id, chat_id, hour start (unix), model) -> usage
+_flusher: Optional[asyncio.Task] = None
+flush_stats = {"flushes": 0, "rows": 0, "skipped_busy": 0, "failures": 0, "dropped": 0}
+
+def _enabled() -> bool:
+    return bool(settings and settings.USAGE_ACCOUNTING_ENABLED)
+
+def start(chat_key: tuple[int, int]):
+    """Begins accounting for the current request. `chat_key` is (bot_id, chat_id) (bot_registry.chat_key())."""
+    if _enabled():
+        _current.set(RequestUsage(*chat_key))
+
+def finish():
+    """Adds the current request's usage to the per-chat aggregates."""
+    usage = _current.get()
+    if usage is None:
+        return
+    _current.set(None)
+    if usage.empty:
+        return
+    key = (usage.bot_id, usage.chat_id, int(time.time() // 3600 * 3600), usage.model)
+    aggregate = _pending.get(key)
+    if aggregate is None:
+        aggregate = _pending[key] = ChatUsage()
+    aggregate.add(usage)
+
+def _price(model: str) -> tuple[float, float]:
+    table = settings.USAGE_PRICES_PER_MILLION_TOKENS if settings else {}
+    prices = table.get(model)
+    if not prices:
+        # Dated snapshots ("gpt-4o-mini-2024-07-18") bill like their base model
+        base = max((name for name in table if model.startswith(name + "-")), key=len, default=None)
+        prices = table.get(base) if base else None
+    return (prices[0], prices[1] if len(prices) > 1 else 0.0) if prices else (0.0, 0.0)
+
+def record_completion(model: str, usage: Any, seconds: float):
+    """Records a chat completion (`usage` is the response's usage object, may be None)."""
+    current = _current.get()
+    if current is None:
+        return
+    current.model = model
+    current.add_stage("llm", seconds)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    current.prompt_tokens += prompt_tokens
+    current.completion_tokens += completion_tokens
+    input_price, output_price = _price(model)
+    current.cost_usd += (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+def record_embedding(model: str, usage: Any, seconds: float):
+    current = _current.get()
+    if current is None:
+        return
+    current.add_stage("embedding", seconds)
+    tokens = (getattr(usage, "total_tokens", 0) or 0) if usage is not None else 0
+    current.embedding_tokens += tokens
+    current.cost_usd += tokens * _price(model)[0] / 1e6
+
+def record_cache_hit(count: int = 1):
+    """Counts work avoided by a cache (e.g. an embedding reused for a duplicate message)."""
+    current = _current.get()
+    if current is not None:
+        current.cache_hits += count
+
+def record_error():
+    current = _current.get()
+    if current is not None:
+        current.error = True
+
+@contextmanager
+def timed(stage: str):
+    """Adds the duration of the block to a stage of the current request."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = _current.get()
+        if current is not None:
+            current.add_stage(stage, time.perf_counter() - start_time)
+
+# --- Flushing ---
+
+def _rows(snapshot: dict) -> list[tuple]:
+    return [
+        (bot_id, chat_id, hour, model, usage.requests, usage.errors, usage.prompt_tokens, usage.completion_tokens,
+         usage.embedding_tokens, usage.cost_usd, usage.cache_hits, *(usage.histograms[stage] for stage in STAGES))
+        for (bot_id, chat_id, hour, model), usage in snapshot.items()
+    ]
+
+def _restore(snapshot: dict):
+    """Puts an unflushed snapshot back, unless too much has piled up."""
+    for key, usage in snapshot.items():
+        existing = _pending.get(key)
+        if existing is not None:
+            existing.merge(usage)
+        elif len(_pending) < settings.USAGE_MAX_PENDING_ROWS:
+            _pending[key] = usage
+        else:
+            flush_stats["dropped"] += 1
+
+async def flush(force: bool = False) -> int:
+    """Writes pending aggregates in one bulk upsert. Returns the number of rows written."""
+    global _pending
+    if not _pending:
+        return 0
+    repo = database.repository # Never creates the pool just for accounting
+    if not repo or not repo.pool:
+        return 0
+    if not force and repo.pool.get_idle_size() == 0:
+        # Every connection is serving requests; writing now could make a reply wait for one
+        flush_stats["skipped_busy"] += 1
+        return 0
+    snapshot, _pending = _pending, {}
+    try:
+        await repo.record_chat_usage(_rows(snapshot))
+    except Exception as e:
+        flush_stats["failures"] += 1
+        logger.warning("Could not flush usage for %s chat rollups: %s", len(snapshot), e)
+        _restore(snapshot)
+        return 0
+    flush_stats["flushes"] += 1
+    flush_stats["rows"] += len(snapshot)
+    return len(snapshot)
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(settings.USAGE_FLUSH_INTERVAL_SECONDS)
+        try:
+            written = await flush()
+            if written:
+                logger.debug("Flushed %s usage rollup rows.", written)
+        except Exception as e:
+            logger.error("Usage flush loop error: %s", e)
+
+def start_flusher():
+    """Starts the periodic flush task (from the app lifespan)."""
+    global _flusher
+    if _enabled() and _flusher is None:
+        _flusher = asyncio.create_task(_flush_loop())
+
+async def stop_flusher():
+    """Stops the flush task and writes whatever is still pending."""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        await asyncio.gather(_flusher, return_exceptions=True)
+        _flusher = None
+    await flush(force=True)
+
+def stats() -> dict:
+    return {"enabled": _enabled(), "pending_rows": len(_pending), **flush_stats}
+
+# --- Reporting ---
+
+async def top_chats(hours: float, sort: str, limit: int) -> list[dict]:
+    """Top (bot, chat) pairs over the last `hours` by "cost" or "p95" (total latency), with per-stage percentiles."""
+    repo = await database.get_repository()
+    if not repo:
+        return []
+    since = time.time() - hours * 3600
+    ranked = await repo.top_chat_usage(since, sort, limit, list(LATENCY_BUCKETS_MS))
+    details = await repo.chat_usage_rows([row["chat_id"] for row in ranked], since)
+
+    per_chat: dict[tuple[int, int], dict] = {}
+    for row in details:
+        chat = per_chat.setdefault((row["bot_id"], row["chat_id"]), {"aggregate": ChatUsage(), "models": {}})
+        usage = ChatUsage()
+        for name in ("requests", "errors", "prompt_tokens", "completion_tokens", "embedding_tokens", "cost_usd", "cache_hits"):
+            setattr(usage, name, row[name])
+        usage.histograms = {stage: list(row[f"{stage}_latency_hist"]) for stage in STAGES}
+        chat["aggregate"].merge(usage)
+        model = row["model"] or "none"
+        chat["models"][model] = chat["models"].get(model, 0) + row["requests"]
+
+    results = []
+    for row in ranked:
+        chat = per_chat.get((row["bot_id"], row["chat_id"]))
+        if not chat:
+            continue
+        usage = chat["aggregate"]
+        results.append({
+            "bot_id": row["bot_id"],
+            "chat_id": row["chat_id"],
+            "requests": usage.requests,
+            "errors": usage.errors,
+            "cost_usd": round(usage.cost_usd, 4),
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "embedding_tokens": usage.embedding_tokens,
+            "cache_hits": usage.cache_hits,
+            "models": chat["models"],
+            "latency_ms": {
+                stage: {"p50": percentile_ms(usage.histograms[stage], 0.5), "p95": percentile_ms(usage.histograms[stage], 0.95)}
+                for stage in STAGES if sum(usage.histograms[stage])
+            },
+        })
+    return results
@@ -2,43 +2,118 @@
 # This might run as a separate persistent process
 
 import asyncio
+import functools
+import hashlib
 import logging
 import os
+import sys
+import time
 import httpx
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters.command import Command
 from aiogram.types import Update
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from spool import Spool
+
+# Shared modules from api/ (standard library only, no API settings needed)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+import logging_setup
+
+# Configure logging once for the process: JSON records, written off the event loop
+logging_setup.configure_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    json_format=os.getenv("LOG_FORMAT", "json") == "json"
+)
+# httpx logs every request URL at INFO, and getUpdates URLs contain the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Get bot token and API base URL from environment variables
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Several bots can share one listener in raw mode: comma-separated tokens (instead of TELEGRAM_BOT_TOKEN)
+BOT_TOKENS = [token.strip() for token in os.getenv("TELEGRAM_BOT_TOKENS", "").split(",") if token.strip()] or (
+    [BOT_TOKEN] if BOT_TOKEN else [])
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000") # Default for local dev
+# "aiogram": aiogram polls and builds Update models. "raw": the listener long-polls getUpdates
+# itself and forwards each update's original JSON bytes, without building models (needs msgspec).
+LISTENER_MODE = os.getenv("LISTENER_MODE", "aiogram").lower()
+POLL_TIMEOUT_SECONDS = int(os.getenv("POLL_TIMEOUT_SECONDS", "50"))
+FORWARD_CONCURRENCY = int(os.getenv("FORWARD_CONCURRENCY", "100")) # Max updates being forwarded at once
+# The API answers triggered messages before responding, so this must cover an LLM reply; a forward
+# that times out is retried (the API ignores the redelivery if it already handled the update)
+FORWARD_TIMEOUT_SECONDS = float(os.getenv("FORWARD_TIMEOUT_SECONDS", "120"))
+# Optional durable spool (SQLite file): updates are stored before being confirmed to Telegram and
+# forwarded from there, so API outages and deploys don't lose them. With several bots, each gets
+# its own file, named after the bot ID (spool.db -> spool.<bot_id>.db).
+SPOOL_PATH = os.getenv("SPOOL_PATH")
 
-if not BOT_TOKEN:
-    logging.error("Error: TELEGRAM_BOT_TOKEN environment variable not set.")
+if not BOT_TOKENS:
+    logging.error("Error: TELEGRAM_BOT_TOKEN (or TELEGRAM_BOT_TOKENS) environment variable not set.")
     exit()
+if len(BOT_TOKENS) > 1 and LISTENER_MODE != "raw":
+    logging.error("Error: polling several bots (TELEGRAM_BOT_TOKENS) needs LISTENER_MODE=raw.")
+    exit()
+
+# Optional capture of received updates for load replay (same format as the API's CAPTURE_UPDATES_PATH)
+CAPTURE_UPDATES_PATH = os.getenv("CAPTURE_UPDATES_PATH")
+capture = None
+if CAPTURE_UPDATES_PATH:
+    import update_capture
+    capture = update_capture.open_capture(
+        CAPTURE_UPDATES_PATH,
+        anonymize=os.getenv("CAPTURE_ANONYMIZE", "true").lower() != "false",
+        salt=os.getenv("CAPTURE_ANONYMIZE_SALT"),
+        keep_usernames=(os.getenv("BOT_USERNAME", ""),),
+        keep_ids=tuple(token.split(":", 1)[0] for token in BOT_TOKENS), # A bot's user ID prefixes its token
+        anonymize_text=os.getenv("CAPTURE_ANONYMIZE_TEXT", "false").lower() == "true"
+    )
+
+if LISTENER_MODE == "raw":
+    import telegram_types
 
 # Initialize bot and dispatcher
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKENS[0])
 dp = Dispatcher()
 
-async def forward_to_api(update: Update):
-    """Forwards the relevant update data to the FastAPI backend."""
-    api_endpoint = f"{API_BASE_URL}/api/webhook"
+# Shared client for forwarding, so connections to the API are kept alive between updates
+api_client: httpx.AsyncClient | None = None
+spool: "Spool | None" = None # aiogram mode's spool
+
+def webhook_url(token: str) -> str:
+    """The API route for a bot's updates (the key is api/bot_registry.webhook_key, which needs API settings)."""
+    return f"{API_BASE_URL}/api/webhook/{hashlib.sha256(token.encode()).hexdigest()[:32]}"
+
+def spool_path(token: str) -> str:
+    if len(BOT_TOKENS) == 1:
+        return SPOOL_PATH
+    root, extension = os.path.splitext(SPOOL_PATH)
+    return f"{root}.{token.split(':', 1)[0]}{extension}"
+
+async def forward_to_api(body: bytes | str, api_endpoint: str, received_at: float | None = None) -> bool:
+    """
+    Forwards an update's JSON body to the bot's route on the FastAPI backend. Returns False if the
+    attempt should be retried (API unreachable, overloaded or failing), True otherwise.
+    `received_at` (unix time the listener got the update) lets the API measure queue age.
+    """
+    headers = {"Content-Type": "application/json"}
+    if received_at:
+        headers["X-Received-At"] = f"{received_at:.3f}"
     try:
-        async with httpx.AsyncClient() as client:
-            # Convert the Update object to a dictionary for JSON serialization
-            update_data = update.model_dump(mode='json') # Use model_dump for pydantic v2
-            response = await client.post(api_endpoint, json=update_data, timeout=10.0)
-            response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-            logging.info(f"Successfully forwarded update to API. Status: {response.status_code}")
+        response = await api_client.post(api_endpoint, content=body, headers=headers)
+        response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
+        logging.info("Successfully forwarded update to API. Status: %s", response.status_code)
+        return True
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
+        logging.error("API rejected update. Status: %s", status)
+        # Other 4xx mean the update itself is bad; retrying won't help
+        return not (status >= 500 or status in (408, 429))
     except httpx.RequestError as e:
-        logging.error(f"Could not forward update to API: {e}")
+        logging.error("Could not forward update to API: %s", e)
+        return False
     except Exception as e:
-        logging.error(f"An unexpected error occurred during API forwarding: {e}")
+        logging.error("An unexpected error occurred during API forwarding: %s", e)
+        return False
 
 @dp.message(Command("start"))
 async def handle_start(message: types.Message, bot: Bot):
@@ -49,7 +124,7 @@ async def handle_start(message: types.Message, bot: Bot):
     # await message.answer("Processing /start...") # Optional: Give user feedback
     # For simplicity now, we won't forward commands directly, we'll handle all messages
     # pass
-    logging.info(f"Received /start command from chat {message.chat.id}")
+    logging.info("Received /start command from chat %s", message.chat.id)
     # The generic message handler below will catch this and forward the update
 
 @dp.message(Command("help"))
@@ -57,7 +132,7 @@ async def handle_help(message: types.Message, bot: Bot):
     """Handles the /help command by forwarding it."""
     # await message.answer("Processing /help...") # Optional: Give user feedback
     # pass
-    logging.info(f"Received /help command from chat {message.chat.id}")
+    logging.info("Received /help command from chat %s", message.chat.id)
     # The generic message handler below will catch this and forward the update
 
 # Register a handler for *all* message types
@@ -74,15 +149,143 @@ async def handle_all_messages(message: types.Message):
 @dp.update()
 async def handle_update(update: Update):
     """Receives all updates and forwards them to the API."""
-    logging.info(f"Received update: {update.update_id}")
-    await forward_to_api(update)
+    received_at = time.time()
+    logging_setup.bind(update_id=update.update_id)
+    logging.info("Received update: %s", update.update_id)
+    if capture:
+        capture.write(update.model_dump(mode='json', exclude_none=True, by_alias=True))
+    # Serialize straight to JSON with Telegram's field names ("from", not "from_user")
+    body = update.model_dump_json(exclude_none=True, by_alias=True)
+    if spool:
+        # Updates are handled one at a time with a spool (see main), and aiogram confirms the offset
+        # once this returns, so keep retrying: Telegram holds the following updates meanwhile
+        backoff = 1.0
+        while True:
+            try:
+                await spool.append([(update.update_id, body.encode())])
+                return
+            except Exception as e:
+                logging.error("Could not spool update %s: %s. Retrying in %.0fs", update.update_id, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+    await forward_to_api(body, webhook_url(BOT_TOKENS[0]), received_at)
+
+async def handle_raw_update(raw, update_id: int, in_flight: asyncio.Semaphore, api_endpoint: str, received_at: float):
+    """Forwards one update from a raw getUpdates batch."""
+    try:
+        logging_setup.bind(update_id=update_id)
+        logging.info("Received update: %s", update_id)
+        if capture:
+            capture.write(telegram_types.decode_raw(raw))
+        await forward_to_api(bytes(raw), api_endpoint, received_at)
+    finally:
+        in_flight.release()
+
+async def poll_raw_updates(token: str, spool: "Spool | None"):
+    """
+    Long-polls getUpdates on one persistent connection and forwards updates as the original bytes.
+
+    The response envelope is decoded into Raw slices of the body, and only update_id is read
+    from each update. The offset is advanced past every update received, which confirms them
+    to Telegram on the next poll (as aiogram does). Polling waits while FORWARD_CONCURRENCY
+    updates are still being forwarded.
+
+    With a spool, each batch is committed to it before the offset moves on; if that fails the
+    batch stays unconfirmed and Telegram delivers it again. Each bot is polled by its own call.
+    """
+    url = f"https://api.telegram.org/bot{token}/getUpdates"
+    api_endpoint = webhook_url(token)
+    logging_setup.bind(bot_id=token.split(":", 1)[0])
+    offset = 0
+    backoff = 1.0
+    in_flight = asyncio.Semaphore(FORWARD_CONCURRENCY)
+    tasks = set()
+    timeout = httpx.Timeout(10.0, read=POLL_TIMEOUT_SECONDS + 10.0)
+    async with httpx.AsyncClient(timeout=timeout) as telegram:
+        try:
+            while True:
+                params = {"timeout": POLL_TIMEOUT_SECONDS}
+                if offset:
+                    params["offset"] = offset
+                try:
+                    response = await telegram.get(url, params=params)
+                    received_at = time.time()
+                    batch = telegram_types.decode_get_updates(response.content)
+                except (httpx.HTTPError, telegram_types.DecodeError) as e:
+                    logging.error("getUpdates failed (%s): %s. Retrying in %.0fs", type(e).__name__, e, backoff)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                if not batch.ok:
+                    retry_after = batch.parameters.retry_after if batch.parameters else None
+                    delay = retry_after or backoff
+                    logging.error("getUpdates returned an error: %s. Retrying in %.0fs", batch.description, delay)
+                    await asyncio.sleep(delay)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+
+                updates = [(telegram_types.peek_update_id(raw), raw) for raw in batch.result]
+                if spool and updates:
+                    try:
+                        await spool.append([(update_id, bytes(raw)) for update_id, raw in updates])
+                    except Exception as e:
+                        logging.error("Could not spool %s updates, leaving them unconfirmed: %s. Retrying in %.0fs",
+                                      len(updates), e, backoff)
+                        await asyncio.sleep(backoff)
+                        backoff = min(backoff * 2, 60.0)
+                        continue
+                    logging.info("Spooled updates %s-%s", updates[0][0], updates[-1][0])
+                backoff = 1.0
+
+                for update_id, raw in updates:
+                    offset = max(offset, update_id + 1)
+                    if spool:
+                        if capture:
+                            capture.write(telegram_types.decode_raw(raw))
+                        continue
+                    await in_flight.acquire()
+                    task = asyncio.create_task(handle_raw_update(raw, update_id, in_flight, api_endpoint, received_at))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
 
 async def main():
     """Starts the bot polling."""
-    logging.info(f"Starting bot listener... Forwarding updates to {API_BASE_URL}")
-    # Start polling
-    # Pass the bot instance to handlers if needed
-    await dp.start_polling(bot)
+    global api_client, spool
+    logging.info("Starting bot listener (%s mode, %s bots)... Forwarding updates to %s",
+                 LISTENER_MODE, len(BOT_TOKENS), API_BASE_URL)
+    api_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(FORWARD_TIMEOUT_SECONDS, connect=10.0),
+        limits=httpx.Limits(max_connections=FORWARD_CONCURRENCY, max_keepalive_connections=FORWARD_CONCURRENCY)
+    )
+    spools: dict[str, Spool] = {}
+    drainers = []
+    if SPOOL_PATH:
+        for token in BOT_TOKENS:
+            spools[token] = Spool(spool_path(token))
+            await spools[token].open()
+            forward = functools.partial(forward_to_api, api_endpoint=webhook_url(token))
+            drainers.append(asyncio.create_task(spools[token].drain(forward, FORWARD_CONCURRENCY)))
+    try:
+        if LISTENER_MODE == "raw":
+            await asyncio.gather(*(poll_raw_updates(token, spools.get(token)) for token in BOT_TOKENS))
+        else:
+            spool = spools.get(BOT_TOKENS[0])
+            # With a spool, handle updates in order rather than as tasks, so an update is spooled
+            # before polling moves on and the next getUpdates confirms its offset
+            await dp.start_polling(bot, handle_as_tasks=spool is None)
+    finally:
+        # Undelivered updates stay in the spools for the next run
+        for drainer in drainers:
+            drainer.cancel()
+        await asyncio.gather(*drainers, return_exceptions=True)
+        for bot_spool in spools.values():
+            await bot_spool.close()
+        await api_client.aclose()
+        if capture:
+            capture.close()
 
 if __name__ == '__main__':
     asyncio.run(main()) 
\ No newline at end of file
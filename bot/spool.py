@@ -0,0 +1,201 @@
+"""
+Durable local spool between Telegram and the API.
+
+Updates are written to an SQLite queue (WAL, synchronous=FULL) before the polling offset is
+advanced, and a drainer forwards them to the API afterwards, deleting each one once the API
+has accepted it. If the API is down or slow, updates wait on disk instead of being dropped,
+and survive listener restarts; the backlog drains with bounded concurrency once the API is
+back. Delivery is at-least-once: an update can be forwarded twice if the listener stops
+between a successful forward and its deletion, or if a forward times out after the API has
+handled it. The API acks such redeliveries without handling them again (api/seen_updates.py).
+
+Appends are group-committed: while one transaction is being written, further appends queue
+up and go into the next transaction, so a burst costs a few fsyncs rather than one per update.
+All SQLite access happens on a single worker thread, off the event loop.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF_SECONDS = 60.0
+IDLE_WAIT_SECONDS = 1.0
+
+
+class Spool:
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self._db: Optional[sqlite3.Connection] = None
+        self._pending: list[tuple[list[tuple[int, bytes]], asyncio.Future]] = []
+        self._flushing = False
+        self._has_updates = asyncio.Event()
+        self.appended = 0
+        self.commits = 0
+
+    # --- SQLite, on the worker thread only ---
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " update_id INTEGER PRIMARY KEY,"
+            " body BLOB NOT NULL,"
+            " enqueued_at REAL NOT NULL)"
+        )
+        return self._db.execute("SELECT count(*) FROM spool").fetchone()[0]
+
+    def _insert(self, rows: list[tuple[int, bytes]]):
+        now = time.time()
+        self._db.execute("BEGIN")
+        # Telegram re-sends updates whose offset wasn't confirmed; the primary key absorbs those
+        self._db.executemany(
+            "INSERT OR IGNORE INTO spool (update_id, body, enqueued_at) VALUES (?, ?, ?)",
+            [(update_id, body, now) for update_id, body in rows]
+        )
+        self._db.execute("COMMIT")
+
+    def _fetch(self, after: int, limit: int) -> list[tuple[int, bytes, float]]:
+        return self._db.execute(
+            "SELECT update_id, body, enqueued_at FROM spool WHERE update_id > ? ORDER BY update_id LIMIT ?", (after, limit)
+        ).fetchall()
+
+    def _delete(self, update_ids: list[int]):
+        self._db.execute("BEGIN")
+        self._db.executemany("DELETE FROM spool WHERE update_id = ?", [(update_id,) for update_id in update_ids])
+        self._db.execute("COMMIT")
+
+    def _backlog(self) -> int:
+        return self._db.execute("SELECT count(*) FROM spool").fetchone()[0]
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # --- Public API ---
+
+    async def open(self):
+        backlog = await self._run(self._open)
+        if backlog:
+            logger.info("Spool %s has %s updates left from a previous run.", self.path, backlog)
+            self._has_updates.set()
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=True)
+
+    async def append(self, rows: list[tuple[int, bytes]]):
+        """Durably stores (update_id, body) rows. Returns once they are committed to disk."""
+        if not rows:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((rows, future))
+        if not self._flushing:
+            self._flushing = True
+            asyncio.create_task(self._flush())
+        await future
+
+    async def _flush(self):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                rows = [row for rows, _ in batch for row in rows]
+                try:
+                    await self._run(self._insert, rows)
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                self.appended += len(rows)
+                self.commits += 1
+                for _, future in batch:
+                    future.set_result(None)
+                self._has_updates.set()
+        finally:
+            self._flushing = False
+
+    async def drain(self, forward: Callable[..., Awaitable[bool]], concurrency: int, batch_size: int = 200):
+        """
+        Forwards spooled updates in update_id order, with at most `concurrency` in flight, until
+        cancelled. `forward(body, received_at=enqueued_at)` returns True once the update needs no
+        further attempts (accepted, or rejected as invalid) and False to retry it. A failed attempt pauses dispatching with
+        exponential backoff, since it usually means the API is unavailable.
+        """
+        slots = asyncio.Semaphore(concurrency)
+        in_flight: set[int] = set() # Dispatched and not yet settled
+        delivered: list[int] = []
+        failed: list[int] = []
+        tasks = set()
+        cursor = 0 # Highest update_id dispatched; moved back when an update fails
+        backoff = 0.0
+        resume_at = 0.0
+
+        async def deliver(update_id: int, body: bytes, enqueued_at: float):
+            nonlocal backoff, resume_at
+            try:
+                ok = await forward(body, received_at=enqueued_at)
+            except Exception as e:
+                logger.error("Unexpected error forwarding spooled update %s: %s", update_id, e)
+                ok = False
+            if ok:
+                delivered.append(update_id)
+                backoff = 0.0
+            else:
+                failed.append(update_id)
+                backoff = min(max(backoff * 2, 1.0), MAX_BACKOFF_SECONDS)
+                resume_at = time.monotonic() + backoff
+            slots.release()
+            self._has_updates.set()
+
+        try:
+            while True:
+                # Settle finished deliveries first, so moving the cursor back never re-sends a delivered row
+                if delivered:
+                    done = delivered[:]
+                    delivered.clear()
+                    await self._run(self._delete, done)
+                    in_flight.difference_update(done)
+                if failed:
+                    cursor = min(cursor, min(failed) - 1)
+                    logger.warning("Forwarding failed for %s spooled updates; %s waiting. Retrying in %.0fs",
+                                   len(failed), await self._run(self._backlog), backoff)
+                    in_flight.difference_update(failed)
+                    failed.clear()
+                delay = resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self._has_updates.clear()
+                rows = await self._run(self._fetch, cursor, batch_size)
+                rows = [row for row in rows if row[0] not in in_flight]
+                if not rows:
+                    try:
+                        await asyncio.wait_for(self._has_updates.wait(), IDLE_WAIT_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                for update_id, body, enqueued_at in rows:
+                    await slots.acquire()
+                    if time.monotonic() < resume_at: # A delivery failed meanwhile; pause until the backoff passes
+                        slots.release()
+                        break
+                    in_flight.add(update_id)
+                    cursor = max(cursor, update_id)
+                    task = asyncio.create_task(deliver(update_id, body, enqueued_at))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if delivered:
+                await self._run(self._delete, delivered)
@@ -0,0 +1,115 @@
+import pytest
+
+from api import dedup
+from api.dedup import DedupWindow, Fingerprint, hamming, normalize
+
+LONG_TEXT = "Has anyone tried the new release of the bot framework, it seems much faster for big groups"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Hello, World!!", "hello world"),
+    ("  HELLO\n\tworld ", "hello world"),
+    ("ＨＥＬＬＯ ｗｏｒｌｄ", "hello world"), # Full-width look-alikes
+    ("Straße", "strasse"),
+    ("snake_case-name", "snake case name"),
+    ("ship it 🚀🚀", "ship it"),
+    ("🚀🔥", ""),
+    ("see https://example.com/a?utm_source=tg&x=1 now", "see https example com a now"),
+])
+def test_normalize(text, expected):
+    assert normalize(text) == expected
+
+def test_trivial_variations_share_text_hash():
+    variants = [LONG_TEXT, LONG_TEXT.upper(), LONG_TEXT.replace(",", " ...") + "!!", f"  {LONG_TEXT} 👍"]
+    assert len({Fingerprint(text).text_hash for text in variants}) == 1
+    assert len({Fingerprint(text).simhash for text in variants}) == 1
+
+def test_tracking_query_strings_are_ignored():
+    a = Fingerprint("look at https://example.com/post/1?utm_source=a")
+    b = Fingerprint("look at https://example.com/post/1?utm_source=b&ref=c")
+    assert a.text_hash == b.text_hash
+    assert a.text_hash != Fingerprint("look at https://example.com/post/2").text_hash
+
+def test_emoji_only_messages_hash_raw_text():
+    rocket = Fingerprint("@bot 🚀")
+    assert rocket.text_hash != Fingerprint("@bot 🔥").text_hash
+    assert rocket.text_hash == Fingerprint("  @Bot   🚀 ").text_hash
+    assert rocket.simhash is None
+    assert Fingerprint("?!").text_hash != Fingerprint("...").text_hash
+
+def test_mentions_alone_do_not_count_as_text():
+    assert Fingerprint("@alice 👍").text_hash != Fingerprint("@bob 👍").text_hash
+    assert Fingerprint("@alice thanks").text_hash == Fingerprint("@alice, thanks!").text_hash
+
+def test_short_texts_dedup_exactly_only():
+    short = Fingerprint("thanks a lot everyone")
+    assert short.tokens == 4
+    assert short.simhash is None
+    long = Fingerprint(LONG_TEXT)
+    assert long.tokens == 17
+    assert long.simhash is not None
+
+@pytest.mark.parametrize("text", [LONG_TEXT, "a", "@bot 🚀", "x " * 50] + [f"message number {n} in a long thread" for n in range(50)])
+def test_hashes_fit_bigint(text):
+    fingerprint = Fingerprint(text)
+    for value in (fingerprint.text_hash, fingerprint.simhash):
+        assert value is None or -(1 << 63) <= value < (1 << 63)
+
+def test_hamming_of_signed_values():
+    assert hamming(-1, 0) == 64
+    assert hamming(dedup._signed(1 << 63), 0) == 1
+    assert hamming(5, 6) == 2
+
+
+def near_copy(fingerprint: Fingerprint, flipped_bits: int) -> Fingerprint:
+    """A fingerprint with different text whose SimHash differs in `flipped_bits` bits."""
+    copy = Fingerprint(LONG_TEXT + " and also something else")
+    copy.simhash = dedup._signed((fingerprint.simhash & dedup._MASK_64) ^ ((1 << flipped_bits) - 1))
+    return copy
+
+def window(**overrides) -> DedupWindow:
+    return DedupWindow(**{"per_chat": 10, "max_age_seconds": 60, "max_distance": 6, "max_chats": 10, **overrides})
+
+def test_window_exact_and_near_matches():
+    w = window()
+    original = Fingerprint(LONG_TEXT)
+    w.remember((1, -100), 7, original)
+
+    assert w.match((1, -100), Fingerprint(LONG_TEXT.upper())) == 7
+    assert w.match((1, -100), near_copy(original, 6)) == 7
+    assert w.match((1, -100), near_copy(original, 7)) is None
+    assert w.match((2, -100), original) is None # Other bot, same chat
+    assert w.stats() == {"chats": 1, "exact_hits": 1, "near_hits": 1, "misses": 2}
+
+def test_window_prefers_newest_entry():
+    w = window()
+    w.remember("chat", 1, Fingerprint(LONG_TEXT))
+    w.remember("chat", 2, Fingerprint(LONG_TEXT))
+    assert w.match("chat", Fingerprint(LONG_TEXT)) == 2
+
+def test_window_expires_old_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: now[0])
+    w = window(max_age_seconds=60)
+    w.remember("chat", 1, Fingerprint(LONG_TEXT))
+    now[0] += 59
+    assert w.match("chat", Fingerprint(LONG_TEXT)) == 1
+    now[0] += 2
+    assert w.match("chat", Fingerprint(LONG_TEXT)) is None
+
+def test_window_bounds():
+    w = window(per_chat=2, max_chats=2)
+    for memory_id, text in enumerate(["one two", "three four", "five six"]):
+        w.remember("a", memory_id, Fingerprint(text))
+    assert w.match("a", Fingerprint("one two")) is None # Pushed out of the chat's window
+    assert w.match("a", Fingerprint("five six")) == 2
+
+    w.remember("b", 10, Fingerprint("seven"))
+    w.remember("a", 3, Fingerprint("eight")) # "a" becomes most recently used
+    w.remember("c", 11, Fingerprint("nine"))
+    assert w.match("b", Fingerprint("seven")) is None
+    assert w.match("a", Fingerprint("eight")) == 3
+
+    disabled = window(per_chat=0)
+    disabled.remember("a", 1, Fingerprint("one two"))
+    assert disabled.stats()["chats"] == 0
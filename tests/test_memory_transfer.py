@@ -0,0 +1,116 @@
+import json
+import struct
+
+import pytest
+
+from api import memory_transfer as mt
+
+
+def copy_tuple(fields):
+    """Encodes one binary COPY tuple the way PostgreSQL does."""
+    parts = [struct.pack(">h", len(fields))]
+    for value in fields:
+        parts.append(struct.pack(">i", -1) if value is None else struct.pack(">i", len(value)) + value)
+    return b"".join(parts)
+
+def copy_stream(rows):
+    return mt.PG_COPY_HEADER + b"".join(copy_tuple(fields) for fields in rows) + mt.PG_COPY_TRAILER
+
+def memory_fields(chat_id=-1001234, message_id=42, user_id=777, timestamp=812_345_678_000_000, bot_id=555,
+                  text="hello 👋", model="text-embedding-3-small", vector=(0.25, -1.5, 3.0)):
+    """One chat_memories row in MEMORY_COLUMNS order, as raw COPY field bytes."""
+    return [
+        struct.pack(">q", chat_id),
+        struct.pack(">q", message_id),
+        struct.pack(">q", user_id),
+        struct.pack(">q", timestamp),
+        struct.pack(">q", bot_id),
+        text.encode(),
+        None if model is None else model.encode(),
+        struct.pack(">HH", len(vector), 0) + struct.pack(f">{len(vector)}f", *vector),
+    ]
+
+def payload_of(record: bytes) -> bytes:
+    kind, length = struct.unpack_from(">BI", record)
+    assert kind == mt.KIND_MEMORY
+    assert len(record) == 5 + length
+    return record[5:]
+
+
+def test_parser_reads_tuples_and_nulls():
+    rows = [memory_fields(), memory_fields(message_id=43, model=None)]
+    assert mt.CopyBinaryParser().feed(copy_stream(rows)) == rows
+
+def test_parser_handles_partial_chunks():
+    rows = [memory_fields(message_id=n, text="x" * n) for n in range(1, 6)]
+    stream = copy_stream(rows)
+    for chunk_size in (1, 3, 17, 64):
+        parser = mt.CopyBinaryParser()
+        parsed = []
+        for start in range(0, len(stream), chunk_size):
+            parsed += parser.feed(stream[start:start + chunk_size])
+        assert parsed == rows, chunk_size
+        assert not parser._buffer
+
+def test_parser_skips_header_extension():
+    extension = b"\x01\x02\x03"
+    stream = mt.PG_COPY_SIGNATURE + struct.pack(">iI", 0, len(extension)) + extension + copy_tuple(memory_fields())
+    assert mt.CopyBinaryParser().feed(stream) == [memory_fields()]
+
+def test_parser_rejects_other_streams():
+    with pytest.raises(ValueError):
+        mt.CopyBinaryParser().feed(b"COPY 1\n" + b"\x00" * 32)
+
+@pytest.mark.parametrize("model", ["text-embedding-3-small", None, ""])
+def test_export_import_round_trip(model):
+    fields = memory_fields(model=model)
+    record = mt.encode_memory(fields)
+    assert mt.memory_to_copy_tuple(payload_of(record)) == copy_tuple(fields)
+
+def test_round_trip_of_empty_text_and_vector():
+    fields = memory_fields(text="", vector=())
+    assert mt.memory_to_copy_tuple(payload_of(mt.encode_memory(fields))) == copy_tuple(fields)
+
+def test_format_1_payload_gets_the_given_bot_id():
+    payload = payload_of(mt.encode_memory(memory_fields(bot_id=555)))
+    format_1_payload = payload[:32] + payload[40:] # Format 1 had no bot_id column
+    assert mt.memory_to_copy_tuple(format_1_payload, 1, 4242) == copy_tuple(memory_fields(bot_id=4242))
+
+def test_format_2_payload_keeps_its_bot_id():
+    payload = payload_of(mt.encode_memory(memory_fields(bot_id=555)))
+    assert mt.memory_to_copy_tuple(payload, 2, 4242) == copy_tuple(memory_fields(bot_id=555))
+
+
+def write_transfer_file(path, rows, header=None):
+    header = json.dumps(header or {"format_version": mt.FORMAT_VERSION}).encode()
+    with open(path, "wb") as out:
+        out.write(mt.MAGIC + struct.pack(">I", len(header)) + header)
+        out.write(mt._record(mt.KIND_GROUP, json.dumps({"chat_id": -1001234}).encode()))
+        out.write(b"".join(mt.encode_memory(fields) for fields in rows))
+        out.write(mt._record(mt.KIND_END, json.dumps({"memories": len(rows)}).encode()))
+
+def test_iter_records_across_read_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(mt, "READ_CHUNK_BYTES", 7)
+    rows = [memory_fields(message_id=n) for n in range(3)]
+    path = tmp_path / "chats.tfm"
+    write_transfer_file(path, rows)
+
+    records = list(mt.iter_records(str(path)))
+    assert records[0] == (None, json.dumps({"format_version": mt.FORMAT_VERSION}).encode())
+    assert [kind for kind, _ in records[1:]] == [mt.KIND_GROUP] + [mt.KIND_MEMORY] * 3 + [mt.KIND_END]
+    memories = [mt.memory_to_copy_tuple(payload) for kind, payload in records if kind == mt.KIND_MEMORY]
+    assert mt.CopyBinaryParser().feed(mt.PG_COPY_HEADER + b"".join(memories) + mt.PG_COPY_TRAILER) == rows
+
+def test_iter_records_rejects_truncated_files(tmp_path):
+    path = tmp_path / "chats.tfm"
+    write_transfer_file(path, [memory_fields()])
+    data = path.read_bytes()
+    path.write_bytes(data[:-3])
+    with pytest.raises(ValueError, match="truncated"):
+        list(mt.iter_records(str(path)))
+
+def test_iter_records_rejects_other_files(tmp_path):
+    path = tmp_path / "chats.tfm"
+    path.write_bytes(b"PK\x03\x04" + b"\x00" * 16)
+    with pytest.raises(ValueError, match="not a Telefy"):
+        list(mt.iter_records(str(path)))
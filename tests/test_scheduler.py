@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from api.scheduler import CronSchedule, IntervalSchedule, _cron_field, parse_schedule
+
+
+def ts(*args) -> float:
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+def next_run(spec: str, *now) -> datetime:
+    return datetime.fromtimestamp(CronSchedule(spec).next_after(ts(*now)), timezone.utc)
+
+
+@pytest.mark.parametrize("field, expected", [
+    ("*", set(range(0, 60))),
+    ("*/15", {0, 15, 30, 45}),
+    ("5", {5}),
+    ("1-5", {1, 2, 3, 4, 5}),
+    ("10-20/5", {10, 15, 20}),
+    ("5/20", {5, 25, 45}),
+    ("1,3,40-42", {1, 3, 40, 41, 42}),
+])
+def test_cron_field(field, expected):
+    assert _cron_field(field, 0, 59) == expected
+
+@pytest.mark.parametrize("field", ["60", "5-1", "*/0", "-1", "abc", "1,", ""])
+def test_cron_field_rejects(field):
+    with pytest.raises(ValueError):
+        _cron_field(field, 0, 59)
+
+@pytest.mark.parametrize("spec", ["* * * *", "* * * * * *", "0 24 * * *", "0 0 0 * *", "0 0 * 13 *", "0 0 * * 8"])
+def test_cron_spec_rejects(spec):
+    with pytest.raises(ValueError):
+        CronSchedule(spec)
+
+
+def test_next_after_is_strictly_later():
+    assert next_run("30 3 * * *", 2026, 10, 19, 3, 29, 59) == datetime(2026, 10, 19, 3, 30, tzinfo=timezone.utc)
+    assert next_run("30 3 * * *", 2026, 10, 19, 3, 30) == datetime(2026, 10, 20, 3, 30, tzinfo=timezone.utc)
+    assert next_run("30 3 * * *", 2026, 10, 19, 12, 0) == datetime(2026, 10, 20, 3, 30, tzinfo=timezone.utc)
+
+def test_next_after_rolls_over_month_and_year():
+    assert next_run("0 0 1 * *", 2026, 12, 15) == datetime(2027, 1, 1, tzinfo=timezone.utc)
+    assert next_run("0 0 29 2 *", 2026, 3, 1) == datetime(2028, 2, 29, tzinfo=timezone.utc)
+
+def test_weekdays_0_and_7_are_sunday():
+    sunday = datetime(2026, 10, 25, 12, 0, tzinfo=timezone.utc)
+    assert next_run("0 12 * * 0", 2026, 10, 19) == sunday
+    assert next_run("0 12 * * 7", 2026, 10, 19) == sunday
+
+def test_day_of_month_or_weekday():
+    # Both restricted: either may match, like cron (2026-11-01 is a Sunday, the Monday after is the 2nd)
+    assert next_run("0 12 1 * 1", 2026, 10, 27) == datetime(2026, 11, 1, 12, 0, tzinfo=timezone.utc)
+    assert next_run("0 12 13 * 5", 2026, 10, 19) == datetime(2026, 10, 23, 12, 0, tzinfo=timezone.utc)
+    # Only one restricted: that one must match
+    assert next_run("0 12 13 * *", 2026, 10, 19) == datetime(2026, 11, 13, 12, 0, tzinfo=timezone.utc)
+    assert next_run("0 12 * * 5", 2026, 10, 24) == datetime(2026, 10, 30, 12, 0, tzinfo=timezone.utc)
+
+def test_impossible_date_never_matches():
+    with pytest.raises(ValueError, match="never matches"):
+        CronSchedule("0 0 31 2 *").next_after(ts(2026, 10, 19))
+
+def test_period():
+    now = ts(2026, 10, 19, 12, 7)
+    assert CronSchedule("*/15 * * * *").period(now) == 900
+    assert CronSchedule("30 3 * * *").period(now) == 86400
+    assert IntervalSchedule(90).period(now) == 90
+
+
+@pytest.mark.parametrize("spec, seconds", [
+    ("every 10s", 10),
+    ("every 15m", 900),
+    ("every 2h", 7200),
+    ("every 1d", 86400),
+    ("every 1.5h", 5400),
+    ("every 30", 30),
+    ("  every 5m  ", 300),
+])
+def test_parse_interval(spec, seconds):
+    schedule = parse_schedule(spec)
+    assert isinstance(schedule, IntervalSchedule)
+    assert schedule.seconds == seconds
+    assert schedule.next_after(1000.0) == 1000.0 + seconds
+
+def test_parse_cron():
+    schedule = parse_schedule("30 3 * * *")
+    assert isinstance(schedule, CronSchedule)
+    assert schedule.minutes == {30} and schedule.hours == {3}
+
+@pytest.mark.parametrize("spec", ["every 0m", "every -5s", "every m", "every 5w", "daily"])
+def test_parse_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_schedule(spec)